@@ -5,9 +5,22 @@ import logging
 import datetime
 import random
 import string
-import sqlite3
-from pathlib import Path
 import json
+import threading
+from collections import OrderedDict
+import time
+
+# setup import to work with django or standalone
+try:
+    import Thud.ThudStorage as ThudStorage
+    import Thud.ThudTimers as ThudTimers
+    import Thud.ThudMatchmaking as ThudMatchmaking
+    import Thud.ThudPresence as ThudPresence
+except ImportError:
+    import ThudStorage
+    import ThudTimers
+    import ThudMatchmaking
+    import ThudPresence
 
 # setup logging to work correctly both with django and standalone
 try:
@@ -16,16 +29,136 @@ try:
 except ImportError:
     logging.basicConfig(filename=os.path.join(os.getcwd(), 'ThudLog.log'), level=logging.DEBUG)
 
+BOARD_SIZE = 15
+
+# Occupancy bitboards store square x,y at bit x * BOARD_SIZE + y of a 225 bit integer
+SQUARE_BITS = [[1 << (x * BOARD_SIZE + y) for y in range(BOARD_SIZE)] for x in range(BOARD_SIZE)]
+
+
+def build_adjacent_masks():
+    masks = [[0] * BOARD_SIZE for x in range(BOARD_SIZE)]
+    for x in range(BOARD_SIZE):
+        for y in range(BOARD_SIZE):
+            for x_value in range(max(x - 1, 0), min(x + 2, BOARD_SIZE)):
+                for y_value in range(max(y - 1, 0), min(y + 2, BOARD_SIZE)):
+                    if (x_value, y_value) != (x, y):
+                        masks[x][y] |= SQUARE_BITS[x_value][y_value]
+    return masks
+
+
+ADJACENT_MASKS = build_adjacent_masks()
+
+# Compass directions as (x, y) steps, ordered so that the opposite of direction d is 7 - d
+DIRECTIONS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+OPPOSITE_DIRECTIONS = tuple(7 - direction for direction in range(len(DIRECTIONS)))
+DIRECTION_INDEX = {step: direction for direction, step in enumerate(DIRECTIONS)}
+
+
+def on_board(x, y):
+    """
+    True for squares inside the octagon, including the Thud stone
+    """
+    if x < 0 or y < 0 or x >= BOARD_SIZE or y >= BOARD_SIZE:
+        return False
+    if x < 5:
+        return 5 - x <= y < 10 + x
+    elif x > 9:
+        return x - 9 <= y < 24 - x
+    return True
+
+
+def build_rays():
+    """
+    For every square and direction, the squares walked in order until the edge of the octagon, along with running
+    masks where RAY_MASKS[x][y][direction][n] covers the first n squares of the ray
+    """
+    rays = [[None] * BOARD_SIZE for x in range(BOARD_SIZE)]
+    ray_masks = [[None] * BOARD_SIZE for x in range(BOARD_SIZE)]
+    for x in range(BOARD_SIZE):
+        for y in range(BOARD_SIZE):
+            square_rays = []
+            square_masks = []
+            for step_x, step_y in DIRECTIONS:
+                ray = []
+                masks = [0]
+                ray_x, ray_y = x + step_x, y + step_y
+                while on_board(ray_x, ray_y):
+                    ray.append((ray_x, ray_y))
+                    masks.append(masks[-1] | SQUARE_BITS[ray_x][ray_y])
+                    ray_x, ray_y = ray_x + step_x, ray_y + step_y
+                square_rays.append(tuple(ray))
+                square_masks.append(tuple(masks))
+            rays[x][y] = tuple(square_rays)
+            ray_masks[x][y] = tuple(square_masks)
+    return rays, ray_masks
+
+
+RAYS, RAY_MASKS = build_rays()
+
+
+def find_line(start_x, start_y, end_x, end_y):
+    """
+    Returns (direction, distance) for two squares on a straight or diagonal line, or None if they aren't
+    """
+    delta_x = end_x - start_x
+    delta_y = end_y - start_y
+    distance = max(abs(delta_x), abs(delta_y))
+    if distance == 0 or (delta_x and delta_y and abs(delta_x) != abs(delta_y)):
+        return None
+    return DIRECTION_INDEX[(delta_x // distance, delta_y // distance)], distance
+
+
+def build_zobrist_keys():
+    """
+    64 bit keys for each piece type on each square, and one for trolls to move.  The generator is seeded so that
+    hashes are the same in every process and can be stored.
+    """
+    generator = random.Random(0x7468756421)
+    keys = {piece_type: [[generator.getrandbits(64) for y in range(BOARD_SIZE)] for x in range(BOARD_SIZE)]
+            for piece_type in ('Dwarf', 'Troll')}
+    return keys, generator.getrandbits(64)
+
+
+ZOBRIST_KEYS, ZOBRIST_TROLL_TO_MOVE = build_zobrist_keys()
+
+
+def mask_squares(mask):
+    """
+    Yields the x, y squares set in an occupancy mask, ordered by x then y
+    """
+    while mask:
+        low_bit = mask & -mask
+        yield divmod(low_bit.bit_length() - 1, BOARD_SIZE)
+        mask ^= low_bit
+
+
+# Compact board encoding for Board.to_bytes - a version byte, then a byte for each square of the octagon in this order,
+# 0 for an empty square (or the Thud stone) and piece id * 2 + 1 for a troll or piece id * 2 for a dwarf
+BOARD_FORMAT_VERSION = 1
+PLAYABLE_SQUARES = tuple((x, y) for x in range(BOARD_SIZE) for y in range(BOARD_SIZE) if on_board(x, y))
+
 
 class Board(object):
+    """
+    The gameboard keeps its occupancy as three bitboards - dwarves, trolls and blocked squares (the cut away corners
+    and the Thud stone).  The squares grid of 'x,y' strings, 0 for blocked squares and Piece objects is kept as a view
+    of the same data for reporting and saving games.  A Zobrist hash of the pieces is kept up to date alongside the
+    bitboards.  Any change to the board should go through the Board methods so they all stay in step.
+    """
 
-    def __init__(self):
+    def __init__(self, populate=True):
         self.name = 'Gameboard'
         self.squares = [[str(x) + ',' + str(y) for y in range(15)] for x in range(15)]
         self.moves = []
         self.piece_id = 0
+        self.dwarves = 0
+        self.trolls = 0
+        self.blocked = 0
+        self.zobrist = 0
         self.populate_invalid_moves()
-        self.units = self.populate_units()
+        # an empty board is only wanted when the pieces are about to be filled in some other way
+        self.units = self.populate_units() if populate else []
+        self.rebuild_occupancy()
 
     def __getitem__(self, key):
         return self.squares[key]
@@ -98,11 +231,72 @@ class Board(object):
                     units.append(self.squares[row][column])
         return units
 
+    @property
+    def occupied(self):
+        return self.dwarves | self.trolls
+
+    @property
+    def obstacles(self):
+        return self.dwarves | self.trolls | self.blocked
+
+    def rebuild_occupancy(self):
+        """
+        Recalculates the bitboards and position hash from the squares grid, used after the grid has been filled in
+        directly
+        """
+        dwarves = trolls = blocked = zobrist = 0
+        for x, column in enumerate(self.squares):
+            for y, square in enumerate(column):
+                if isinstance(square, Dwarf):
+                    dwarves |= SQUARE_BITS[x][y]
+                    zobrist ^= ZOBRIST_KEYS['Dwarf'][x][y]
+                elif isinstance(square, Troll):
+                    trolls |= SQUARE_BITS[x][y]
+                    zobrist ^= ZOBRIST_KEYS['Troll'][x][y]
+                elif square == 0:
+                    blocked |= SQUARE_BITS[x][y]
+        self.dwarves, self.trolls, self.blocked, self.zobrist = dwarves, trolls, blocked, zobrist
+
+    def clear_occupancy(self, x, y):
+        bit = SQUARE_BITS[x][y]
+        if self.dwarves & bit:
+            self.zobrist ^= ZOBRIST_KEYS['Dwarf'][x][y]
+        elif self.trolls & bit:
+            self.zobrist ^= ZOBRIST_KEYS['Troll'][x][y]
+        self.dwarves &= ~bit
+        self.trolls &= ~bit
+        self.blocked &= ~bit
+
+    def set_occupancy(self, x, y, value):
+        self.clear_occupancy(x, y)
+        if isinstance(value, Dwarf):
+            self.dwarves |= SQUARE_BITS[x][y]
+            self.zobrist ^= ZOBRIST_KEYS['Dwarf'][x][y]
+        elif isinstance(value, Troll):
+            self.trolls |= SQUARE_BITS[x][y]
+            self.zobrist ^= ZOBRIST_KEYS['Troll'][x][y]
+        elif value == 0:
+            self.blocked |= SQUARE_BITS[x][y]
+
+    def is_dwarf(self, x, y):
+        return bool(self.dwarves & SQUARE_BITS[x][y])
+
+    def is_troll(self, x, y):
+        return bool(self.trolls & SQUARE_BITS[x][y])
+
+    def is_blocked(self, x, y):
+        return bool(self.blocked & SQUARE_BITS[x][y])
+
+    def is_open(self, x, y):
+        return not self.obstacles & SQUARE_BITS[x][y]
+
     def move_piece_on_board(self, piece, x, y):
         piece_x = piece.x
         piece_y = piece.y
         self.squares[x][y] = piece
         self.squares[piece_x][piece_y] = str(piece_x) + ',' + str(piece_y)
+        self.clear_occupancy(piece_x, piece_y)
+        self.set_occupancy(x, y, piece)
         return True
 
     def get_piece(self, x, y):
@@ -114,12 +308,219 @@ class Board(object):
 
     def set_square(self, x, y, value):
         self.squares[x][y] = value
+        self.set_occupancy(x, y, value)
 
     def capture_piece(self, piece):
         x, y = piece.x, piece.y
         piece.capture()
         self.set_square(x, y, str(x) + ',' + str(y))
 
+    def load_game_state(self, game_state, unit_data=None):
+        """
+        Rebuilds the board from the output of GameManager.report_game_state, along with the saved piece details
+        (move history and status by piece id) if there are any
+        """
+        self.units = []
+        for x, column in enumerate(self.squares):
+            for y in range(len(column)):
+                square = game_state[str(x)][y]
+                if square['type'] == 'null':
+                    self.squares[x][y] = 0
+                elif square['type'] == 'open':
+                    self.squares[x][y] = str(x) + ',' + str(y)
+                else:
+                    if square['type'] == 'Dwarf':
+                        piece = Dwarf(x, y, square['id'])
+                    elif square['type'] == 'Troll':
+                        piece = Troll(x, y, square['id'])
+                    if unit_data is not None:
+                        piece.moves = unit_data[str(square['id'])]['move_history']
+                        piece.status = unit_data[str(square['id'])]['status']
+                    self.squares[x][y] = piece
+                    self.units.append(piece)
+        self.rebuild_occupancy()
+
+    def to_bytes(self):
+        """
+        Encodes the pieces on the board in BOARD_FORMAT_VERSION format, one byte per square of the octagon
+        :return bytes:
+        """
+        encoded = bytearray([BOARD_FORMAT_VERSION])
+        for x, y in PLAYABLE_SQUARES:
+            square = self.squares[x][y]
+            if isinstance(square, Piece):
+                if not 0 < square.id < 128:
+                    raise ValueError("Piece id {} can't be encoded.".format(square.id))
+                encoded.append(square.id << 1 | (square.type == 'Troll'))
+            else:
+                encoded.append(0)
+        return bytes(encoded)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Builds a board from the output of to_bytes.  Pieces keep their ids, and their move history starts from the
+        square they're on.
+        """
+        if len(data) != len(PLAYABLE_SQUARES) + 1 or data[0] != BOARD_FORMAT_VERSION:
+            raise ValueError("Unknown board format.")
+        board = cls(populate=False)
+        for (x, y), value in zip(PLAYABLE_SQUARES, data[1:]):
+            if value:
+                piece = Troll(x, y, value >> 1) if value & 1 else Dwarf(x, y, value >> 1)
+                board.squares[x][y] = piece
+                board.units.append(piece)
+        board.piece_id = max([piece.id for piece in board.units] + [0])
+        board.rebuild_occupancy()
+        return board
+
+    def report_units(self):
+        """
+        Returns every piece's type, move history and status by piece id, including captured pieces, which to_bytes
+        leaves out
+        """
+        return dict((str(unit.id), {"type": unit.type, "move_history": unit.moves, "status": unit.status})
+                    for unit in self.units)
+
+    def load_units(self, unit_data):
+        """
+        Puts back the move histories and captured pieces from report_units on a board built by from_bytes
+        """
+        pieces = dict((unit.id, unit) for unit in self.units)
+        for piece_id, data in unit_data.items():
+            moves = [tuple(square) for square in data["move_history"]]
+            piece = pieces.get(int(piece_id))
+            if piece is None:
+                x, y = moves[-1]
+                piece = Troll(x, y, int(piece_id)) if data["type"] == 'Troll' else Dwarf(x, y, int(piece_id))
+                pieces[piece.id] = piece
+            piece.moves = moves
+            piece.status = data["status"]
+        self.units = [pieces[piece_id] for piece_id in sorted(pieces)]
+        self.piece_id = max(list(pieces) + [0])
+
+    def load_occupancy(self, dwarves, trolls):
+        """
+        Replaces the pieces on the board with new pieces on the squares set in the dwarf and troll masks
+        """
+        for x, y in mask_squares(self.occupied):
+            self.squares[x][y] = str(x) + ',' + str(y)
+        self.piece_id = 0
+        self.units = []
+        for x, y in mask_squares(dwarves):
+            self.squares[x][y] = Dwarf(x, y, self.generate_piece_id())
+            self.units.append(self.squares[x][y])
+        for x, y in mask_squares(trolls):
+            self.squares[x][y] = Troll(x, y, self.generate_piece_id())
+            self.units.append(self.squares[x][y])
+        self.rebuild_occupancy()
+
+    def restore_piece(self, piece):
+        piece.restore()
+        self.set_square(piece.x, piece.y, piece)
+
+
+# moves between the snapshots of a game's pieces saved alongside its move log
+SNAPSHOT_INTERVAL = 32
+# games kept in memory by each GameManager, the rest are loaded from the database when they're next used
+MAX_ACTIVE_GAMES = 1000
+# seconds a game can go unused before it's saved and dropped from memory
+IDLE_TIMEOUT = 2 * 60 * 60
+
+
+class GameCache(object):
+    """
+    The games a GameManager has in memory, by game token.  Works like a dict, except that looking up a game that
+    isn't in memory loads it through load (returning None if there's no such game), and once there are more than
+    capacity games the least recently used are handed to evict and dropped.  Games that pinned(game_id, game) says
+    are still in use are never dropped, even if that leaves more than capacity games in memory.
+    """
+
+    def __init__(self, load, evict, capacity=MAX_ACTIVE_GAMES, pinned=None):
+        self.load = load
+        self.evict = evict
+        self.capacity = capacity
+        self.pinned = pinned
+        self.games = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __getitem__(self, game_id):
+        game = self.get(game_id)
+        if game is None:
+            raise KeyError(game_id)
+        return game
+
+    def __setitem__(self, game_id, game):
+        with self.lock:
+            self.games[game_id] = game
+            self.games.move_to_end(game_id)
+            while len(self.games) > self.capacity:
+                # the game being added hasn't been saved yet, so it stays even if everything else is pinned
+                old_id = next((old_id for old_id, old_game in self.games.items()
+                               if old_id != game_id and not self.is_pinned(old_id, old_game)), None)
+                if old_id is None:
+                    break
+                self.evict(old_id, self.games[old_id])
+                del self.games[old_id]
+                self.evictions += 1
+
+    def __delitem__(self, game_id):
+        with self.lock:
+            del self.games[game_id]
+
+    def __contains__(self, game_id):
+        return self.get(game_id) is not None
+
+    def __iter__(self):
+        return iter(list(self.games))
+
+    def __len__(self):
+        return len(self.games)
+
+    def get(self, game_id, default=None):
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is not None:
+                self.hits += 1
+                self.games.move_to_end(game_id)
+                return game
+            self.misses += 1
+            game = self.load(game_id)
+            if game is None:
+                return default
+            self[game_id] = game
+            return game
+
+    def is_pinned(self, game_id, game):
+        return self.pinned is not None and self.pinned(game_id, game)
+
+    def expire(self, game_id):
+        """
+        Hands a game to evict and drops it from memory, returning False if it wasn't in memory or is pinned
+        """
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is None or self.is_pinned(game_id, game):
+                return False
+            self.evict(game_id, game)
+            del self.games[game_id]
+            self.expirations += 1
+            return True
+
+    def peek(self, game_id):
+        """
+        Returns the game if it's in memory, without loading it or counting as a use
+        """
+        return self.games.get(game_id)
+
+    def stats(self):
+        return {"games": len(self.games), "capacity": self.capacity, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations}
+
 
 class GameManager(object):
     """
@@ -127,12 +528,42 @@ class GameManager(object):
     Takes moves in the format (gametoken, playertoken, start, destination)
     """
 
-    def __init__(self):
+    def __init__(self, db_path=ThudStorage.DEFAULT_DB_PATH, flush_changes=1, flush_ms=None,
+                 max_active_games=MAX_ACTIVE_GAMES, idle_timeout=IDLE_TIMEOUT):
+        """
+        Changed games are written to the database in batches - once flush_changes changes are waiting, or when a
+        change is made more than flush_ms after the oldest unsaved one.  Servers that call flush every flush_ms
+        bound how long a change can go unsaved.  The defaults save every change straight away.  At most
+        max_active_games games are kept in memory, and games unused for idle_timeout seconds are dropped by
+        clear_old_games.
+        """
         logging.debug('Game Manager started at {}.'.format(datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S')))
         self.name = 'Game Manager'
-        self.active_games = {}
+        self.storage = ThudStorage.GameStorage(db_path)
+        self.flush_changes = flush_changes
+        self.flush_ms = flush_ms
+        # games with changes that aren't in the database yet
+        self.dirty_games = set()
+        # changes waiting in total, and for each dirty game
+        self.pending_changes = 0
+        self.game_changes = {}
+        self.oldest_change = None
+        self.dirty_lock = threading.Lock()
+        self.active_games = GameCache(self.read_game, self.evict_game, max_active_games, self.game_in_use)
         self.free_players = {}
-        self.last_cleared = datetime.datetime.now()
+        # websocket: token of the game its player was matched into
+        self.socket_games = {}
+        # the order players joined the lobby in, and who has come and gone since the last presence update
+        self.presence = ThudPresence.Presence()
+        # game token: set of spectator websockets
+        self.watchers = {}
+        # lobby players waiting to be paired by rating
+        self.match_queue = ThudMatchmaking.MatchQueue()
+        self.idle_timeout = idle_timeout
+        # idle and turn clock deadlines, keyed ('idle', game token) and ('clock', game token)
+        self.timers = ThudTimers.TimingWheel()
+        # servers that search for bot moves in worker processes turn this off and call apply_bot_move themselves
+        self.inline_bots = True
 
     def __str__(self):
         return self.name
@@ -140,138 +571,371 @@ class GameManager(object):
     def __repr__(self):
         return self.name
 
-    def start_game(self, player_one, player_two):
+    def start_game(self, player_one, player_two, player_one_bot=None, player_two_bot=None, clock_ms=None):
         """
-        Generates a game token, and individual player tokens for authentication
+        Generates a game token, and individual player tokens for authentication.  Either player can be a bot, and
+        the game can be played on the clock, with clock_ms milliseconds for each player.
         """
         game = Game(player_one, player_two)
+        game.player_one.bot = player_one_bot
+        game.player_two.bot = player_two_bot
         game_token = self.generate_game_token(game)
         self.active_games[game_token] = game
+        if clock_ms:
+            self.start_clocks(game_token, clock_ms)
         logging.debug("{}: Game {} start with players {}, {}".format(
             datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'), game_token, game.player_one.token,
             game.player_two.token))
+        self.touch_game(game_token)
+        self.mark_dirty(game_token)
         return game_token, game.player_one.token, game.player_two.token
 
-    def generate_game_token(self, game, max_game=1):
-        # ToDo: query the database along with active_games for the highest game token played by these two players
-        token = game.player_one.name + game.player_two.name + str(max_game)
-        try:
-            existing_game = self.active_games[token]
-            max_game += 1
-            return self.generate_game_token(game, max_game)
-        except KeyError:
-            return token
+    def generate_game_token(self, game):
+        """
+        Numbers each game between the same players in turn - the counter is kept in the database, so numbers are
+        never reused.  Different pairs of names can run together into the same prefix, so the token is still checked.
+        """
+        prefix = game.player_one.name + game.player_two.name
+        while True:
+            token = prefix + str(self.storage.next_game_number(prefix))
+            if self.active_games.peek(token) is None and not self.storage.game_exists(token):
+                return token
 
     def end_game(self, game_token, player_one_token, player_two_token):
+        """
+        Ends a game for both players and drops it from memory.  A game that's still going is saved as finished with
+        no winner, so it can't be played on if it's loaded again.
+        """
         try:
             game = self.active_games[game_token]
             if game.player_one.token == player_one_token and game.player_two.token == player_two_token:
+                if game.status == 'Active':
+                    game.finish(None)
+                    self.timers.cancel(('clock', game_token))
+                if game_token in self.dirty_games or game.status != game.saved_status:
+                    self.save_game(game_token)
                 del self.active_games[game_token]
+                for watcher in self.watchers.pop(game_token, ()):
+                    watcher.stop_watching("Game ended.")
+                for player in (game.player_one, game.player_two):
+                    self.socket_games.pop(player.websocket, None)
+                self.close_bots(game)
                 return True
         except KeyError:
             return False
 
+    def mark_dirty(self, game_id):
+        """
+        Queues a changed game to be saved, flushing every queued game if enough changes are waiting or the oldest has
+        waited too long
+        """
+        with self.dirty_lock:
+            self.dirty_games.add(game_id)
+            self.pending_changes += 1
+            self.game_changes[game_id] = self.game_changes.get(game_id, 0) + 1
+            if self.oldest_change is None:
+                self.oldest_change = time.time()
+            due = self.pending_changes >= self.flush_changes or (
+                self.flush_ms is not None and (time.time() - self.oldest_change) * 1000 >= self.flush_ms)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Saves every queued game in one transaction.  Returns the number of games saved.
+        """
+        with self.dirty_lock:
+            game_ids, self.dirty_games = self.dirty_games, set()
+            game_changes, self.game_changes = self.game_changes, {}
+            self.pending_changes = 0
+            self.oldest_change = None
+        game_ids = [game_id for game_id in game_ids if self.active_games.peek(game_id) is not None]
+        if game_ids:
+            try:
+                self.save_games(game_ids)
+            except Exception:
+                logging.exception("Unable to save games {}, keeping them queued.".format(', '.join(game_ids)))
+                with self.dirty_lock:
+                    self.dirty_games.update(game_ids)
+                    for game_id in game_ids:
+                        self.game_changes[game_id] = self.game_changes.get(game_id, 0) + game_changes.get(game_id, 0)
+                        self.pending_changes += game_changes.get(game_id, 0)
+                raise
+        return len(game_ids)
+
+    def shutdown(self):
+        """
+        Saves any queued games and closes the database
+        """
+        self.flush()
+        self.storage.close()
+
     def save_game(self, game_id):
         '''
         Manages saving active games to a database.
-        Executed upon game creation in Thud.GameManager.start_game and every turn in Thud.GameManager.process_move.
-        Although serializing data into a single cell is generally frowned upon for SQL, I think it's okay
-        to do it in this case because there's never an instance where we'd only want to retrieve parts of
-        the board. It might be worth investigating other database systems.
+        Executed through mark_dirty upon game creation in Thud.GameManager.start_game and every turn in
+        Thud.GameManager.process_move.
+        The first save writes the players and a snapshot of the pieces, after that each save only appends the moves
+        played since the last one, with a fresh snapshot every SNAPSHOT_INTERVAL moves to keep loading quick.
         '''
-        # ToDo: 1) Figure out how to handle changing players in a game
-        # 2) Break up repetitive work into new methods (e.g. loading database). 3) Exception catching for: connecting to database, writing to database, closing database.
-        gamedbpath = Path('.\games.db')
-        player_one_name = self.active_games[game_id].player_one.name
-        player_one_token = self.active_games[game_id].player_one.token
-        player_one_race = self.active_games[game_id].player_one.race
-        player_two_name = self.active_games[game_id].player_two.name
-        player_two_token = self.active_games[game_id].player_two.token
-        player_two_race = self.active_games[game_id].player_two.race
-        last_accessed = self.active_games[game_id].last_accessed
-        move_history = json.dumps(self.active_games[game_id].move_history)
-        game_state = json.dumps(self.report_game_state(game_id), separators=(',', ': '))
-        pieces_raw = {}
-        for unit in self.active_games[game_id].board.units:
-            pieces_raw[unit.id] = {"type": unit.type, "move_history": unit.moves, "status": unit.status, 'x': unit.x, 'y': unit.y}
-        pieces = json.dumps(pieces_raw, separators=(',', ': '))
-
-        # Create the sqlite database if it doesn't exist and connect to it. There also might be a cleaner way to do this part.
-        if not gamedbpath.is_file():
-            game_db = sqlite3.connect('.\games.db')
-            c_game_db = game_db.cursor()
-            c_game_db.execute("CREATE TABLE Games (gametoken text, player_one_name text, player_one_token text, player_one_race text, "
-                                "player_two_name text, player_two_token text, player_two_race text, last_accessed text, move_history text, pieces text, board text)")
-            #c_game_db.execute("CREATE TABLE Pieces (gametoken text, )")
-        else:
-            game_db = sqlite3.connect('.\games.db')
-            c_game_db = game_db.cursor()
+        with self.dirty_lock:
+            self.dirty_games.discard(game_id)
+            self.pending_changes -= self.game_changes.pop(game_id, 0)
+            if not self.dirty_games:
+                self.oldest_change = None
+        return self.save_games([game_id])
+
+    def save_games(self, game_ids):
+        """
+        Saves the changes to several games in a single transaction
+        """
+        # ToDo: Figure out how to handle changing players in a game
+        saves, saved_totals = [], []
+        for game_id in game_ids:
+            game = self.active_games.peek(game_id)
+            saved_moves = game.saved_moves
+            total_moves = len(game.move_history)
+            header = None
+            # the clocks change with every move, so timed games rewrite their header each save
+            if saved_moves is None or game.status != game.saved_status or game.player_one.clock_ms is not None:
+                header = (game_id, game.player_one.name, game.player_one.token, game.player_one.race,
+                          game.player_two.name, game.player_two.token, game.player_two.race, str(game.last_accessed),
+                          game.status, game.winner, self.game_options(game))
+            if saved_moves is None or saved_moves > total_moves:
+                saves.append((game_id, header, self.unsaved_moves(game, 0), self.snapshot(game), True))
+            else:
+                snapshot = None
+                if total_moves // SNAPSHOT_INTERVAL > saved_moves // SNAPSHOT_INTERVAL:
+                    snapshot = self.snapshot(game)
+                saves.append((game_id, header, self.unsaved_moves(game, saved_moves), snapshot, False))
+            saved_totals.append((game, total_moves, game.status))
+        self.storage.save_games(saves)
+        for game, total_moves, status in saved_totals:
+            game.saved_moves = total_moves
+            game.saved_status = status
+        return True
+
+    @staticmethod
+    def game_options(game):
+        """
+        Returns the options column for a game - JSON of the settings of its bots, and for games on the clock the
+        milliseconds each player had left when the side to move's turn started.  None if there's nothing to save.
+        """
+        options = {}
+        bots = [player.bot.settings if player.bot is not None else None
+                for player in (game.player_one, game.player_two)]
+        if any(bots):
+            options["bots"] = bots
+        if game.player_one.clock_ms is not None:
+            options["clocks"] = [game.player_one.clock_ms, game.player_two.clock_ms]
+            options["turn_started"] = game.turn_started
+        return json.dumps(options) if options else None
 
-        c_game_db.execute("SELECT ROWID FROM Games WHERE gametoken = (?) ",(game_id,))
-        rowid = c_game_db.fetchone()
+    @staticmethod
+    def unsaved_moves(game, saved_moves):
+        played_at = str(game.last_accessed)
+        return [(number, start, destination, captures, played_at) for number, ((start, destination), captures) in
+                enumerate(zip(game.move_history[saved_moves:], game.capture_history[saved_moves:]), saved_moves)]
 
-        if rowid:
-            c_game_db.execute("UPDATE Games SET player_one_name = (?), player_one_token = (?), player_one_race = (?), player_two_name = (?), "
-                                "player_two_token = (?), player_two_race = (?), last_accessed = (?), move_history = (?), pieces = (?), board = (?) WHERE ROWID = (?)",
-                                (player_one_name,player_one_token,player_one_race,player_two_name,player_two_token,player_two_race,last_accessed,move_history,pieces,game_state,rowid[0]))
-        else:
-            c_game_db.execute("INSERT INTO Games VALUES (?,?,?,?,?,?,?,?,?,?,?)",(game_id,player_one_name,player_one_token,player_one_race,player_two_name,player_two_token,player_two_race,last_accessed,move_history,pieces,game_state))
+    @staticmethod
+    def snapshot(game):
+        """
+        Returns (move number, pieces, board) for the game as it stands.  The board is stored in the compact
+        Board.to_bytes format, and the pieces column keeps what that leaves out - each piece's move history and the
+        pieces that have been captured.
+        """
+        return len(game.move_history), json.dumps(game.board.report_units()), game.board.to_bytes()
 
-        game_db.commit()
-        game_db.close()
-        return True
-    
     def load_game(self, game_id):
         '''
         Retrieves saved game data from the database, rebuilds the game, and places it in the active game list of the game 
-        manager that called it.
+        manager that called it.  Returns False if the game was never saved.  Games that aren't in memory are also
+        loaded whenever they're looked up in active_games.
         '''
-        # ToDo: In addition to stuff from save_game: Exception catching for: can't find requested game token, closing
-        # database, converting game board to engine readable.
-        try:
-            game_db = sqlite3.connect('.\games.db')
-        except:
-            logging.debug("Unable to load the database.")
-        c_game_db = game_db.cursor()
+        game = self.read_game(game_id)
+        if game is None:
+            return False
+        self.active_games[game_id] = game
+        return True
 
-        c_game_db.execute("SELECT * FROM Games WHERE gametoken = (?) ",(game_id,))
-        game_data = c_game_db.fetchone()
-        
-        game_placeholder = Game(game_data[1],game_data[4])
-        game_placeholder.player_one.name = game_data[1]
-        game_placeholder.player_one.token = game_data[2]
-        game_placeholder.player_one.race = game_data[3]
-        game_placeholder.player_two.name = game_data[4]
-        game_placeholder.player_two.token = game_data[5]
-        game_placeholder.player_two.race = game_data[6]
-        game_placeholder.last_accessed = game_data[7]
-        game_placeholder.move_history = json.loads(game_data[8])
-
-        self.read_game_state(game_placeholder,game_data)
-
-        self.active_games[game_id] = game_placeholder
-        game_db.close()
+    def read_game(self, game_id):
+        """
+        Rebuilds a saved game - the pieces come from the latest snapshot, and any moves played since are replayed.
+        Returns None if the game was never saved.
+        """
+        game_data = self.storage.load_game(game_id)
+        if game_data is None:
+            logging.debug("Game {} not found in the database.".format(game_id))
+            return None
+        header, snapshot, moves = game_data
+
+        game_placeholder = Game(header[1], header[4])
+        game_placeholder.player_one.name = header[1]
+        game_placeholder.player_one.token = header[2]
+        game_placeholder.player_one.race = header[3]
+        game_placeholder.player_two.name = header[4]
+        game_placeholder.player_two.token = header[5]
+        game_placeholder.player_two.race = header[6]
+        game_placeholder.last_accessed = moves[-1][3] if moves else header[7]
+        game_placeholder.status = game_placeholder.saved_status = header[8]
+        game_placeholder.winner = header[9]
+        options = json.loads(header[10]) if header[10] else {}
+        for player, settings in zip((game_placeholder.player_one, game_placeholder.player_two),
+                                    options.get("bots", ())):
+            if settings is not None:
+                player.bot = self.read_start_player(settings)[1]
+        if "clocks" in options:
+            game_placeholder.player_one.clock_ms, game_placeholder.player_two.clock_ms = options["clocks"]
+            game_placeholder.turn_started = options["turn_started"]
+
+        snapshot_moves = 0
+        if snapshot is not None:
+            snapshot_moves, pieces, board = snapshot
+            self.read_game_state(game_placeholder, pieces, board)
+        for start, destination, captures, played_at in moves[:snapshot_moves]:
+            game_placeholder.move_history.append((start, destination))
+            game_placeholder.capture_history.append(captures)
+        for start, destination, captures, played_at in moves[snapshot_moves:]:
+            game_placeholder.make_move((start, destination, captures))
+        game_placeholder.saved_moves = len(moves)
+        # carries on from the version the game had before it was saved
+        game_placeholder.version = len(moves)
+        self.touch_game(game_id)
+        if game_placeholder.status == 'Active' and game_placeholder.turn_started is not None:
+            # a clock that ran out while the game was out of memory falls on the next tick
+            self.timers.schedule(('clock', game_id), game_placeholder.turn_started +
+                                 game_placeholder.side_to_move().clock_ms / 1000.0)
+        return game_placeholder
+
+    def evict_game(self, game_id, game):
+        """
+        Called before a game is dropped from memory, saving it first if it has unsaved changes
+        """
+        if game_id in self.dirty_games:
+            self.save_game(game_id)
+        self.close_bots(game)
+
+    def game_in_use(self, game_id, game):
+        """
+        Whether a game has players connected by websocket or spectators watching, so it mustn't be dropped from memory
+        """
+        return (game.player_one.websocket is not None or game.player_two.websocket is not None or
+                game_id in self.watchers)
+
+    def touch_game(self, game_token):
+        """
+        Puts off dropping a game from memory until idle_timeout seconds from now
+        """
+        self.timers.schedule(('idle', game_token), time.time() + self.idle_timeout)
+
+    def start_clocks(self, game_token, clock_ms):
+        """
+        Gives each player clock_ms milliseconds for all their moves, starting the clock of the side to move
+        """
+        game = self.active_games[game_token]
+        game.player_one.clock_ms = game.player_two.clock_ms = clock_ms
+        game.turn_started = time.time()
+        self.timers.schedule(('clock', game_token), game.turn_started + clock_ms / 1000.0)
+
+    def record_turn(self, game_token, game):
+        """
+        Called after each move - stops the clock of the player who moved and starts their opponent's
+        """
+        self.touch_game(game_token)
+        player = game.side_to_move()
+        if player.clock_ms is None:
+            return
+        now = time.time()
+        mover = game.player_two if player is game.player_one else game.player_one
+        mover.clock_ms -= int((now - game.turn_started) * 1000)
+        game.turn_started = now
+        self.timers.schedule(('clock', game_token), now + player.clock_ms / 1000.0)
+
+    def flag_fall(self, game_token, now=None):
+        """
+        Ends the game if the side to move has run out of time, their opponent winning.  Returns True if it did.
+        """
+        game = self.active_games.peek(game_token)
+        if game is None or game.status != 'Active' or game.side_to_move().clock_ms is None:
+            return False
+        now = time.time() if now is None else now
+        player = game.side_to_move()
+        if player.clock_ms - (now - game.turn_started) * 1000 > 0:
+            return False
+        logging.debug("{}: {} ran out of time in game {}.".format(
+            datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'), player.name, game_token))
+        player.clock_ms = 0
+        self.finish_game(game_token, game, 'Troll' if player.race == 'Dwarf' else 'Dwarf')
         return True
 
-    def read_game_state(self, game_placeholder, game_data):
-        game_state = json.loads(game_data[10])
-        unit = json.loads(game_data[9])
-        game_placeholder.board.units = []
-        for x, column in enumerate(game_placeholder.board):
-            for y, square in enumerate(column):
-                if game_state[str(x)][y]['type'] == 'null':
-                    game_placeholder.board.squares[x][y] = 0
-                elif game_state[str(x)][y]['type'] == 'open':
-                    game_placeholder.board.squares[x][y] = str(x) + ',' + str(y)
-                else:
-                    if game_state[str(x)][y]['type'] == 'Dwarf':
-                        piece = Dwarf(x, y, game_state[str(x)][y]['id'])
-                    elif game_state[str(x)][y]['type'] == 'Troll':
-                        piece = Troll(x, y, game_state[str(x)][y]['id'])
-                    piece.moves = unit[str(game_state[str(x)][y]['id'])]['move_history']
-                    piece.status = unit[str(game_state[str(x)][y]['id'])]['status']
-                    game_placeholder.board.squares[x][y] = piece
-                    game_placeholder.board.units.append(game_placeholder.board.squares[x][y])
+    def finish_game(self, game_token, game, winner):
+        """
+        Ends a game won by winner - stops its clock, queues it to be saved, updates both players' ratings and shuts
+        down its bots
+        """
+        game.finish(winner)
+        self.timers.cancel(('clock', game_token))
+        self.mark_dirty(game_token)
+        self.rate_game(game)
+        self.close_bots(game)
+
+    @staticmethod
+    def close_bots(game):
+        """
+        Shuts down any worker processes the game's bots started, they're started again if the bots move later
+        """
+        for player in (game.player_one, game.player_two):
+            if player.bot is not None and hasattr(player.bot, 'close'):
+                player.bot.close()
+
+    def player_rating(self, name):
+        rating, games = self.storage.load_ratings([name]).get(name, (ThudMatchmaking.DEFAULT_RATING, 0))
+        return rating
+
+    def rate_game(self, game):
+        """
+        Updates the ratings of both players of a finished game
+        """
+        if game.winner is None or game.player_one.name == game.player_two.name:
+            return
+        if game.player_one.race == game.winner:
+            winner, loser = game.player_one.name, game.player_two.name
+        else:
+            winner, loser = game.player_two.name, game.player_one.name
+        ratings = self.storage.load_ratings([winner, loser])
+        winner_rating, winner_games = ratings.get(winner, (ThudMatchmaking.DEFAULT_RATING, 0))
+        loser_rating, loser_games = ratings.get(loser, (ThudMatchmaking.DEFAULT_RATING, 0))
+        winner_rating, loser_rating = ThudMatchmaking.rate_game(winner_rating, loser_rating)
+        self.storage.save_ratings([(winner, winner_rating, winner_games + 1), (loser, loser_rating, loser_games + 1)])
+
+    def report_status(self, game_id):
+        """
+        Returns whether the game is still going, who won, and the milliseconds left on each player's clock
+        """
+        game = self.active_games[game_id]
+        self.flag_fall(game_id)
+        clocks = {}
+        for player in (game.player_one, game.player_two):
+            if player.clock_ms is not None:
+                clocks[player.race] = player.clock_ms
+                if player is game.side_to_move() and game.status == 'Active':
+                    clocks[player.race] = max(int(player.clock_ms - (time.time() - game.turn_started) * 1000), 0)
+        return {"status": game.status, "winner": game.winner, "to_move": game.side_to_move().race, "clocks": clocks}
+
+    def read_game_state(self, game_placeholder, pieces, board):
+        if isinstance(board, bytes):
+            game_placeholder.board = Board.from_bytes(board)
+            if pieces:
+                game_placeholder.board.load_units(json.loads(pieces))
+        else:
+            # snapshots saved before the compact format are report_game_state JSON with the pieces alongside
+            game_placeholder.board.load_game_state(json.loads(board), json.loads(pieces))
+
+    def report_compact_state(self, game_id):
+        """
+        Returns the board in the compact Board.to_bytes format
+        """
+        return self.active_games[game_id].board.to_bytes()
 
     def report_game_state(self, game_id):
         """
@@ -290,6 +954,16 @@ class GameManager(object):
             board_state[str(x)] = row_state
         return board_state
 
+    def report_game_json(self, game_id):
+        """
+        Returns (version, report_game_state JSON) for a game.  The JSON is built once for each version of the game, so
+        polling a game that hasn't changed doesn't encode the board again.
+        """
+        game = self.active_games[game_id]
+        if game.state_cache is None:
+            game.state_cache = json.dumps(self.report_game_state(game_id))
+        return game.version, game.state_cache
+
     def process_save(self, save_data):
         try:
             game_id = save_data['game']
@@ -322,14 +996,135 @@ class GameManager(object):
                 logging.debug("{}: Game {} found, attempting move from {} to {}.".format(
                     game_token, datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'), start, destination))
                 game = self.active_games[game_token]
-                return game.execute_move(player_token, start, destination, test)
+                if self.flag_fall(game_token):
+                    return False
+                result = game.execute_move(player_token, start, destination, test)
+                if result and not test:
+                    self.record_turn(game_token, game)
+                    self.mark_dirty(game_token)
+                    self.send_move(game_token)
+                    if self.inline_bots:
+                        self.play_bot_turn(game_token)
+                return result
             else:
                 logging.debug("{}: Game {} not found.".format(game_token,
                                                               datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S')))
                 return False
-        except KeyError as e:
+        except (KeyError, TypeError, ValueError) as e:
             return "Bad JSON data {} as part of {}.".format(e, move_data)
 
+    def process_resign(self, resign_data):
+        """
+        Resigning a game, the opponent winning:
+            {"game": "correct_game_token",
+            "player": "correct_player_token"}
+        Returns the finished game's status as for process_status, which is also sent to the players connected by
+        websocket and the game's watchers, or False for an unknown game, a wrong player or a game that's already over
+        """
+        try:
+            game_token = resign_data["game"]
+            player_token = resign_data["player"]
+            if game_token not in self.active_games or self.flag_fall(game_token):
+                return False
+            game = self.active_games[game_token]
+            if game.status != 'Active' or player_token not in (game.player_one.token, game.player_two.token):
+                return False
+            winner = game.player_two if player_token == game.player_one.token else game.player_one
+            logging.debug("{}: Player {} resigned game {}.".format(
+                datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'), player_token, game_token))
+            self.finish_game(game_token, game, winner.race)
+            status = self.report_status(game_token)
+            message = ["resign", status]
+            for player in (game.player_one, game.player_two):
+                if player.websocket is not None:
+                    player.websocket.send_message(message)
+            for watcher in list(self.watchers.get(game_token, ())):
+                watcher.send_update(json.dumps(message))
+            return status
+        except (KeyError, TypeError) as e:
+            return "Bad JSON data {} as part of {}.".format(e, resign_data)
+
+    def process_status(self, status_data):
+        """
+        Checking on a game:
+            {"game": "correct_game_token"}
+        Returns {"status": "Active" or "Finished", "winner": race or None, "to_move": race,
+        "clocks": {race: milliseconds left, }} or False for an unknown game
+        """
+        try:
+            game_token = status_data["game"]
+            if game_token in self.active_games:
+                return self.report_status(game_token)
+            return False
+        except (KeyError, TypeError) as e:
+            return "Bad JSON data {} as part of {}.".format(e, status_data)
+
+    def find_games(self, player=None, status=None, before=None, limit=20):
+        """
+        Lists saved games, most recently played first, after saving any queued changes so the list is up to date.
+        Returns {"games": [game, ], "next": cursor}, where cursor is passed back as before to get the next page,
+        and is None on the last page.
+        """
+        self.flush()
+        rows = self.storage.find_games(player, status, before, limit)
+        games = [{"game": game_token, "player_one": player_one, "player_one_race": player_one_race,
+                  "player_two": player_two, "player_two_race": player_two_race, "last_accessed": last_accessed,
+                  "status": game_status, "winner": winner}
+                 for (game_token, player_one, player_one_race, player_two, player_two_race, last_accessed,
+                      game_status, winner) in rows]
+        cursor = None
+        if len(rows) == max(1, min(int(limit), ThudStorage.MAX_PAGE)):
+            cursor = [rows[-1][5], rows[-1][0]]
+        return {"games": games, "next": cursor}
+
+    def player_active_games(self, player, before=None, limit=20):
+        return self.find_games(player, 'Active', before, limit)
+
+    def recent_finished_games(self, before=None, limit=20):
+        return self.find_games(None, 'Finished', before, limit)
+
+    def player_history(self, player, before=None, limit=20):
+        return self.find_games(player, None, before, limit)
+
+    def process_games(self, games_data, status=None):
+        """
+        Listing games:
+            {"player": "Will",
+            "before": cursor,
+            "limit": 20}
+        Every key is optional.  Returns {"games": [{"game": "game_token", "player_one": "Will", ...}, ],
+        "next": cursor for the next page or None}
+        """
+        try:
+            before = games_data.get("before")
+            return self.find_games(games_data.get("player"), status, tuple(before) if before else None,
+                                   games_data.get("limit", 20))
+        except (AttributeError, TypeError, ValueError) as e:
+            return "Bad JSON data {} as part of {}.".format(e, games_data)
+
+    def process_moves(self, moves_data):
+        """
+        Listing legal moves:
+            {"game": "correct_game_token",
+            "player": "correct_player_token",
+            "start": [x, y]}
+        The player and start keys are optional, start limits the list to the moves of one piece.
+        Returns [{"start": [x, y], "destination": [x, y], "captures": [[x, y], ]}, ] or False for an unknown game
+        """
+        try:
+            game_token = moves_data["game"]
+            if game_token in self.active_games:
+                game = self.active_games[game_token]
+                moves = game.legal_moves(moves_data.get("player"), moves_data.get("start"))
+                return [{"start": start, "destination": destination, "captures": captures}
+                        for start, destination, captures in moves]
+            else:
+                logging.debug("{}: Game {} not found.".format(game_token,
+                                                              datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S')))
+                return False
+        except (KeyError, TypeError, ValueError) as e:
+            return "Bad JSON data {} as part of {}.".format(e, moves_data)
+
     def assign_team(self):
         race = random.choice('01')
         if race == "0":
@@ -339,22 +1134,99 @@ class GameManager(object):
 
 
     def process_start(self, start_data):
+        """
+        Either player can be a computer opponent, by passing the bot details instead of a name:
+            {"player_one": "Will",
+            "player_two": {"bot": "alphabeta", "ms": 500}}
+        To play on the clock, add "clock_ms" - the milliseconds each player has for all their moves.
+        """
         try:
-            player_one = start_data["player_one"]
-            player_two = start_data["player_two"]
-            game, player_one_token, player_two_token = self.start_game(player_one, player_two)
-            return {"game": game, "board": self.report_game_state(game),
-                    "player_one": player_one_token, "player_two": player_two_token}
-        except KeyError:
+            # everything is checked before the game is created, so bad start data never leaves a game behind
+            player_one, player_one_bot = self.read_start_player(start_data["player_one"])
+            player_two, player_two_bot = self.read_start_player(start_data["player_two"])
+            clock_ms = int(start_data.get("clock_ms") or 0)
+            if clock_ms < 0:
+                raise ValueError(clock_ms)
+        except (AttributeError, KeyError, TypeError, ValueError):
             return "Bad JSON data."
+        game, player_one_token, player_two_token = self.start_game(player_one, player_two, player_one_bot,
+                                                                   player_two_bot, clock_ms)
+        if self.inline_bots:
+            self.play_bot_turn(game)
+        return {"game": game, "board": self.report_game_state(game),
+                "player_one": player_one_token, "player_two": player_two_token}
+
+    @staticmethod
+    def read_start_player(player_data):
+        """
+        Returns the name and bot (or None) for a player in start data
+        """
+        if isinstance(player_data, dict):
+            try:
+                from Thud import ThudAI
+            except ImportError:
+                import ThudAI
+            bot = ThudAI.create_bot(player_data)
+            name = player_data.get("name", bot.name)
+        else:
+            name, bot = player_data, None
+        if not isinstance(name, str):
+            raise TypeError(name)
+        return name, bot
+
+    def bot_to_move(self, game_token):
+        """
+        Returns the player whose turn it is if they're a computer opponent, otherwise None
+        """
+        game = self.active_games.get(game_token)
+        if game is None or game.side_to_move().bot is None:
+            return None
+        return game.side_to_move()
+
+    def play_bot_turn(self, game_token):
+        """
+        Lets a computer opponent move if it's their turn.  Returns the bot's move result, or None if it isn't a
+        bot's turn.
+        """
+        player = self.bot_to_move(game_token)
+        if player is None:
+            return None
+        return self.apply_bot_move(game_token, player, player.bot.choose_move(self.active_games[game_token]))
+
+    def apply_bot_move(self, game_token, player, move):
+        """
+        Plays a move chosen for a bot, which may have been searched for in another process.  The move goes through
+        execute_move, so it's rejected if the game has moved on in the meantime.
+        """
+        game = self.active_games.get(game_token)
+        if game is None:
+            return False
+        if move is None:
+            logging.debug("{}: Bot {} has no moves in game {}.".format(
+                datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'), player.bot, game_token))
+            return None
+        start, destination, captures = move
+        logging.debug("{}: Bot {} moving from {} to {} in game {}.".format(
+            datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'), player.bot, start, destination, game_token))
+        if self.flag_fall(game_token):
+            return False
+        result = game.execute_move(player.token, start, destination)
+        if result:
+            self.record_turn(game_token, game)
+            self.mark_dirty(game_token)
+            self.send_move(game_token)
+        return result
 
     def assign_sockets(self, game_token, player_one, player_two):
         player_one_socket = self.free_players[player_one]
         game = self.active_games[game_token]
         game.player_one.set_player_socket(self.free_players[player_one])
         game.player_two.set_player_socket(self.free_players[player_two])
+        self.socket_games[game.player_one.websocket] = self.socket_games[game.player_two.websocket] = game_token
         del self.free_players[player_one]
         del self.free_players[player_two]
+        self.presence.leave(player_one)
+        self.presence.leave(player_two)
         return True
 
     def update_opposite_player(self, game_token, player, message):
@@ -364,22 +1236,103 @@ class GameManager(object):
         elif player == game.player_two.name:
             game.player_one.websocket.send_message(message)
 
+    def report_move(self, game_token):
+        """
+        Returns the last move of a game as an update for the players' websockets.  seq is the number of moves played,
+        so a client that sees a gap in it has missed an update and should ask for a sync.
+        """
+        game = self.active_games[game_token]
+        piece, captured = game.last_move
+        return {"game": game_token, "seq": len(game.move_history), "piece": piece.id, "from": list(piece.moves[-2]),
+                "to": [piece.x, piece.y], "captured": [target.id for target in captured]}
+
+    def send_move(self, game_token):
+        """
+        Sends the move just played to each player connected by websocket, and to everyone watching the game.  The
+        update is encoded once for all the watchers however many there are.
+        """
+        game = self.active_games[game_token]
+        watchers = self.watchers.get(game_token)
+        if game.player_one.websocket is None and game.player_two.websocket is None and not watchers:
+            return
+        message = ["delta", self.report_move(game_token)]
+        for player in (game.player_one, game.player_two):
+            if player.websocket is not None:
+                player.websocket.send_message(message)
+        if watchers:
+            encoded = json.dumps(message)
+            for watcher in list(watchers):
+                watcher.send_update(encoded)
+
+    def add_watcher(self, game_token, websocket):
+        """
+        Subscribes a spectator to a game's moves.  Returns the encoded sync message to start them off, or False for an
+        unknown game.
+        """
+        if game_token not in self.active_games:
+            return False
+        self.watchers.setdefault(game_token, set()).add(websocket)
+        return self.watch_snapshot(game_token)
+
+    def remove_watcher(self, game_token, websocket):
+        watchers = self.watchers.get(game_token)
+        if watchers is not None:
+            watchers.discard(websocket)
+            if not watchers:
+                del self.watchers[game_token]
+
+    def watch_snapshot(self, game_token):
+        """
+        Returns the whole board as an encoded sync message, built around the board JSON cached for the game's version
+        so watchers catching up share the same encoding
+        """
+        version, board = self.report_game_json(game_token)
+        return '["sync", {{"game": {}, "seq": {}, "board": {}}}]'.format(
+            json.dumps(game_token), len(self.active_games[game_token].move_history), board)
+
+    def process_sync(self, sync_data):
+        """
+        Fetching the whole board after missing a websocket move update:
+            {"game": "correct_game_token"}
+        Returns {"game": "game_token", "seq": moves played, "board": {"row_num": [row_data]}} or False for an unknown
+        game
+        """
+        try:
+            game_token = sync_data["game"]
+            if game_token in self.active_games:
+                return {"game": game_token, "seq": len(self.active_games[game_token].move_history),
+                        "board": self.report_game_state(game_token)}
+            return False
+        except (KeyError, TypeError) as e:
+            return "Bad JSON data {} as part of {}.".format(e, sync_data)
+
     def process_match_start(self, match_player, requesting_player):
         if match_player in self.free_players and requesting_player in self.free_players:
-            game_token, player_one_token, player_two_token = self.start_game(requesting_player, match_player)
-            self.assign_sockets(game_token, requesting_player, match_player)
-            player_one_race, player_two_race = self.assign_team()
+            self.match_queue.leave(match_player)
+            self.match_queue.leave(requesting_player)
+            # player one plays the dwarves, so the team decides who takes the first seat
+            if self.assign_team()[0] == "Dwarf":
+                player_one, player_two = requesting_player, match_player
+            else:
+                player_one, player_two = match_player, requesting_player
+            game_token = self.start_game(player_one, player_two)[0]
+            self.assign_sockets(game_token, player_one, player_two)
+            game = self.active_games[game_token]
+            requesting, matched = ((game.player_one, game.player_two) if player_one == requesting_player
+                                   else (game.player_two, game.player_one))
             match_player_data = {"start":
                                     {"game": game_token,
                                      "board": self.report_game_state(game_token),
-                                     "player": player_one_token,
-                                     "race": player_one_race}
+                                     "seq": 0,
+                                     "player": matched.token,
+                                     "race": matched.race}
                                  }
             self.update_opposite_player(game_token, requesting_player, match_player_data)
             return {"game": game_token,
                     "board": self.report_game_state(game_token),
-                    "player": player_two_token,
-                    "race": player_two_race}
+                    "seq": 0,
+                    "player": requesting.token,
+                    "race": requesting.race}
 
     def process_socket_message(self, message, player_id):
         action = message[0]
@@ -392,12 +1345,69 @@ class GameManager(object):
             return ["move", self.process_move(message)]
         elif action == "test":
             return ["test", self.process_move(message, test=True)]
+        elif action == "moves":
+            return ["moves", self.process_moves(message)]
+        elif action == "sync":
+            return ["sync", self.process_sync(message)]
+        elif action == "queue":
+            return self.process_queue(message, player_id)
+        elif action == "lobby":
+            return self.process_lobby(message)
+        elif action == "resign":
+            return ["resign", self.process_resign(message)]
         elif action == "end":
             return ["end", "This functionality isn't currently available."]
             # return self.end_game(message[entry])
         else:
             return "No valid data found."
 
+    def process_lobby(self, lobby_data):
+        """
+        Fetching the next page of lobby players:
+            {"after": cursor}
+        Returns ["list", [player names], cursor for the page after]
+        """
+        try:
+            after = lobby_data.get("after") if isinstance(lobby_data, dict) else None
+            names, cursor = self.presence.page(int(after or 0))
+        except (TypeError, ValueError) as e:
+            return "Bad JSON data {} as part of {}.".format(e, lobby_data)
+        return ["list", names, cursor]
+
+    def process_queue(self, queue_data, player_id):
+        """
+        Joining the matchmaking queue from the lobby:
+            {}
+        or leaving it:
+            {"leave": true}
+        Returns ["start", start data] if an opponent was found straight away, otherwise
+        ["queue", {"queued": True or False, "rating": rating}].  Players left waiting are sent ["start", start data]
+        when match_queued_players pairs them.
+        """
+        if player_id not in self.free_players:
+            return ["queue", False]
+        rating = self.player_rating(player_id)
+        if isinstance(queue_data, dict) and queue_data.get("leave"):
+            self.match_queue.leave(player_id)
+            return ["queue", {"queued": False, "rating": rating}]
+        opponent = self.match_queue.join(player_id, rating)
+        if opponent is not None:
+            return ["start", self.process_match_start(opponent, player_id)]
+        return ["queue", {"queued": True, "rating": rating}]
+
+    def match_queued_players(self, now=None):
+        """
+        Starts games for queued players whose rating windows have widened enough to find an opponent.  Called
+        regularly by the server.  Returns the game tokens started.
+        """
+        games = []
+        for player, opponent in self.match_queue.match_waiting(now):
+            websocket = self.free_players[player]
+            start = self.process_match_start(opponent, player)
+            websocket.send_message(["start", start])
+            games.append(start["game"])
+        return games
+
     def report_free_players(self):
         player_list = []
         for player in self.free_players:
@@ -407,30 +1417,73 @@ class GameManager(object):
     def add_match_player(self, player_name, websocket):
         if player_name not in self.free_players:
             self.free_players[player_name] = websocket
+            self.presence.join(player_name)
             return True
         else:
             return False
 
     def add_player_to_server(self, player_name, websocket):
-        player_list = self.report_free_players()
+        """
+        Adds a player to the lobby.  Returns the first page of the players already there, the whole lobby unless it
+        has more than ThudPresence.LOBBY_PAGE players, with the cursor for the next page, or False if the name is taken.
+        :return tuple: ([names], cursor)
+        """
+        page = self.presence.page()
         if self.add_match_player(player_name, websocket):
-            return player_list
+            return page
         else:
             return False
 
-    def remove_player_from_server(self, player_name):
-        if player_name in self.free_players:
+    def remove_player_from_server(self, player_name, websocket=None):
+        """
+        Takes a player out of the lobby and the match queue.  If their websocket is given it's also detached from the
+        game they were matched into, so the game can be dropped from memory once nobody is connected to it.
+        """
+        self.match_queue.leave(player_name)
+        game_token = self.socket_games.pop(websocket, None) if websocket is not None else None
+        game = self.active_games.peek(game_token) if game_token is not None else None
+        if game is not None:
+            for player in (game.player_one, game.player_two):
+                if player.websocket is websocket:
+                    player.websocket = None
+        if player_name in self.free_players and websocket in (None, self.free_players[player_name]):
             del self.free_players[player_name]
+            self.presence.leave(player_name)
             return True
 
-    def clear_old_games(self):
-        if datetime.datetime.now() - self.last_cleared > datetime.timedelta(hours=2):
-            for game in self.active_games:
-                if datetime.datetime.now() - game.last_accessed > datetime.timedelta(hours=2):
-                    del self.active_games[game]
-            return True
-        else:
-            return False
+    def send_presence(self):
+        """
+        Sends everyone in the lobby the players who joined or left since the last call, encoded once for all of them.
+        Called every few hundred milliseconds by the server, so a busy lobby sends one batch rather than a message
+        per change.  Returns the batch, or None if nobody came or went.
+        """
+        changes = self.presence.take_changes()
+        if changes is None:
+            return None
+        encoded = json.dumps(["presence", changes])
+        for websocket in list(self.free_players.values()):
+            websocket.send_update(encoded)
+        return changes
+
+    def clear_old_games(self, now=None):
+        """
+        Runs the deadlines that have passed - games unused for idle_timeout seconds are saved and dropped from memory,
+        and games whose side to move has run out of time are ended.  Called every tick by the server.
+        Returns the (kind, game token) of each deadline that fell due.
+        """
+        expired = self.timers.advance(now)
+        for kind, game_token in expired:
+            if kind == 'idle':
+                game = self.active_games.peek(game_token)
+                if game is not None and self.game_in_use(game_token, game):
+                    # checked again after another idle_timeout
+                    self.touch_game(game_token)
+                    continue
+                self.timers.cancel(('clock', game_token))
+                self.active_games.expire(game_token)
+            elif kind == 'clock':
+                self.flag_fall(game_token, now)
+        return expired
 
 
 class Game(object):
@@ -445,6 +1498,20 @@ class Game(object):
         self.player_two = Player(player_two, self.generate_player_token(), "T")
         self.last_accessed = datetime.datetime.now()
         self.move_history = []
+        # the squares captured by each move, kept alongside move_history for the saved move log
+        self.capture_history = []
+        # how many moves of this game are in the database, None until the game is first saved
+        self.saved_moves = None
+        self.status = 'Active'
+        self.saved_status = None
+        self.winner = None
+        # when the side to move's clock started, for games played on the clock
+        self.turn_started = None
+        # (piece, captured pieces) of the last move played through execute_move, for the websocket move updates
+        self.last_move = None
+        # counts the moves played through execute_move, state_cache is the board JSON for the current version
+        self.version = 0
+        self.state_cache = None
 
     def __str__(self):
         return self.name
@@ -504,41 +1571,24 @@ class Game(object):
         :param destination:
         :return bool:
         """
-        logging.debug("{}: Checking clear path from {} at {},{} to {}".format(
-            datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'), piece, piece.x, piece.y, str(destination)))
         if isinstance(destination, Troll):
             destination_x, destination_y = destination.x, destination.y
         else:
             destination_x, destination_y = destination
+        logging.debug("Checking clear path from {} at {},{} to {},{}".format(
+            piece, piece.x, piece.y, destination_x, destination_y))
 
-        # don't look at the starting space because we know there's a piece there
-        if piece.x - destination_x > 0:
-            x_travel = list(range(piece.x - 1, destination_x, -1))
-        else:
-            x_travel = list(range(piece.x + 1, destination_x))
-        if piece.y - destination_y > 0:
-            y_travel = list(range(piece.y - 1, destination_y, -1))
-        else:
-            y_travel = list(range(piece.y + 1, destination_y))
-
-        logging.debug("Move ranges: x - {}, y - {}".format(','.join(map(str, x_travel)), ','.join(map(str, y_travel))))
-
-        if not x_travel:
-            logging.debug("Horizontal move calculated along x == {}".format(piece.x))
-            x_travel = [piece.x for x in range(0, len(y_travel))]
-        if not y_travel:
-            logging.debug("Vertical move calculated along y == {}".format(piece.y))
-            y_travel = [piece.y for x in range(0, len(x_travel))]
-        # move is only 1 square, is already validated by earlier functions
-        if not x_travel and not y_travel:
-            return True
-
-        travel_squares = list(zip(x_travel, y_travel))
-        logging.debug('Checking squares in path {}'.format(', '.join(map(str, travel_squares))))
-        for x, y in travel_squares:
-            if isinstance(self.board[x][y], Piece) or not self.board[x][y]:
-                return False
-        return True
+        line = find_line(piece.x, piece.y, destination_x, destination_y)
+        if not line:
+            logging.debug("Error: {},{} is not in a line with {},{}".format(
+                destination_x, destination_y, piece.x, piece.y))
+            return False
+        direction, distance = line
+        # don't look at the starting space because we know there's a piece there, or the destination
+        path = RAY_MASKS[piece.x][piece.y][direction]
+        if distance > len(path):
+            return False
+        return not self.board.obstacles & path[distance - 1]
 
     def validate_dwarf_attack(self, piece, target):
         """
@@ -576,52 +1626,27 @@ class Game(object):
         :param target:
         :return bool:
         """
-        # calculate inverse target square to check for line of creatures
         if isinstance(target, Piece):
             x = target.x
             y = target.y
         else:
             x, y = target
-        delta_x = piece.x - x
-        delta_y = piece.y - y
+        logging.info("Checking valid attack at {},{}.".format(x, y))
 
-        logging.info("{}: Checking valid attack at {},{}.".format(
-            datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'), x, y))
-
-        if delta_x > 0:
-            x_check = list(range(piece.x + 1, piece.x + delta_x, 1))
-        else:
-            x_check = list(range(piece.x - 1, piece.x + delta_x, -1))
-
-        if delta_y > 0:
-            y_check = list(range(piece.y + 1, piece.y + delta_y, 1))
-        else:
-            y_check = list(range(piece.y - 1, piece.y + delta_y, -1))
-
-        if not x_check:
-            x_check = [piece.x for x in range(0, len(y_check))]
-        if not y_check:
-            y_check = [piece.y for x in range(0, len(x_check))]
-
-        for x in x_check:
-            if x < 0 or x > 14:
-                return False
-
-        for y in y_check:
-            if y < 0 or y > 14:
-                return False
-
-        check_squares = list(zip(x_check, y_check))
-
-        logging.debug("Delta x: {}, Delta y: {}, List of x to check: {}, List of y to check: {}".format(
-            delta_x, delta_y, x_check, y_check
-        ))
-
-        logging.debug('Checking squares {} for friendly units to toss.'.format(', '.join(map(str, check_squares))))
-        for x, y in check_squares:
-            if not isinstance(self.board.get_piece(x, y), type(piece)):
-                logging.debug("Error not enough friendly pieces in line for throw.")
-                return False
+        line = find_line(piece.x, piece.y, x, y)
+        if not line:
+            return False
+        direction, distance = line
+        # a throw over n squares needs n - 1 allies lined up directly behind the piece
+        behind = RAY_MASKS[piece.x][piece.y][OPPOSITE_DIRECTIONS[direction]]
+        if distance > len(behind):
+            logging.debug("Error not enough room behind {},{} for throw.".format(piece.x, piece.y))
+            return False
+        friendly = self.board.dwarves if isinstance(piece, Dwarf) else self.board.trolls
+        line_mask = behind[distance - 1]
+        if friendly & line_mask != line_mask:
+            logging.debug("Error not enough friendly pieces in line for throw.")
+            return False
         return True
 
     def validate_troll_move_or_attack(self, piece, target):
@@ -662,24 +1687,17 @@ class Game(object):
         """
         # given target square, return list of adjacent dwarf objects, or false
         dest_x, dest_y = destination
-        check_squares = []
-        targets = []
-        for x_value in range(dest_x-1, dest_x+2):
-            for y_value in range(dest_y-1, dest_y+2):
-                check_squares.append((x_value, y_value))
-        logging.debug("{}: Checking for dwarves at {}.".format(
-            datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'),', '.join(map(str, check_squares))))
-        for x, y in check_squares:
-            try:
-                square = self.board[x][y]
-                if isinstance(square, Dwarf):
-                    targets.append(square)
-            except IndexError:
-                logging.debug("Checked for dwarf out of bounds at {},{}.".format(x, y))
-        if targets:
-            return targets
-        else:
+        adjacent = self.board.dwarves & ADJACENT_MASKS[dest_x][dest_y]
+        if not adjacent:
             return False
+        targets = []
+        for x in range(max(dest_x - 1, 0), min(dest_x + 2, BOARD_SIZE)):
+            for y in range(max(dest_y - 1, 0), min(dest_y + 2, BOARD_SIZE)):
+                if adjacent & SQUARE_BITS[x][y]:
+                    targets.append(self.board[x][y])
+        logging.debug("{}: Found dwarves at {}.".format(
+            datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'), ', '.join(str((t.x, t.y)) for t in targets)))
+        return targets
 
     def validate_destination(self, destination):
         """
@@ -688,16 +1706,9 @@ class Game(object):
         :return bool:
         """
         x, y = destination
-        if x < 0 or y < 0:
-            return False
-        try:
-            destination = self.board[x][y]
-            if destination == 0:
-                return False
-            else:
-                return True
-        except IndexError:
+        if x < 0 or y < 0 or x >= BOARD_SIZE or y >= BOARD_SIZE:
             return False
+        return not self.board.blocked & SQUARE_BITS[x][y]
 
     def validate_move(self, start, destination):
         """
@@ -749,27 +1760,142 @@ class Game(object):
             return False
 
     def remove_captured_piece(self, target):
-        x, y = target.x, target.y
-        target.capture()
-        self.board[x][y] = (x, y)
+        self.board.capture_piece(target)
         return True
 
+    @property
+    def position_hash(self):
+        """
+        64 bit Zobrist key for the pieces on the board and the side to move
+        """
+        if self.side_to_move().race == 'Troll':
+            return self.board.zobrist ^ ZOBRIST_TROLL_TO_MOVE
+        return self.board.zobrist
+
+    def export_position(self):
+        """
+        A compact, picklable copy of the position - the dwarf and troll bitboards and the race to move - for handing
+        games to other processes.  Rebuild it with Game.from_position.
+        :return tuple:
+        """
+        return self.board.dwarves, self.board.trolls, self.side_to_move().race
+
+    @classmethod
+    def from_position(cls, position):
+        """
+        Builds a game from export_position, with player one to move.  Piece ids and history aren't kept.
+        """
+        dwarves, trolls, race = position
+        game = cls('', '')
+        game.board.load_occupancy(dwarves, trolls)
+        if race == 'Troll':
+            game.player_one.race, game.player_two.race = 'Troll', 'Dwarf'
+        return game
+
+    def finish(self, winner):
+        """
+        Ends the game, no more moves can be played
+        :param winner: race of the winning side
+        """
+        self.status = 'Finished'
+        self.winner = winner
+
+    def side_to_move(self):
+        """
+        Returns the player whose turn it is - player one moves first, and players alternate for rest of game
+        """
+        if len(self.move_history) % 2 == 0:
+            return self.player_one
+        return self.player_two
+
+    def legal_moves(self, player_token=None, piece=None):
+        """
+        Generates every legal move, toss, shove and attack for the side to move in one pass over the board.
+        Gives the same answers as validate_move, without checking each destination separately.
+        :param player_token: if given, only returns moves when it's that player's turn
+        :param piece: optional [x, y] square of a single piece to generate moves for
+        :return list: (start, destination, captures) tuples, captures being a list of (x, y) squares
+        """
+        player = self.side_to_move()
+        if player_token is not None and player_token != player.token or self.status != 'Active':
+            return []
+        board = self.board
+        own = board.dwarves if player.race == 'Dwarf' else board.trolls
+        if piece is not None:
+            x, y = piece
+            if not on_board(x, y) or not own & SQUARE_BITS[x][y]:
+                return []
+            own = SQUARE_BITS[x][y]
+
+        moves = []
+        if player.race == 'Dwarf':
+            for x, y in mask_squares(own):
+                self.generate_dwarf_moves(x, y, moves)
+        else:
+            for x, y in mask_squares(own):
+                self.generate_troll_moves(x, y, moves)
+        return moves
+
+    def generate_dwarf_moves(self, x, y, moves):
+        """
+        Dwarves slide any distance along a line, or land on the first troll in that line if enough dwarves are
+        lined up behind them to make the toss.
+        """
+        dwarves, trolls, obstacles = self.board.dwarves, self.board.trolls, self.board.obstacles
+        start = (x, y)
+        for direction, ray in enumerate(RAYS[x][y]):
+            for distance, destination in enumerate(ray, 1):
+                bit = SQUARE_BITS[destination[0]][destination[1]]
+                if not obstacles & bit:
+                    moves.append((start, destination, []))
+                    continue
+                if trolls & bit:
+                    behind = RAY_MASKS[x][y][OPPOSITE_DIRECTIONS[direction]]
+                    if distance <= len(behind) and dwarves & behind[distance - 1] == behind[distance - 1]:
+                        moves.append((start, destination, [destination]))
+                break
+
+    def generate_troll_moves(self, x, y, moves):
+        """
+        Trolls step one square, or are shoved further along a line by the trolls behind them as long as they land
+        next to at least one dwarf.  Every dwarf next to the landing square is captured.
+        """
+        dwarves, trolls, obstacles = self.board.dwarves, self.board.trolls, self.board.obstacles
+        start = (x, y)
+        for direction, ray in enumerate(RAYS[x][y]):
+            behind = RAY_MASKS[x][y][OPPOSITE_DIRECTIONS[direction]]
+            for distance, destination in enumerate(ray, 1):
+                dest_x, dest_y = destination
+                if obstacles & SQUARE_BITS[dest_x][dest_y]:
+                    break
+                adjacent = dwarves & ADJACENT_MASKS[dest_x][dest_y]
+                if distance > 1:
+                    # longer shoves need at least as many trolls in line, so stop once there aren't enough
+                    if distance > len(behind) or trolls & behind[distance - 1] != behind[distance - 1]:
+                        break
+                    if not adjacent:
+                        continue
+                moves.append((start, destination, list(mask_squares(adjacent))))
+
     def execute_move(self, player_token, start, destination, test=False):
         self.record_access()
+        if self.status != 'Active':
+            logging.debug("{}: Game is over, no more moves.".format(datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S')))
+            return False
         x, y = start
         piece = self.board.get_piece(x, y)
         if piece and self.validate_player(player_token, piece):
             move = self.validate_move(start, destination)
             if isinstance(move, list) and not test:
-                for target in move:
-                    self.board.capture_piece(target)
-                self.move(piece, destination)
+                self.last_move = self.make_move((start, destination, [(target.x, target.y) for target in move]))
+                self.new_version()
                 logging.debug("Captured pieces at {}".format(', '.join([piece.type for piece in move])))
                 return [(piece.x, piece.y) for piece in move]
             elif move and not test:
                 logging.debug("Valid move - moving {} at {}, {} to {}".format(
                     piece.type, piece.x, piece.y, destination))
-                self.move(piece, destination)
+                self.last_move = self.make_move((start, destination, []))
+                self.new_version()
                 return True
             elif move and test:
                 if isinstance(move, list):
@@ -790,6 +1916,40 @@ class Game(object):
                                                             datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'),x, y))
             return False
 
+    def make_move(self, move):
+        """
+        Plays a move without validating it, capturing pieces and recording history the same way execute_move does.
+        Used by execute_move once a move is validated, and directly by anything searching through positions.
+        :param move: (start, destination, captures) as returned by legal_moves
+        :return tuple: undo record for unmake_move
+        """
+        start, destination, captures = move
+        piece = self.board[start[0]][start[1]]
+        captured = [self.board[x][y] for x, y in captures]
+        for target in captured:
+            self.board.capture_piece(target)
+        self.move(piece, destination)
+        self.capture_history.append([[x, y] for x, y in captures])
+        return piece, captured
+
+    def unmake_move(self, undo):
+        """
+        Takes back the last move played by make_move, putting captured pieces back on the board
+        :param undo: the record returned by make_move
+        """
+        piece, captured = undo
+        self.move_history.pop()
+        self.capture_history.pop()
+        start_x, start_y = piece.moves[-2]
+        self.board.move_piece_on_board(piece, start_x, start_y)
+        piece.undo_move()
+        for target in captured:
+            self.board.restore_piece(target)
+
+    def new_version(self):
+        self.version += 1
+        self.state_cache = None
+
     def move(self, piece, destination):
         x, y = destination
         self.store_move((piece.x, piece.y), destination)
@@ -830,10 +1990,17 @@ class Piece(object):
     def capture(self):
         self.status = 'Captured'
 
+    def restore(self):
+        self.status = 'Alive'
+
     def move(self, square):
         self.x, self.y = square
         self.moves.append(square)
 
+    def undo_move(self):
+        self.moves.pop()
+        self.x, self.y = self.moves[-1]
+
 
 class Dwarf(Piece):
 
@@ -854,6 +2021,10 @@ class Player(object):
     def __init__(self, name, player_id, race):
         self.name = name
         self.token = player_id
+        self.bot = None
+        self.websocket = None
+        # milliseconds left for all this player's moves, None when the game isn't played on the clock
+        self.clock_ms = None
         if race == 'D':
             self.race = 'Dwarf'
         elif race == 'T':
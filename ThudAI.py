@@ -0,0 +1,374 @@
+__author__ = 'wwagner'
+
+import os
+import time
+import math
+import random
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+# setup import to work with django or standalone
+try:
+    import Thud.Thud as Thud
+except ImportError:
+    import Thud
+
+# Computer opponents for Thud.  Bots only use the Game rules API - legal_moves, make_move/unmake_move and
+# position_hash - so they play by exactly the same rules as everyone else.
+
+PIECE_VALUES = {'Dwarf': 1, 'Troll': 4}
+DEFAULT_MS = 500
+MAX_MS = 5000
+# the most processes an mcts bot searches with
+MAX_WORKERS = os.cpu_count() or 1
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def count_pieces(mask):
+    return bin(mask).count('1')
+
+
+def evaluate(game):
+    """
+    Scores a position by the classic Thud scoring - a dwarf is worth one point and a troll four - from the point of
+    view of the side to move.
+    :param game:
+    :return int:
+    """
+    board = game.board
+    score = count_pieces(board.dwarves) * PIECE_VALUES['Dwarf'] - count_pieces(board.trolls) * PIECE_VALUES['Troll']
+    if game.side_to_move().race == 'Dwarf':
+        return score
+    return -score
+
+
+def order_moves(moves, best_move=None):
+    """
+    Searches the best move from an earlier iteration first, then the biggest captures
+    """
+    moves = sorted(moves, key=lambda move: len(move[2]), reverse=True)
+    if best_move in moves:
+        moves.remove(best_move)
+        moves.insert(0, best_move)
+    return moves
+
+
+class AlphaBetaPlayer(object):
+    """
+    Iterative deepening negamax search with alpha-beta pruning and a transposition table keyed on the game's
+    position hash.  Each call to choose_move stops at the end of its time budget and plays the best move from the
+    deepest search it finished.
+    """
+    name = 'alphabeta'
+    options = ('ms', )
+    EXACT, LOWER, UPPER = 0, 1, 2
+
+    def __init__(self, ms=DEFAULT_MS, max_depth=8, table_size=200000):
+        self.budget = min(max(int(ms), 1), MAX_MS) / 1000.0
+        self.max_depth = max_depth
+        self.table_size = table_size
+        self.transpositions = {}
+        self.deadline = 0
+        self.nodes = 0
+        self.last_score = None
+        self.last_depth = 0
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return self.name
+
+    @property
+    def settings(self):
+        """
+        The start data that builds an identical bot, used to hand bots to worker processes
+        """
+        return {"bot": self.name, "ms": int(self.budget * 1000)}
+
+    def choose_move(self, game):
+        """
+        Returns the (start, destination, captures) move to play, or None if the side to move has no moves
+        :param game:
+        :return tuple | None:
+        """
+        moves = game.legal_moves()
+        if not moves:
+            return None
+        if len(self.transpositions) > self.table_size:
+            self.transpositions.clear()
+        self.deadline = time.time() + self.budget
+        self.nodes = 0
+        self.last_score, self.last_depth = evaluate(game), 0
+        best_move = order_moves(moves)[0]
+        for depth in range(1, self.max_depth + 1):
+            try:
+                score, move = self.search_root(game, moves, depth, best_move)
+            except SearchTimeout:
+                break
+            best_move = move
+            self.last_score, self.last_depth = score, depth
+            logging.debug("Bot {} finished depth {} with score {} after {} nodes.".format(
+                self.name, depth, score, self.nodes))
+        return best_move
+
+    def check_time(self):
+        self.nodes += 1
+        if self.nodes % 256 == 0 and time.time() > self.deadline:
+            raise SearchTimeout()
+
+    def search_root(self, game, moves, depth, best_move):
+        alpha, beta = -float('inf'), float('inf')
+        chosen = best_move
+        for move in order_moves(moves, best_move):
+            undo = game.make_move(move)
+            try:
+                score = -self.search(game, depth - 1, -beta, -alpha)
+            finally:
+                game.unmake_move(undo)
+            if score > alpha:
+                alpha, chosen = score, move
+        return alpha, chosen
+
+    def search(self, game, depth, alpha, beta):
+        self.check_time()
+        if depth == 0:
+            return evaluate(game)
+        key = game.position_hash
+        entry = self.transpositions.get(key)
+        best_move = None
+        if entry:
+            entry_depth, entry_score, entry_flag, best_move = entry
+            if entry_depth >= depth:
+                if entry_flag == self.EXACT:
+                    return entry_score
+                elif entry_flag == self.LOWER:
+                    alpha = max(alpha, entry_score)
+                elif entry_flag == self.UPPER:
+                    beta = min(beta, entry_score)
+                if alpha >= beta:
+                    return entry_score
+
+        moves = game.legal_moves()
+        if not moves:
+            return evaluate(game)
+        original_alpha = alpha
+        best_score = -float('inf')
+        for move in order_moves(moves, best_move):
+            undo = game.make_move(move)
+            try:
+                score = -self.search(game, depth - 1, -beta, -alpha)
+            finally:
+                game.unmake_move(undo)
+            if score > best_score:
+                best_score, best_move = score, move
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+
+        if best_score <= original_alpha:
+            flag = self.UPPER
+        elif best_score >= beta:
+            flag = self.LOWER
+        else:
+            flag = self.EXACT
+        self.transpositions[key] = (depth, best_score, flag, best_move)
+        return best_score
+
+
+def playout_result(game):
+    """
+    Scores the end of a playout between 0 and 1 from the dwarves' point of view, 0.5 being level on points.  Using
+    the size of the lead rather than just who's ahead keeps short playouts from being too noisy.
+    """
+    score = evaluate(game)
+    if game.side_to_move().race == 'Troll':
+        score = -score
+    return 1.0 / (1.0 + math.exp(-score / 4.0))
+
+
+class MCTSNode(object):
+    __slots__ = ('move', 'parent', 'race', 'children', 'untried', 'visits', 'wins')
+
+    def __init__(self, move, parent, race):
+        self.move = move
+        self.parent = parent
+        # the race that played the move leading here, wins are counted for them
+        self.race = race
+        self.children = []
+        self.untried = None
+        self.visits = 0
+        self.wins = 0.0
+
+    def select_child(self, exploration):
+        log_visits = math.log(self.visits)
+        return max(self.children, key=lambda child: child.wins / child.visits +
+                   exploration * math.sqrt(log_visits / child.visits))
+
+
+def mcts_root_statistics(position, ms, playout_depth, policy, seed):
+    """
+    Runs in a worker process for root parallel searches - searches its own tree from the position and returns the
+    visits and wins of the root moves, keyed by (start, destination), along with the number of rollouts played
+    """
+    player = MCTSPlayer(ms=ms, playout_depth=playout_depth, policy=policy, seed=seed)
+    return player.root_statistics(player.search(Thud.Game.from_position(position))), player.rollouts
+
+
+class MCTSPlayer(object):
+    """
+    Monte Carlo tree search with UCT selection.  Each iteration walks the tree with make_move, adds one node, plays
+    a random (or capture first) playout a fixed number of plies deep and scores it on the points left on the board,
+    then takes every move back with unmake_move.  With more than one worker each process grows its own tree from
+    the root and the root visit counts are added together.
+    """
+    name = 'mcts'
+    options = ('ms', 'workers', 'policy')
+    POLICIES = ('random', 'capture')
+
+    def __init__(self, ms=DEFAULT_MS, workers=1, playout_depth=20, policy='capture', exploration=1.4, seed=None):
+        self.budget = min(max(int(ms), 1), MAX_MS) / 1000.0
+        self.workers = min(max(int(workers), 1), MAX_WORKERS)
+        self.playout_depth = playout_depth
+        if policy not in self.POLICIES:
+            raise KeyError(policy)
+        self.policy = policy
+        self.exploration = exploration
+        self.random = random.Random(seed)
+        self.executor = None
+        self.rollouts = 0
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return self.name
+
+    @property
+    def settings(self):
+        return {"bot": self.name, "ms": int(self.budget * 1000), "workers": self.workers, "policy": self.policy}
+
+    def choose_move(self, game):
+        """
+        Returns the (start, destination, captures) move with the most visits, or None if there are no moves
+        :param game:
+        :return tuple | None:
+        """
+        moves = game.legal_moves()
+        if not moves:
+            return None
+        started = time.time()
+        if self.workers == 1:
+            statistics = self.root_statistics(self.search(game))
+        else:
+            statistics = self.search_parallel(game)
+        # most visited move, with ties going to the best win rate
+        best_move = max(moves, key=lambda move: self.move_strength(statistics.get((move[0], move[1]), (0, 0.0))))
+        logging.debug("Bot {} played {} rollouts in {:.3f}s.".format(self.name, self.rollouts, time.time() - started))
+        return best_move
+
+    def search_parallel(self, game):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers - 1)
+        position = game.export_position()
+        seeds = [self.random.getrandbits(32) for worker in range(self.workers - 1)]
+        futures = [self.executor.submit(mcts_root_statistics, position, self.budget * 1000, self.playout_depth,
+                                        self.policy, seed) for seed in seeds]
+        statistics = self.root_statistics(self.search(game))
+        for future in futures:
+            worker_statistics, worker_rollouts = future.result()
+            self.rollouts += worker_rollouts
+            for key, (visits, wins) in worker_statistics.items():
+                total_visits, total_wins = statistics.get(key, (0, 0.0))
+                statistics[key] = (total_visits + visits, total_wins + wins)
+        return statistics
+
+    @staticmethod
+    def root_statistics(root):
+        return dict(((child.move[0], child.move[1]), (child.visits, child.wins)) for child in root.children)
+
+    @staticmethod
+    def move_strength(statistics):
+        visits, wins = statistics
+        return visits, wins / visits if visits else 0.0
+
+    def search(self, game):
+        """
+        Grows a tree from the game's position until the time budget runs out and returns its root
+        """
+        deadline = time.time() + self.budget
+        root = MCTSNode(None, None, None)
+        self.rollouts = 0
+        while True:
+            self.iterate(game, root)
+            self.rollouts += 1
+            if self.rollouts % 8 == 0 and time.time() > deadline:
+                return root
+
+    def iterate(self, game, root):
+        undo_records = []
+        node = root
+        try:
+            # selection
+            while node.untried is not None and not node.untried and node.children:
+                node = node.select_child(self.exploration)
+                undo_records.append(game.make_move(node.move))
+            # expansion
+            if node.untried is None:
+                node.untried = game.legal_moves()
+                self.random.shuffle(node.untried)
+                # moves are expanded from the end of the list, so try captures first
+                node.untried.sort(key=lambda move: len(move[2]))
+            if node.untried:
+                race = game.side_to_move().race
+                child = MCTSNode(node.untried.pop(), node, race)
+                node.children.append(child)
+                undo_records.append(game.make_move(child.move))
+                node = child
+            # playout
+            for ply in range(self.playout_depth):
+                moves = game.legal_moves()
+                if not moves:
+                    break
+                undo_records.append(game.make_move(self.playout_move(moves)))
+            result = playout_result(game)
+        finally:
+            while undo_records:
+                game.unmake_move(undo_records.pop())
+        # backpropagation
+        while node is not None:
+            node.visits += 1
+            if node.race == 'Dwarf':
+                node.wins += result
+            elif node.race == 'Troll':
+                node.wins += 1.0 - result
+            node = node.parent
+
+    def playout_move(self, moves):
+        if self.policy == 'capture':
+            captures = [move for move in moves if move[2]]
+            if captures:
+                return self.random.choice(captures)
+        return self.random.choice(moves)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+BOTS = {AlphaBetaPlayer.name: AlphaBetaPlayer,
+        MCTSPlayer.name: MCTSPlayer}
+
+
+def create_bot(bot_data):
+    """
+    Builds a bot from start data like {"bot": "alphabeta", "ms": 500}.  Raises KeyError for unknown bots.
+    :param bot_data:
+    :return bot:
+    """
+    bot_class = BOTS[bot_data["bot"]]
+    return bot_class(**dict((option, bot_data[option]) for option in bot_class.options if option in bot_data))
@@ -0,0 +1,117 @@
+__author__ = 'wwagner'
+
+import time
+from collections import OrderedDict
+
+# Automatic matchmaking - players queue with their Elo rating and are paired with the closest waiting player they can
+# find within a rating window, which widens the longer they wait.  Waiting players are kept in buckets of
+# BUCKET_WIDTH rating points, so finding an opponent only looks at the buckets the window covers rather than the whole
+# queue.  The owner calls match_waiting regularly to pair players whose windows have grown.
+
+DEFAULT_RATING = 1500
+K_FACTOR = 32
+
+BUCKET_WIDTH = 50
+# rating difference accepted straight away, how fast it grows per second of waiting, and the most it grows to
+SEARCH_WINDOW = 100
+WINDOW_GROWTH = 10
+MAX_WINDOW = 400
+
+
+def expected_score(rating, opponent_rating):
+    """
+    The chance of a player beating an opponent according to their ratings
+    """
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+def rate_game(winner_rating, loser_rating, k_factor=K_FACTOR):
+    """
+    Returns the new (winner rating, loser rating) after a game
+    """
+    change = k_factor * (1 - expected_score(winner_rating, loser_rating))
+    return winner_rating + change, loser_rating - change
+
+
+class MatchQueue(object):
+    """
+    Players waiting for a game, by rating bucket and in the order they joined
+    """
+
+    def __init__(self, bucket_width=BUCKET_WIDTH, window=SEARCH_WINDOW, growth=WINDOW_GROWTH, max_window=MAX_WINDOW):
+        self.bucket_width = bucket_width
+        self.window = window
+        self.growth = growth
+        self.max_window = max_window
+        # bucket number: {player: rating} oldest first
+        self.buckets = {}
+        # player: (rating, time joined) oldest first
+        self.waiting = OrderedDict()
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def __contains__(self, player):
+        return player in self.waiting
+
+    def bucket(self, rating):
+        return int(rating // self.bucket_width)
+
+    def search_window(self, waited):
+        return min(self.window + self.growth * max(waited, 0), self.max_window)
+
+    def join(self, player, rating, now=None):
+        """
+        Queues a player, or pairs them straight away with a waiting player close enough in rating.  Returns the
+        opponent they were paired with, or None if they're waiting.
+        """
+        self.leave(player)
+        opponent = self.find_opponent(player, rating, self.window)
+        if opponent is not None:
+            self.leave(opponent)
+            return opponent
+        self.waiting[player] = (rating, time.time() if now is None else now)
+        self.buckets.setdefault(self.bucket(rating), OrderedDict())[player] = rating
+        return None
+
+    def leave(self, player):
+        entry = self.waiting.pop(player, None)
+        if entry is None:
+            return False
+        number = self.bucket(entry[0])
+        del self.buckets[number][player]
+        if not self.buckets[number]:
+            del self.buckets[number]
+        return True
+
+    def find_opponent(self, player, rating, window):
+        """
+        Returns the longest waiting player in the nearest bucket that has someone within window of rating, or None
+        """
+        own = self.bucket(rating)
+        reach = int(window // self.bucket_width) + 1
+        for distance in range(reach + 1):
+            for number in ((own, ) if distance == 0 else (own - distance, own + distance)):
+                for other, other_rating in self.buckets.get(number, {}).items():
+                    if other != player and abs(other_rating - rating) <= window:
+                        return other
+        return None
+
+    def match_waiting(self, now=None):
+        """
+        Pairs the players whose search windows have widened enough to reach another waiting player, longest waiting
+        first.  Returns [(player, opponent), ] and takes them out of the queue.
+        """
+        now = time.time() if now is None else now
+        pairs = []
+        for player, (rating, joined) in list(self.waiting.items()):
+            window = self.search_window(now - joined)
+            # players are already paired with anyone within the starting window when they join
+            if player not in self.waiting or window <= self.window:
+                continue
+            opponent = self.find_opponent(player, rating, window)
+            if opponent is not None:
+                self.leave(player)
+                self.leave(opponent)
+                pairs.append((player, opponent))
+        return pairs
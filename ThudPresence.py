@@ -0,0 +1,79 @@
+__author__ = 'wwagner'
+
+from bisect import bisect_left
+
+# Lobby presence - who is in the lobby, a page at a time, and the joins and leaves since the last batch was sent.
+# Players are listed in the order they joined.  Each join gets a sequence number, and pages are returned with the
+# sequence number of their last player as a cursor, so the next page carries on from there even if players have come
+# and gone in between, without sorting or walking the lobby.  A player who rejoins has a new sequence number and is
+# listed again later on, so nobody still in the lobby is skipped.
+
+LOBBY_PAGE = 100
+
+
+class Presence(object):
+    """
+    Joins are appended to order as (sequence number, name).  Leaving only removes the name from members, and the
+    stale entries are dropped from order once they make up half of it.
+    """
+
+    def __init__(self):
+        self.sequence = 0
+        # name: sequence number of their current join
+        self.members = {}
+        self.order = []
+        # name: 'join' or 'leave', the last change for each player since take_changes
+        self.changes = {}
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def join(self, name):
+        if name in self.members:
+            return False
+        self.sequence += 1
+        self.members[name] = self.sequence
+        self.order.append((self.sequence, name))
+        self.changes[name] = 'join'
+        return True
+
+    def leave(self, name):
+        if self.members.pop(name, None) is None:
+            return False
+        self.changes[name] = 'leave'
+        if len(self.order) > 2 * len(self.members) + LOBBY_PAGE:
+            self.order = [(sequence, member) for sequence, member in self.order if self.members.get(member) == sequence]
+        return True
+
+    def page(self, after=0, limit=LOBBY_PAGE):
+        """
+        Returns up to limit names in the order they joined, starting after the cursor of the previous page, and the
+        cursor for the next page
+        :return tuple: ([names], cursor)
+        """
+        names = []
+        cursor = after
+        for index in range(bisect_left(self.order, (after + 1, )), len(self.order)):
+            if len(names) >= limit:
+                break
+            sequence, name = self.order[index]
+            if self.members.get(name) == sequence:
+                names.append(name)
+                cursor = sequence
+        return names, cursor
+
+    def take_changes(self):
+        """
+        Returns {"join": [names], "leave": [names]} for the players who came or went since the last call, or None if
+        nobody did.  A player who came and went in between is only reported as their latest change.
+        """
+        if not self.changes:
+            return None
+        changes, self.changes = self.changes, {}
+        batch = {"join": [], "leave": []}
+        for name, change in changes.items():
+            batch[change].append(name)
+        return batch
@@ -2,17 +2,23 @@ __author__ = 'wbw'
 
 from datetime import date, datetime
 import tornado.escape
+import tornado.gen
 import tornado.ioloop
 import tornado.web
 import tornado.websocket
 import logging
 import sys
+import urllib.parse
 
 # setup import to work with django or standalone
 try:
     import Thud.Thud as Thud
+    import Thud.ThudWorkers as ThudWorkers
+    import Thud.ThudTimers as ThudTimers
 except ImportError:
     import Thud
+    import ThudWorkers
+    import ThudTimers
 
 class BaseHandler(tornado.web.RequestHandler):
     def set_default_headers(self):
@@ -27,6 +33,11 @@ class VersionHandler(BaseHandler):
         self.write(tornado.escape.json_encode(response))
 
 
+class CacheStats(BaseHandler):
+    def get(self):
+        self.write(tornado.escape.json_encode(game_manager.active_games.stats()))
+
+
 class GetGameByIdHandler(BaseHandler):
     def get(self, id):
         response = {"id": 1,
@@ -35,11 +46,26 @@ class GetGameByIdHandler(BaseHandler):
         self.write(tornado.escape.json_encode(response))
 
 
+@tornado.gen.coroutine
+def run_bot_turn(game_token):
+    """
+    Searches for a bot's move in the engine pool and plays it once it comes back, leaving the IOLoop free for other
+    players in the meantime
+    """
+    player = game_manager.bot_to_move(game_token)
+    if player is None:
+        return
+    move = yield engine_pool.bot_move(game_token, game_manager.active_games[game_token], player)
+    game_manager.apply_bot_move(game_token, player, move)
+
+
 class StartGameWithPlayers(BaseHandler):
     def post(self):
         start_data = tornado.escape.json_decode(self.request.body)
         response = game_manager.process_start(start_data)
         self.write(tornado.escape.json_encode(response))
+        if isinstance(response, dict):
+            tornado.ioloop.IOLoop.current().spawn_callback(run_bot_turn, response["game"])
 
 
 class ExecuteMove(BaseHandler):
@@ -47,6 +73,60 @@ class ExecuteMove(BaseHandler):
         move_data = tornado.escape.json_decode(self.request.body)
         response = game_manager.process_move(move_data)
         self.write(tornado.escape.json_encode(response))
+        if response is True or isinstance(response, list):
+            tornado.ioloop.IOLoop.current().spawn_callback(run_bot_turn, move_data["game"])
+
+
+def read_analysis_ms(analysis_data):
+    """
+    Returns the thinking time of a hint or analysis request in milliseconds, or None for the default.  Raises ValueError
+    or TypeError if it isn't a positive whole number, so a bad request is turned away before it reaches the pool.
+    """
+    ms = analysis_data.get("ms")
+    if ms is None:
+        return None
+    ms = int(ms)
+    if ms <= 0:
+        raise ValueError(ms)
+    return ms
+
+
+class HintMove(BaseHandler):
+    @tornado.gen.coroutine
+    def post(self):
+        hint_data = tornado.escape.json_decode(self.request.body)
+        try:
+            ms = read_analysis_ms(hint_data)
+            game = game_manager.active_games.get(hint_data.get("game"))
+        except (AttributeError, TypeError, ValueError):
+            self.write(tornado.escape.json_encode("Bad JSON data."))
+            return
+        if game is None:
+            response = False
+        else:
+            response = yield engine_pool.hint(game, ms)
+        self.write(tornado.escape.json_encode(response))
+
+
+class AnalyseGames(BaseHandler):
+    @tornado.gen.coroutine
+    def post(self):
+        analyse_data = tornado.escape.json_decode(self.request.body)
+        try:
+            ms = read_analysis_ms(analyse_data)
+            game_tokens = analyse_data.get("games", [])
+            if not isinstance(game_tokens, list) or not all(isinstance(token, str) for token in game_tokens):
+                raise TypeError(game_tokens)
+        except (AttributeError, TypeError, ValueError):
+            self.write(tornado.escape.json_encode("Bad JSON data."))
+            return
+        games = [game_manager.active_games.get(game_token) for game_token in game_tokens]
+        response = []
+        # the searches all run in parallel in the pool, so waiting on them in order costs nothing extra
+        for analysis in engine_pool.analyse([game for game in games if game is not None], ms):
+            result = yield analysis
+            response.append(result)
+        self.write(tornado.escape.json_encode(response))
 
 
 class ValidateMove(BaseHandler):
@@ -56,13 +136,76 @@ class ValidateMove(BaseHandler):
         self.write(tornado.escape.json_encode(response))
 
 
+class LegalMoves(BaseHandler):
+    def post(self):
+        moves_data = tornado.escape.json_decode(self.request.body)
+        response = game_manager.process_moves(moves_data)
+        self.write(tornado.escape.json_encode(response))
+
+
 class GetBoardState(BaseHandler):
+    """
+    The board is tagged with the game's version, so a client polling with If-None-Match gets 304 Not Modified until
+    the next move.  The token is percent encoded in the tag, since quotes and non-ASCII characters can't go in a header.
+    """
     def post(self):
         game = tornado.escape.json_decode(self.request.body)
-        response = game_manager.report_game_state(game)
+        if not isinstance(game, str):
+            self.write(tornado.escape.json_encode("Bad JSON data."))
+            return
+        if game not in game_manager.active_games:
+            self.write(tornado.escape.json_encode(False))
+            return
+        version, response = game_manager.report_game_json(game)
+        self.set_header("Etag", '"{}-{}"'.format(urllib.parse.quote(game, safe=''), version))
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(response)
+
+
+class ListGames(BaseHandler):
+    """
+    /games/active lists a player's unfinished games, /games/finished the most recently finished games, and
+    /games/history every game of a player
+    """
+    def initialize(self, status):
+        self.status = status
+
+    def post(self):
+        games_data = tornado.escape.json_decode(self.request.body)
+        response = game_manager.process_games(games_data, self.status)
         self.write(tornado.escape.json_encode(response))
 
 
+class ResignGame(BaseHandler):
+    def post(self):
+        resign_data = tornado.escape.json_decode(self.request.body)
+        response = game_manager.process_resign(resign_data)
+        self.write(tornado.escape.json_encode(response))
+
+
+class GameStatus(BaseHandler):
+    def post(self):
+        status_data = tornado.escape.json_decode(self.request.body)
+        response = game_manager.process_status(status_data)
+        self.write(tornado.escape.json_encode(response))
+
+
+class GetCompactBoardState(BaseHandler):
+    def post(self):
+        game = tornado.escape.json_decode(self.request.body)
+        if not isinstance(game, str):
+            self.write(tornado.escape.json_encode("Bad JSON data."))
+            return
+        if game not in game_manager.active_games:
+            self.write(tornado.escape.json_encode(False))
+            return
+        response = game_manager.report_compact_state(game)
+        self.set_header("Content-Type", "application/octet-stream")
+        self.write(response)
+
+
 class SaveGame(BaseHandler):
     def post(self):
         game = tornado.escape.json_decode(self.request.body)
@@ -102,46 +245,156 @@ class PlayerConnection(tornado.websocket.WebSocketHandler):
         self.player_id = player_id
         logging.debug("{}: Websocket opened for player {}".format(datetime.now().strftime('%m/%d/%Y %H:%M:%S'),
                                                                   player_id))
-        player_list = game_manager.add_player_to_server(self.player_id, self)
+        page = game_manager.add_player_to_server(self.player_id, self)
         logging.debug("{}: Reported player list {}".format(datetime.now().strftime('%m/%d/%Y %H:%M:%S'),
-                                                                  player_list))
-        if player_list != False:
-            self.write_message(tornado.escape.json_encode(["list", player_list]))
+                                                                  page))
+        if page != False:
+            player_list, cursor = page
+            self.write_message(tornado.escape.json_encode(["list", player_list, cursor]))
         else:
             self.write_message(tornado.escape.json_encode("Duplicate player name."))
             self.close()
 
     def on_message(self, message):
-        response = game_manager.process_socket_message(tornado.escape.json_decode(message), self.player_id)
+        socket_data = tornado.escape.json_decode(message)
+        response = game_manager.process_socket_message(socket_data, self.player_id)
         logging.debug("{}: Message {} received, response {}.".format(
             datetime.now().strftime('%m/%d/%Y %H:%M:%S'),
             message, response))
         self.write_message(tornado.escape.json_encode(response))
+        # bots don't move inline on the server, so let one reply the same way ExecuteMove does
+        if response[0] == "move" and (response[1] is True or isinstance(response[1], list)):
+            tornado.ioloop.IOLoop.current().spawn_callback(run_bot_turn, socket_data[1]["game"])
 
     def send_message(self, message):
-        self.write_message(tornado.escape.json_encode(message))
+        try:
+            self.write_message(tornado.escape.json_encode(message))
+        except tornado.websocket.WebSocketClosedError:
+            # the player has gone, they can sync the board if they come back
+            return False
+        return True
+
+    def send_update(self, message):
+        # message is already encoded, for updates sent to many players at once
+        try:
+            self.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            return False
+        return True
 
     def on_close(self):
-        game_manager.remove_player_from_server(self.player_id)
+        game_manager.remove_player_from_server(self.player_id, self)
         logging.debug("{}: Websocket closed for player {}".format(datetime.now().strftime('%m/%d/%Y %H:%M:%S'),
                                                                   self.player_id))
 
 
+class WatchGame(tornado.websocket.WebSocketHandler):
+    """
+    A spectator following a game at /watch/game_token.  They're sent the whole board, then each move as it's played.
+    Updates waiting to be written are capped at WATCH_BACKLOG - a watcher that falls further behind skips the moves
+    in between and is sent the whole board again once it catches up.
+    """
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self, game_token):
+        self.game_token = game_token
+        self.pending = 0
+        self.behind = False
+        snapshot = game_manager.add_watcher(game_token, self)
+        if snapshot is False:
+            self.write_message(tornado.escape.json_encode("Game not found."))
+            self.close()
+        else:
+            self.write_update(snapshot)
+
+    def send_update(self, message):
+        if self.pending >= WATCH_BACKLOG:
+            self.behind = True
+        else:
+            self.write_update(message)
+
+    def write_update(self, message):
+        try:
+            written = self.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        self.pending += 1
+        written.add_done_callback(self.on_written)
+
+    def on_written(self, written):
+        self.pending -= 1
+        if written.exception() is None and self.behind and self.pending == 0:
+            self.behind = False
+            if self.game_token in game_manager.active_games:
+                self.write_update(game_manager.watch_snapshot(self.game_token))
+
+    def stop_watching(self, reason):
+        """
+        Tells the spectator why they're no longer watching, and closes their websocket
+        """
+        try:
+            self.write_message(tornado.escape.json_encode(reason))
+        except tornado.websocket.WebSocketClosedError:
+            return
+        self.close(reason=reason)
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        game_manager.remove_watcher(self.game_token, self)
+
+
+# unwritten updates a spectator may have queued before they're skipped
+WATCH_BACKLOG = 16
+
+# how often lobby players are sent the joins and leaves since the last update
+PRESENCE_MS = 250
+
+# how often waiting players are matched again with their wider rating windows
+MATCH_MS = 1000
+
+# moves are saved in batches, at least every FLUSH_MS milliseconds or whenever FLUSH_CHANGES changes are waiting
+FLUSH_MS = 1000
+FLUSH_CHANGES = 500
+
+
 def run_server(port):
 
     application = tornado.web.Application([
         (r"/getgamebyid/([0-9]+)", GetGameByIdHandler),
         (r"/version", VersionHandler),
+        (r"/stats", CacheStats),
         (r"/start", StartGameWithPlayers),
         (r"/move", ExecuteMove),
         (r"/move/validate", ValidateMove),
+        (r"/moves", LegalMoves),
+        (r"/hint", HintMove),
+        (r"/analyse", AnalyseGames),
         (r"/game", GetBoardState),
+        (r"/game/compact", GetCompactBoardState),
+        (r"/game/status", GameStatus),
+        (r"/game/resign", ResignGame),
+        (r"/games/active", ListGames, dict(status='Active')),
+        (r"/games/finished", ListGames, dict(status='Finished')),
+        (r"/games/history", ListGames, dict(status=None)),
         (r"/save", SaveGame),
         (r"/load", LoadGame),
         (r"/match/([A-Za-z0-9]+)", PlayerConnection),
+        (r"/watch/([^/]+)", WatchGame),
     ])
 
     application.listen(port)
+    # writes the games changed since the last flush, bounding how long a move can go unsaved
+    tornado.ioloop.PeriodicCallback(game_manager.flush, FLUSH_MS).start()
+    # drops idle games and ends games that have run out of time
+    tornado.ioloop.PeriodicCallback(game_manager.clear_old_games, ThudTimers.TICK_MS).start()
+    # pairs queued players as their rating windows widen
+    tornado.ioloop.PeriodicCallback(game_manager.match_queued_players, MATCH_MS).start()
+    # batches lobby joins and leaves
+    tornado.ioloop.PeriodicCallback(game_manager.send_presence, PRESENCE_MS).start()
     tornado.ioloop.IOLoop.instance().start()
 
 if __name__ == '__main__':
@@ -151,8 +404,14 @@ if __name__ == '__main__':
         PORT = 80
     print("Thud server starting on port ", PORT)
 
-    # start the game manager BEFORE the webserver
-    game_manager = Thud.GameManager()
-    run_server(PORT)
+    # start the game manager and engine workers BEFORE the webserver
+    game_manager = Thud.GameManager(flush_changes=FLUSH_CHANGES, flush_ms=FLUSH_MS)
+    game_manager.inline_bots = False
+    engine_pool = ThudWorkers.EnginePool()
+    try:
+        run_server(PORT)
+    finally:
+        game_manager.shutdown()
+        engine_pool.shutdown(wait=False)
 
 
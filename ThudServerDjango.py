@@ -43,6 +43,12 @@ def ValidateMove(request):
     return HttpResponse(json.dumps(response))
 
 
+def LegalMoves(request):
+    moves_data = json.loads(request.body.decode('utf-8'))
+    response = game_manager.process_moves(moves_data)
+    return HttpResponse(json.dumps(response))
+
+
 def GetBoardState(request):
     game = json.loads(request.body.decode('utf-8'))
     response = game_manager.report_game_state(game)
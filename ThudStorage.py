@@ -0,0 +1,328 @@
+__author__ = 'wwagner'
+
+import json
+import logging
+import sqlite3
+import threading
+
+# Game storage - keeps one open sqlite connection per thread instead of connecting for every save and load.  The schema
+# is migrated once when the storage is created, and connections run in WAL mode with synchronous=NORMAL, so a save only
+# appends to the write ahead log rather than syncing the whole database file.
+
+# the database has always lived at this path relative to the working directory
+DEFAULT_DB_PATH = r'.\games.db'
+
+HEADER_COLUMNS = ('gametoken', 'player_one_name', 'player_one_token', 'player_one_race', 'player_two_name',
+                  'player_two_token', 'player_two_race', 'last_accessed', 'status', 'winner', 'options')
+# written as one fixed statement, so it stays in sqlite's statement cache
+INSERT_HEADER = "INSERT OR REPLACE INTO games VALUES ({})".format(','.join('?' * len(HEADER_COLUMNS)))
+
+
+def create_games_table(connection):
+    connection.execute("CREATE TABLE IF NOT EXISTS Games (gametoken text, player_one_name text, player_one_token text, "
+                       "player_one_race text, player_two_name text, player_two_token text, player_two_race text, "
+                       "last_accessed text, move_history text, pieces text, board text)")
+    connection.execute("CREATE INDEX IF NOT EXISTS games_gametoken ON Games (gametoken)")
+
+
+def split_move_log(connection):
+    """
+    Replaces the single Games row per game, rewritten on every move, with a games header row, an append only moves
+    table and the latest snapshot of the pieces.  Existing games keep their saved board as their snapshot, their
+    earlier moves are kept as history without captures since they're never replayed.
+    """
+    connection.execute("ALTER TABLE Games RENAME TO legacy_games")
+    connection.execute("CREATE TABLE games (gametoken text PRIMARY KEY, player_one_name text, player_one_token text, "
+                       "player_one_race text, player_two_name text, player_two_token text, player_two_race text, "
+                       "last_accessed text)")
+    connection.execute("CREATE TABLE moves (gametoken text, move_number integer, start_x integer, start_y integer, "
+                       "destination_x integer, destination_y integer, captures text, played_at text, "
+                       "PRIMARY KEY (gametoken, move_number)) WITHOUT ROWID")
+    connection.execute("CREATE TABLE snapshots (gametoken text PRIMARY KEY, move_number integer, pieces text, "
+                       "board text)")
+    legacy_games = connection.execute("SELECT gametoken, player_one_name, player_one_token, player_one_race, "
+                                      "player_two_name, player_two_token, player_two_race, last_accessed, "
+                                      "move_history, pieces, board FROM legacy_games ORDER BY ROWID")
+    for row in legacy_games.fetchall():
+        game_id, move_history = row[0], json.loads(row[8])
+        connection.execute("INSERT OR REPLACE INTO games VALUES (?,?,?,?,?,?,?,?)", row[:8])
+        connection.execute("DELETE FROM moves WHERE gametoken = ?", (game_id, ))
+        connection.executemany("INSERT INTO moves VALUES (?,?,?,?,?,?,'[]',?)",
+                               [(game_id, number, start[0], start[1], destination[0], destination[1], row[7])
+                                for number, (start, destination) in enumerate(move_history)])
+        connection.execute("INSERT OR REPLACE INTO snapshots VALUES (?,?,?,?)",
+                           (game_id, len(move_history), row[9], row[10]))
+    connection.execute("DROP TABLE legacy_games")
+
+
+def add_game_status(connection):
+    connection.execute("ALTER TABLE games ADD COLUMN status text DEFAULT 'Active'")
+    connection.execute("ALTER TABLE games ADD COLUMN winner text")
+
+
+def index_games(connection):
+    """
+    Indexes for listing games by player and status, newest first.  Game tokens are already the primary key.
+    """
+    connection.execute("CREATE INDEX games_player_one ON games (player_one_name, status, last_accessed, gametoken)")
+    connection.execute("CREATE INDEX games_player_two ON games (player_two_name, status, last_accessed, gametoken)")
+    connection.execute("CREATE INDEX games_status ON games (status, last_accessed, gametoken)")
+
+
+def add_game_counters(connection):
+    """
+    The last game number given out for each game token prefix (the two player names)
+    """
+    connection.execute("CREATE TABLE game_counters (prefix text PRIMARY KEY, last_game integer) WITHOUT ROWID")
+
+
+def add_player_ratings(connection):
+    """
+    Each player's matchmaking rating and the number of rated games they've played
+    """
+    connection.execute("CREATE TABLE player_ratings (name text PRIMARY KEY, rating real, games integer) WITHOUT ROWID")
+
+
+def add_game_options(connection):
+    """
+    JSON of the game's settings that aren't replayed from its moves, such as the bots playing it
+    """
+    connection.execute("ALTER TABLE games ADD COLUMN options text")
+
+
+def index_game_history(connection):
+    """
+    Indexes for listing games newest first without a status filter - a player's history, and every game
+    """
+    connection.execute("CREATE INDEX games_player_one_history ON games (player_one_name, last_accessed, gametoken)")
+    connection.execute("CREATE INDEX games_player_two_history ON games (player_two_name, last_accessed, gametoken)")
+    connection.execute("CREATE INDEX games_history ON games (last_accessed, gametoken)")
+
+
+# each entry upgrades the schema by one version, PRAGMA user_version records how many have been applied
+MIGRATIONS = [create_games_table,
+              split_move_log,
+              add_game_status,
+              index_games,
+              add_game_counters,
+              add_player_ratings,
+              add_game_options,
+              index_game_history]
+
+# columns returned by find_games, leaving out the player tokens
+LISTING_COLUMNS = ('gametoken', 'player_one_name', 'player_one_race', 'player_two_name', 'player_two_race',
+                   'last_accessed', 'status', 'winner')
+MAX_PAGE = 100
+
+PRAGMAS = ("PRAGMA journal_mode = WAL",
+           "PRAGMA synchronous = NORMAL",
+           "PRAGMA cache_size = -8000",
+           "PRAGMA temp_store = MEMORY")
+
+STATEMENT_CACHE_SIZE = 64
+
+
+class GameStorage(object):
+    """
+    Saves and loads games as a header row, a log of moves and a snapshot of the pieces every so often.  Each thread
+    gets its own connection, opened on first use and kept until close, and the statements are fixed strings so
+    sqlite's statement cache reuses them across calls.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        try:
+            self.migrate()
+        except Exception:
+            self.close()
+            raise
+
+    def __str__(self):
+        return self.path
+
+    def __repr__(self):
+        return self.path
+
+    def connection(self):
+        """
+        Returns this thread's connection, opening and configuring it the first time
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+            for pragma in PRAGMAS:
+                connection.execute(pragma)
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def migrate(self):
+        """
+        Applies each migration the database hasn't had yet in its own transaction, along with the user_version bump.
+        The sqlite3 module only opens transactions before inserts and updates, and would commit every CREATE, ALTER
+        and DROP straight away, so the transactions are begun by hand with the connection in autocommit mode.
+        """
+        connection = self.connection()
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        isolation_level, connection.isolation_level = connection.isolation_level, None
+        try:
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+                logging.debug("Migrating game database {} to version {}.".format(self.path, number))
+                connection.execute("BEGIN")
+                try:
+                    migration(connection)
+                    connection.execute("PRAGMA user_version = {}".format(number))
+                except Exception:
+                    connection.execute("ROLLBACK")
+                    raise
+                connection.execute("COMMIT")
+        finally:
+            connection.isolation_level = isolation_level
+        return len(MIGRATIONS)
+
+    def save_game(self, game_id, header=None, moves=(), snapshot=None, replace=False):
+        """
+        Writes a game in one transaction.  Usually that's just the new moves, one small row each.
+        :param header: tuple in HEADER_COLUMNS order, left alone if None
+        :param moves: [(move_number, start, destination, captures, played_at), ] to append, move numbers from 0
+        :param snapshot: (move_number, pieces, board) - the pieces after that many moves, replacing the last snapshot
+        :param replace: drops every saved move first, for saving a game from scratch
+        """
+        return self.save_games([(game_id, header, moves, snapshot, replace)])
+
+    def save_games(self, saves):
+        """
+        Writes any number of games in a single transaction
+        :param saves: [(game_id, header, moves, snapshot, replace), ] with the same meanings as save_game
+        """
+        connection = self.connection()
+        with connection:
+            for game_id, header, moves, snapshot, replace in saves:
+                if header is not None:
+                    connection.execute(INSERT_HEADER, header)
+                elif moves:
+                    connection.execute("UPDATE games SET last_accessed = ? WHERE gametoken = ?",
+                                       (moves[-1][4], game_id))
+                if replace:
+                    connection.execute("DELETE FROM moves WHERE gametoken = ?", (game_id, ))
+                if moves:
+                    connection.executemany("INSERT OR REPLACE INTO moves VALUES (?,?,?,?,?,?,?,?)",
+                                           [(game_id, number, start[0], start[1], destination[0], destination[1],
+                                             json.dumps(captures), played_at)
+                                            for number, start, destination, captures, played_at in moves])
+                if snapshot is not None:
+                    connection.execute("INSERT OR REPLACE INTO snapshots VALUES (?,?,?,?)",
+                                       (game_id, ) + tuple(snapshot))
+        return True
+
+    def next_game_number(self, prefix):
+        """
+        Counts up the game number for a token prefix and returns it.  A prefix seen for the first time starts after
+        the highest number already saved with it.
+        """
+        connection = self.connection()
+        with connection:
+            if connection.execute("UPDATE game_counters SET last_game = last_game + 1 WHERE prefix = ?",
+                                  (prefix, )).rowcount == 0:
+                connection.execute("INSERT OR IGNORE INTO game_counters VALUES (?, ?)",
+                                   (prefix, self.highest_game_number(prefix) + 1))
+            return connection.execute("SELECT last_game FROM game_counters WHERE prefix = ?", (prefix, )).fetchone()[0]
+
+    def highest_game_number(self, prefix):
+        # the tokens starting with prefix are a range of the primary key index
+        tokens = self.connection().execute("SELECT gametoken FROM games WHERE gametoken > ? AND gametoken < ?",
+                                           (prefix, prefix + '\U0010ffff'))
+        numbers = [int(token[len(prefix):]) for token, in tokens if token[len(prefix):].isdigit()]
+        return max(numbers + [0])
+
+    def load_ratings(self, names):
+        """
+        Returns {name: (rating, games played)} for the players with a saved rating
+        """
+        connection = self.connection()
+        ratings = {}
+        for name in set(names):
+            row = connection.execute("SELECT rating, games FROM player_ratings WHERE name = ?", (name, )).fetchone()
+            if row is not None:
+                ratings[name] = row
+        return ratings
+
+    def save_ratings(self, ratings):
+        """
+        :param ratings: [(name, rating, games played), ]
+        """
+        connection = self.connection()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO player_ratings VALUES (?,?,?)", ratings)
+        return True
+
+    def game_exists(self, game_id):
+        return self.connection().execute("SELECT 1 FROM games WHERE gametoken = ?", (game_id, )).fetchone() is not None
+
+    def load_game(self, game_id):
+        """
+        Returns (header, snapshot, moves) for a game, or None if it has never been saved.  The snapshot is
+        (move_number, pieces, board) or None, and moves are (start, destination, captures, played_at) in order.
+        """
+        connection = self.connection()
+        header = connection.execute("SELECT * FROM games WHERE gametoken = ?", (game_id, )).fetchone()
+        if header is None:
+            return None
+        snapshot = connection.execute("SELECT move_number, pieces, board FROM snapshots WHERE gametoken = ?",
+                                      (game_id, )).fetchone()
+        moves = [((start_x, start_y), [destination_x, destination_y], json.loads(captures), played_at)
+                 for start_x, start_y, destination_x, destination_y, captures, played_at in connection.execute(
+                     "SELECT start_x, start_y, destination_x, destination_y, captures, played_at FROM moves "
+                     "WHERE gametoken = ? ORDER BY move_number", (game_id, ))]
+        return header, snapshot, moves
+
+    def find_games(self, player=None, status=None, before=None, limit=20):
+        """
+        Lists saved games, most recently played first, as tuples of LISTING_COLUMNS.  Every filter is optional.
+        :param player: only games with a player of this name
+        :param status: only games with this status, 'Active' or 'Finished'
+        :param before: (last_accessed, gametoken) of the last game on the previous page
+        :param limit: games per page, at most MAX_PAGE
+        :return list:
+        """
+        return self.connection().execute(*self.listing_query(player, status, before, limit)).fetchall()
+
+    def listing_query(self, player=None, status=None, before=None, limit=20):
+        """
+        Returns the (query, parameters) find_games runs.  Every listing reads an index in order, so a page never
+        sorts more than the games on it.
+        """
+        clauses, parameters = [], []
+        if status is not None:
+            clauses.append("status = ?")
+            parameters.append(status)
+        if before is not None:
+            clauses.append("(last_accessed, gametoken) < (?, ?)")
+            parameters.extend(before)
+        columns = ', '.join(LISTING_COLUMNS)
+        if player is None:
+            query = "SELECT {} FROM games {}".format(columns, self.where(clauses))
+        else:
+            # one indexed search for each side of the board rather than an OR across both columns
+            query = "SELECT {0} FROM games {1} UNION ALL SELECT {0} FROM games {2}".format(
+                columns, self.where(["player_one_name = ?"] + clauses),
+                self.where(["player_two_name = ?", "player_one_name != ?"] + clauses))
+            parameters = [player] + parameters + [player, player] + parameters
+        query += " ORDER BY last_accessed DESC, gametoken DESC LIMIT ?"
+        parameters.append(max(1, min(int(limit), MAX_PAGE)))
+        return query, parameters
+
+    @staticmethod
+    def where(clauses):
+        return "WHERE " + " AND ".join(clauses) if clauses else ""
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        self.local = threading.local()
@@ -0,0 +1,96 @@
+__author__ = 'wwagner'
+
+import time
+
+# Deadlines for idle games and turn clocks.  A hierarchical timing wheel keeps every deadline in a bucket, so scheduling,
+# moving and cancelling a deadline cost the same however many games are running, and each tick only looks at the
+# deadlines that are due.  The owner calls advance regularly - the Tornado server does it from a PeriodicCallback.
+
+TICK_MS = 1000
+WHEEL_SLOTS = 64
+WHEEL_LEVELS = 4
+
+
+class TimingWheel(object):
+    """
+    Level 0 has a slot for each of the next WHEEL_SLOTS ticks, level 1 a slot for each WHEEL_SLOTS ticks after that,
+    and so on.  When a lower level comes round to its first slot the next slot of the level above is emptied into it,
+    so a deadline moves down at most WHEEL_LEVELS - 1 times before it fires.  Deadlines further out than the top level
+    reaches wait in its last slot and are placed again when it comes round.
+    """
+
+    def __init__(self, tick_ms=TICK_MS, slots=WHEEL_SLOTS, levels=WHEEL_LEVELS, now=None):
+        self.tick = tick_ms / 1000.0
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[{} for slot in range(slots)] for level in range(levels)]
+        # key: (level, slot, tick) for every scheduled deadline
+        self.entries = {}
+        self.current = int((time.time() if now is None else now) / self.tick)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def schedule(self, key, deadline):
+        """
+        Sets the deadline for key, in time.time() seconds, replacing any deadline it already had.  Deadlines that have
+        already passed fire on the next tick.
+        """
+        self.cancel(key)
+        self.place(key, max(int(-(-deadline // self.tick)), self.current + 1))
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            level, slot, tick = entry
+            del self.wheels[level][slot][key]
+            return True
+        return False
+
+    def deadline(self, key):
+        entry = self.entries.get(key)
+        return entry[2] * self.tick if entry else None
+
+    def place(self, key, tick):
+        for level in range(self.levels):
+            span = self.slots ** level
+            if tick // span - self.current // span < self.slots:
+                break
+        else:
+            # past the end of the top level, wait in its last slot
+            span = self.slots ** level
+            slot = (self.current // span + self.slots - 1) % self.slots
+            self.wheels[level][slot][key] = tick
+            self.entries[key] = (level, slot, tick)
+            return
+        slot = (tick // span) % self.slots
+        self.wheels[level][slot][key] = tick
+        self.entries[key] = (level, slot, tick)
+
+    def advance(self, now=None):
+        """
+        Moves the wheel on to now, returning the keys whose deadlines have passed in the order they fell due
+        :return list:
+        """
+        target = int((time.time() if now is None else now) / self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            for level in range(1, self.levels):
+                span = self.slots ** level
+                if self.current % span:
+                    break
+                slot = (self.current // span) % self.slots
+                bucket, self.wheels[level][slot] = self.wheels[level][slot], {}
+                for key, tick in bucket.items():
+                    del self.entries[key]
+                    self.place(key, max(tick, self.current))
+            slot = self.current % self.slots
+            bucket, self.wheels[0][slot] = self.wheels[0][slot], {}
+            for key in bucket:
+                del self.entries[key]
+                expired.append(key)
+        return expired
@@ -0,0 +1,86 @@
+__author__ = 'wwagner'
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import logging
+
+# setup import to work with django or standalone
+try:
+    import Thud.Thud as Thud
+    import Thud.ThudAI as ThudAI
+except ImportError:
+    import Thud
+    import ThudAI
+
+# Engine work runs in worker processes so searching never blocks the server's IOLoop.  Games are handed over as
+# Game.export_position tuples (two bitboards and the race to move) rather than pickled Game objects.
+
+WORKER_BOT_LIMIT = 64
+
+# bots kept alive in each worker process so their transposition tables carry over between moves of the same game
+worker_bots = OrderedDict()
+
+
+def find_worker_bot(settings, bot_key):
+    # the pool's processes already search side by side, so bots in them don't start pools of their own
+    settings = dict(settings, workers=1)
+    if bot_key is None:
+        return ThudAI.create_bot(settings)
+    key = (bot_key, settings["bot"], settings.get("ms"))
+    bot = worker_bots.pop(key, None)
+    if bot is None:
+        bot = ThudAI.create_bot(settings)
+    worker_bots[key] = bot
+    while len(worker_bots) > WORKER_BOT_LIMIT:
+        key, old_bot = worker_bots.popitem(last=False)
+        if hasattr(old_bot, 'close'):
+            old_bot.close()
+    return bot
+
+
+def bot_move(position, settings, bot_key=None):
+    """
+    Runs in a worker process - rebuilds the position and returns the move the bot chooses
+    :param position: tuple from Game.export_position
+    :param settings: bot start data, like {"bot": "alphabeta", "ms": 500}
+    :param bot_key: reuses the same bot for every move of a game, usually the game token
+    :return tuple | None:
+    """
+    game = Thud.Game.from_position(position)
+    return find_worker_bot(settings, bot_key).choose_move(game)
+
+
+def analyse_position(position, ms):
+    """
+    Runs in a worker process - searches a position and reports the best move, its score for the side to move, and how
+    deep the search got
+    :return dict:
+    """
+    game = Thud.Game.from_position(position)
+    bot = ThudAI.AlphaBetaPlayer(ms=ms)
+    move = bot.choose_move(game)
+    return {"move": move, "score": bot.last_score, "depth": bot.last_depth}
+
+
+class EnginePool(object):
+    """
+    A pool of worker processes for bot moves, hints and batch analysis.  Every method returns a
+    concurrent.futures.Future, which Tornado coroutines can yield on.
+    """
+
+    def __init__(self, workers=None):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def bot_move(self, game_token, game, player):
+        logging.debug("Handing bot move for game {} to the engine pool.".format(game_token))
+        return self.executor.submit(bot_move, game.export_position(), player.bot.settings,
+                                    (game_token, player.token))
+
+    def hint(self, game, ms=None):
+        return self.executor.submit(analyse_position, game.export_position(), ms or ThudAI.DEFAULT_MS)
+
+    def analyse(self, games, ms=None):
+        return [self.hint(game, ms) for game in games]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,175 @@
+__author__ = 'wwagner'
+
+import argparse
+import base64
+import gzip
+import io
+import json
+import logging
+import sys
+
+# setup import to work with django or standalone
+try:
+    import Thud.ThudStorage as ThudStorage
+except ImportError:
+    import ThudStorage
+
+# Bulk export and import of saved games as newline delimited JSON, one game per line:
+#     python -m Thud.archive export games.ndjson.gz --db games.db
+#     python -m Thud.archive import games.ndjson.gz --db other.db
+# Games, moves and snapshots are each read in primary key order a chunk at a time and merged by game token, so
+# exporting takes the same memory however many games there are.  Files ending in .gz are compressed.
+
+CHUNK_SIZE = 1000
+
+
+def open_archive(path, mode, compress=None):
+    """
+    Opens an archive file for text, '-' being stdin or stdout
+    """
+    if compress is None:
+        compress = path.endswith('.gz')
+    if path == '-':
+        stream = sys.stdout.buffer if 'w' in mode else sys.stdin.buffer
+        if compress:
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=stream, mode=mode + 'b'), encoding='utf-8')
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    if compress:
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def read_chunks(connection, query, chunk_size):
+    cursor = connection.execute(query)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def game_records(connection, chunk_size=CHUNK_SIZE):
+    """
+    Yields each saved game as a dict of its header columns, with its moves and latest snapshot
+    """
+    moves = read_chunks(connection, "SELECT gametoken, start_x, start_y, destination_x, destination_y, captures, "
+                                    "played_at FROM moves ORDER BY gametoken, move_number", chunk_size)
+    snapshots = read_chunks(connection, "SELECT gametoken, move_number, pieces, board FROM snapshots "
+                                        "ORDER BY gametoken", chunk_size)
+    games = read_chunks(connection, "SELECT {} FROM games ORDER BY gametoken".format(
+        ', '.join(ThudStorage.HEADER_COLUMNS)), chunk_size)
+    move = next(moves, None)
+    snapshot = next(snapshots, None)
+    for header in games:
+        game_id = header[0]
+        record = dict(zip(ThudStorage.HEADER_COLUMNS, header))
+        record["moves"] = []
+        # moves and snapshots of games missing a header are skipped
+        while move is not None and move[0] <= game_id:
+            if move[0] == game_id:
+                record["moves"].append([[move[1], move[2]], [move[3], move[4]], json.loads(move[5]), move[6]])
+            move = next(moves, None)
+        record["snapshot"] = None
+        while snapshot is not None and snapshot[0] <= game_id:
+            if snapshot[0] == game_id:
+                record["snapshot"] = encode_snapshot(snapshot[1:])
+            snapshot = next(snapshots, None)
+        yield record
+
+
+def encode_snapshot(snapshot):
+    move_number, pieces, board = snapshot
+    if isinstance(board, bytes):
+        return {"move_number": move_number, "pieces": pieces, "board_bytes": base64.b64encode(board).decode('ascii')}
+    return {"move_number": move_number, "pieces": pieces, "board": board}
+
+
+def decode_snapshot(snapshot):
+    if "board_bytes" in snapshot:
+        return snapshot["move_number"], snapshot["pieces"], base64.b64decode(snapshot["board_bytes"])
+    return snapshot["move_number"], snapshot["pieces"], snapshot["board"]
+
+
+def export_games(storage, file, chunk_size=CHUNK_SIZE):
+    """
+    Writes every saved game to file as a line of JSON.  Returns the number of games written.
+    """
+    count = 0
+    for record in game_records(storage.connection(), chunk_size):
+        file.write(json.dumps(record, separators=(',', ':')))
+        file.write('\n')
+        count += 1
+    return count
+
+
+def import_games(storage, file, batch_size=CHUNK_SIZE):
+    """
+    Saves every game in an exported file, replacing any saved game with the same token, batch_size games to a
+    transaction.  Returns the number of games read.
+    """
+    count = 0
+    batch = []
+    for line in file:
+        if line.strip():
+            batch.append(json.loads(line))
+        if len(batch) >= batch_size:
+            count += write_batch(storage.connection(), batch)
+            batch = []
+    if batch:
+        count += write_batch(storage.connection(), batch)
+    return count
+
+
+def write_batch(connection, records):
+    # archives written before a column was added leave it empty
+    headers = [tuple(record.get(column) for column in ThudStorage.HEADER_COLUMNS) for record in records]
+    moves = [(record["gametoken"], number, start[0], start[1], destination[0], destination[1], json.dumps(captures),
+              played_at)
+             for record in records for number, (start, destination, captures, played_at) in enumerate(record["moves"])]
+    snapshots = [(record["gametoken"], ) + decode_snapshot(record["snapshot"]) for record in records
+                 if record["snapshot"] is not None]
+    # keep the token counters ahead of imported games, so new games never take their tokens
+    counters = []
+    for record in records:
+        prefix = (record["player_one_name"] or '') + (record["player_two_name"] or '')
+        number = record["gametoken"][len(prefix):]
+        if record["gametoken"].startswith(prefix) and number.isdigit():
+            counters.append((prefix, int(number)))
+    with connection:
+        connection.executemany("DELETE FROM moves WHERE gametoken = ?", [(header[0], ) for header in headers])
+        connection.executemany("DELETE FROM snapshots WHERE gametoken = ?", [(header[0], ) for header in headers])
+        connection.executemany(ThudStorage.INSERT_HEADER, headers)
+        connection.executemany("INSERT INTO moves VALUES (?,?,?,?,?,?,?,?)", moves)
+        connection.executemany("INSERT INTO snapshots VALUES (?,?,?,?)", snapshots)
+        connection.executemany("INSERT INTO game_counters VALUES (?, ?) ON CONFLICT (prefix) "
+                               "DO UPDATE SET last_game = max(last_game, excluded.last_game)", counters)
+    return len(records)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Export or import saved Thud games as newline delimited JSON.')
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('file', help="archive to write or read, '-' for stdout or stdin")
+    parser.add_argument('--db', default=ThudStorage.DEFAULT_DB_PATH, help='game database')
+    parser.add_argument('--gzip', action='store_true', help='compress even if the file name does not end in .gz')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='rows read or games written at a time')
+    options = parser.parse_args(arguments)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    storage = ThudStorage.GameStorage(options.db)
+    try:
+        if options.command == 'export':
+            with open_archive(options.file, 'w', options.gzip or None) as file:
+                count = export_games(storage, file, options.chunk_size)
+        else:
+            with open_archive(options.file, 'r', options.gzip or None) as file:
+                count = import_games(storage, file, options.chunk_size)
+    finally:
+        storage.close()
+    print('{} {} games'.format('Exported' if options.command == 'export' else 'Imported', count), file=sys.stderr)
+    return count
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+__author__ = 'wwagner'
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import datetime
+
+# setup import to work with django or standalone
+try:
+    import Thud.Thud as Thud
+except ImportError:
+    import Thud
+
+# Engine benchmarks - perft move generation counts and timings of the rules engine on fixed positions.  Results are
+# written as JSON so runs can be compared with --compare to catch regressions:
+#     python -m Thud.benchmark --output before.json
+#     python -m Thud.benchmark --output after.json --compare before.json
+
+POSITIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api_test.json')
+
+# race to move in each of the saved board states in api_test.json
+SAVED_POSITIONS = {'base state': 'Dwarf', 'first move': 'Troll'}
+
+# positions reached by seeded self-play from the opening, (seed, moves played)
+PLAYED_POSITIONS = {'midgame': (602, 20), 'endgame': (1247, 60)}
+
+
+def perft(game, depth):
+    """
+    Counts every legal sequence of moves depth plies deep from the game's position
+    :param game:
+    :param depth:
+    :return int:
+    """
+    if depth == 0:
+        return 1
+    moves = game.legal_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        undo = game.make_move(move)
+        nodes += perft(game, depth - 1)
+        game.unmake_move(undo)
+    return nodes
+
+
+def saved_position(name):
+    """
+    Builds a game from one of the board states saved in api_test.json
+    """
+    with open(POSITIONS_FILE) as file:
+        game_state = json.loads(file.read())[name]
+    game = Thud.Game('player_one', 'player_two')
+    game.board.load_game_state(game_state)
+    if SAVED_POSITIONS[name] == 'Troll':
+        game.player_one.race, game.player_two.race = 'Troll', 'Dwarf'
+    return game
+
+
+def played_position(name):
+    """
+    Builds a game by playing seeded moves from the opening, taking captures when there are any
+    """
+    seed, moves_played = PLAYED_POSITIONS[name]
+    generator = random.Random(seed)
+    game = Thud.Game('player_one', 'player_two')
+    for turn in range(moves_played):
+        moves = game.legal_moves()
+        captures = [move for move in moves if move[2]]
+        start, destination, targets = generator.choice(captures or moves)
+        game.execute_move(game.side_to_move().token, start, destination)
+    return game
+
+
+def load_positions():
+    positions = dict((name, saved_position(name)) for name in SAVED_POSITIONS)
+    positions.update((name, played_position(name)) for name in PLAYED_POSITIONS)
+    return positions
+
+
+def time_calls(function, calls):
+    started = time.perf_counter()
+    for call in range(calls):
+        function()
+    elapsed = time.perf_counter() - started
+    return {"calls": calls, "seconds": round(elapsed, 6), "per_call_us": round(elapsed / calls * 1000000, 3)}
+
+
+def run_perft(positions, depth):
+    results = {}
+    for name, game in sorted(positions.items()):
+        results[name] = {}
+        for current_depth in range(1, depth + 1):
+            started = time.perf_counter()
+            nodes = perft(game, current_depth)
+            elapsed = time.perf_counter() - started
+            results[name][str(current_depth)] = {"nodes": nodes, "seconds": round(elapsed, 6),
+                                                 "nodes_per_second": round(nodes / elapsed, 1) if elapsed else None}
+    return results
+
+
+def run_timings(positions, calls):
+    """
+    Times the validation functions on every legal destination of every position, and reporting, saving and loading
+    a game
+    """
+    timings = {}
+    for name, game in sorted(positions.items()):
+        moves = game.legal_moves()
+        pieces = [(game.board.get_piece(*start), destination) for start, destination, captures in moves]
+        destinations = [destination for start, destination, captures in moves]
+
+        def validate_moves():
+            for start, destination, captures in moves:
+                game.validate_move(start, destination)
+
+        def validate_clear_paths():
+            for piece, destination in pieces:
+                game.validate_clear_path(piece, destination)
+
+        def validate_throws():
+            for piece, destination in pieces:
+                game.validate_throw(piece, destination)
+
+        def find_adjacent_dwarves():
+            for destination in destinations:
+                game.find_adjacent_dwarves(destination)
+
+        # each call covers every legal move, so time fewer of them
+        move_calls = max(1, calls // 10)
+        timings[name] = {"legal_moves": time_calls(game.legal_moves, calls),
+                         "validate_move": time_calls(validate_moves, move_calls),
+                         "validate_clear_path": time_calls(validate_clear_paths, move_calls),
+                         "validate_throw": time_calls(validate_throws, move_calls),
+                         "find_adjacent_dwarves": time_calls(find_adjacent_dwarves, move_calls),
+                         "moves_timed_per_call": len(moves)}
+        timings[name].update(time_game_manager(game, calls))
+    return timings
+
+
+def time_game_manager(game, calls):
+    """
+    Times report_game_state, save_game and load_game for a game, using a throwaway database.  save_game is timed
+    saving the whole game, as its first save does, and save_move saving one new move, as every later save does.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        game_manager = Thud.GameManager(os.path.join(directory, 'games.db'))
+        try:
+            game_manager.active_games['benchmark'] = game
+            board_bytes = game.board.to_bytes()
+
+            def save_whole_game():
+                game.saved_moves = None
+                game_manager.save_game('benchmark')
+
+            timings = {"report_game_state": time_calls(lambda: game_manager.report_game_state('benchmark'), calls),
+                       "board_to_bytes": time_calls(game.board.to_bytes, calls),
+                       "board_from_bytes": time_calls(lambda: Thud.Board.from_bytes(board_bytes), calls),
+                       "save_game": time_calls(save_whole_game, calls)}
+            moves = game.legal_moves()
+            if moves:
+                def save_move():
+                    undo = game.make_move(moves[0])
+                    game_manager.save_game('benchmark')
+                    game.unmake_move(undo)
+                    game.saved_moves = len(game.move_history)
+
+                timings["save_move"] = time_calls(save_move, calls)
+            timings["load_game"] = time_calls(lambda: game_manager.load_game('benchmark'), calls)
+        finally:
+            game_manager.storage.close()
+    return timings
+
+
+def run_sizes(positions):
+    """
+    Bytes taken by each position as report_game_state JSON and in the compact Board.to_bytes format
+    """
+    game_manager = Thud.GameManager(':memory:')
+    sizes = {}
+    for name, game in sorted(positions.items()):
+        game_manager.active_games[name] = game
+        sizes[name] = {"game_state_json": len(json.dumps(game_manager.report_game_state(name), separators=(',', ': '))),
+                       "board_bytes": len(game.board.to_bytes())}
+    return sizes
+
+
+def compare(results, baseline, tolerance):
+    """
+    Lists every timing that got slower than the baseline by more than tolerance (0.2 being 20%), and every perft count
+    that changed, which means move generation itself changed
+    :return list:
+    """
+    problems = []
+    for name, depths in results["perft"].items():
+        for depth, result in depths.items():
+            old = baseline.get("perft", {}).get(name, {}).get(depth)
+            if old and old["nodes"] != result["nodes"]:
+                problems.append("perft {} depth {}: {} nodes, was {}".format(name, depth, result["nodes"],
+                                                                            old["nodes"]))
+    for name, timings in results["timings"].items():
+        for function, result in timings.items():
+            old = baseline.get("timings", {}).get(name, {}).get(function)
+            if not isinstance(result, dict) or not old:
+                continue
+            if result["per_call_us"] > old["per_call_us"] * (1 + tolerance):
+                problems.append("{} {}: {}us per call, was {}us".format(name, function, result["per_call_us"],
+                                                                        old["per_call_us"]))
+    return problems
+
+
+def run_benchmarks(depth=2, calls=100):
+    positions = load_positions()
+    return {"timestamp": datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S'),
+            "python": platform.python_version(),
+            "perft_depth": depth,
+            "calls": calls,
+            "perft": run_perft(positions, depth),
+            "timings": run_timings(positions, calls),
+            "sizes": run_sizes(positions)}
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Thud rules engine.')
+    parser.add_argument('--depth', type=int, default=2, help='deepest perft count to run')
+    parser.add_argument('--calls', type=int, default=100, help='repetitions for each timing')
+    parser.add_argument('--output', default='benchmark.json', help='file to write the results to')
+    parser.add_argument('--compare', help='earlier results file to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown allowed before reporting, 0.2 = 20%%')
+    parser.add_argument('--logging', action='store_true', help='keep debug logging on while timing')
+    options = parser.parse_args(arguments)
+
+    if not options.logging:
+        logging.getLogger().setLevel(logging.WARNING)
+    results = run_benchmarks(options.depth, options.calls)
+    with open(options.output, 'w') as file:
+        file.write(json.dumps(results, indent=2, sort_keys=True))
+    for name, depths in sorted(results["perft"].items()):
+        for depth, result in sorted(depths.items()):
+            print("perft {:<10} depth {}: {:>10} nodes {:>12} nodes/s".format(name, depth, result["nodes"],
+                                                                            result["nodes_per_second"]))
+    for name, timings in sorted(results["timings"].items()):
+        for function, result in sorted(timings.items()):
+            if isinstance(result, dict):
+                print("{:<10} {:<22} {:>12}us per call".format(name, function, result["per_call_us"]))
+
+    for name, sizes in sorted(results["sizes"].items()):
+        print("{:<10} {:>6} bytes as JSON, {:>4} bytes compact".format(name, sizes["game_state_json"],
+                                                                      sizes["board_bytes"]))
+
+    if options.compare:
+        with open(options.compare) as file:
+            problems = compare(results, json.loads(file.read()), options.tolerance)
+        for problem in problems:
+            print("REGRESSION " + problem)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+__author__ = 'wwagner'
+
+import argparse
+import json
+import logging
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# setup import to work with django or standalone
+try:
+    import Thud.Thud as Thud
+    import Thud.ThudAI as ThudAI
+except ImportError:
+    import Thud
+    import ThudAI
+
+# Self-play harness - plays complete games through Game.execute_move across a process pool and reports throughput and
+# capture statistics.  Run with "python -m Thud.simulate --games 10000 --workers 8 --policy random".
+
+POLICIES = ('random', 'capture') + tuple(sorted(ThudAI.BOTS))
+
+
+def choose_random(game, moves, generator):
+    return generator.choice(moves)
+
+
+def choose_capture(game, moves, generator):
+    captures = [move for move in moves if move[2]]
+    return generator.choice(captures or moves)
+
+
+def make_policy(policy, ms):
+    """
+    Returns a function choosing a move from (game, moves, random generator)
+    """
+    if policy == 'random':
+        return choose_random
+    elif policy == 'capture':
+        return choose_capture
+    bot = ThudAI.create_bot({"bot": policy, "ms": ms})
+    return lambda game, moves, generator: bot.choose_move(game)
+
+
+def play_game(policy='random', seed=None, max_moves=500, ms=50):
+    """
+    Plays one game to the end, or until max_moves have been played, and returns its statistics
+    :return dict:
+    """
+    generator = random.Random(seed)
+    choose = make_policy(policy, ms)
+    game = Thud.Game('player_one', 'player_two')
+    captures = {'Dwarf': 0, 'Troll': 0}
+    capture_moves = 0
+    while len(game.move_history) < max_moves:
+        moves = game.legal_moves()
+        if not moves:
+            break
+        player = game.side_to_move()
+        start, destination, targets = choose(game, moves, generator)
+        result = game.execute_move(player.token, start, destination)
+        if not result:
+            raise ValueError('Rules engine rejected generated move {} to {}'.format(start, destination))
+        if targets:
+            capture_moves += 1
+            captures['Troll' if player.race == 'Dwarf' else 'Dwarf'] += len(targets)
+    return {"moves": len(game.move_history),
+            "finished": len(game.move_history) < max_moves,
+            "dwarves_captured": captures['Dwarf'],
+            "trolls_captured": captures['Troll'],
+            "capture_moves": capture_moves,
+            "score": ThudAI.evaluate(game) if game.side_to_move().race == 'Dwarf' else -ThudAI.evaluate(game)}
+
+
+def play_games(policy, seeds, max_moves, ms):
+    """
+    Runs in a worker process - plays a batch of games, keeping the per game statistics small for the trip back
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    return [play_game(policy, seed, max_moves, ms) for seed in seeds]
+
+
+def summarise(results, elapsed, workers, policy):
+    total_moves = sum(result["moves"] for result in results)
+    games = len(results)
+    return {"policy": policy,
+            "workers": workers,
+            "games": games,
+            "seconds": round(elapsed, 3),
+            "games_per_second": round(games / elapsed, 2) if elapsed else None,
+            "moves_per_second": round(total_moves / elapsed, 1) if elapsed else None,
+            "average_moves": round(total_moves / games, 1) if games else 0,
+            "finished_games": sum(1 for result in results if result["finished"]),
+            "average_dwarves_captured": round(sum(r["dwarves_captured"] for r in results) / games, 2) if games else 0,
+            "average_trolls_captured": round(sum(r["trolls_captured"] for r in results) / games, 2) if games else 0,
+            "capture_moves": sum(result["capture_moves"] for result in results),
+            "dwarves_ahead": sum(1 for result in results if result["score"] > 0),
+            "trolls_ahead": sum(1 for result in results if result["score"] < 0),
+            "level": sum(1 for result in results if result["score"] == 0)}
+
+
+def run_simulation(games, workers=1, policy='random', seed=0, max_moves=500, ms=50, batch_size=None):
+    """
+    Plays games spread across a pool of worker processes and returns the summary report
+    :return dict:
+    """
+    seeds = [seed + game for game in range(games)]
+    batch_size = batch_size or max(1, min(100, games // (workers * 4) or 1))
+    batches = [seeds[index:index + batch_size] for index in range(0, games, batch_size)]
+    started = time.time()
+    results = []
+    if workers == 1:
+        for batch in batches:
+            results.extend(play_games(policy, batch, max_moves, ms))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(play_games, policy, batch, max_moves, ms) for batch in batches]
+            for future in futures:
+                results.extend(future.result())
+    return summarise(results, time.time() - started, workers, policy)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Play Thud games against itself and report engine throughput.')
+    parser.add_argument('--games', type=int, default=100, help='number of games to play')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--policy', choices=POLICIES, default='random', help='how both sides choose their moves')
+    parser.add_argument('--max-moves', type=int, default=500, help='moves before a game is stopped unfinished')
+    parser.add_argument('--ms', type=int, default=50, help='thinking time per move for bot policies')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the first game, later games count up from it')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    options = parser.parse_args(arguments)
+
+    report = run_simulation(options.games, options.workers, options.policy, options.seed, options.max_moves,
+                            options.ms)
+    if options.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print('{:>26}: {}'.format(key, value))
+    return report
+
+
+if __name__ == '__main__':
+    main()
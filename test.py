@@ -3,6 +3,21 @@ __author__ = 'wwagner'
 import unittest
 import unittest.mock
 import Thud
+import ThudAI
+import ThudWorkers
+import simulate
+import benchmark
+import archive
+import ThudStorage
+import ThudTimers
+import ThudMatchmaking
+import ThudPresence
+import time
+import os
+import tempfile
+import threading
+import sqlite3
+import random
 import json
 
 
@@ -90,6 +105,61 @@ class BoardTest(unittest.TestCase):
         self.test_board.move_piece_on_board(test_dwarf, 5, 1)
         self.assertEqual(self.test_board.get_piece(5, 1), test_dwarf)
 
+    def test_bytes_round_trip(self):
+        self.test_board.capture_piece(self.test_board.get_piece(7, 6))
+        self.test_board.move_piece_on_board(self.test_board.get_piece(0, 5), 3, 5)
+        encoded = self.test_board.to_bytes()
+        self.assertEqual(len(encoded), len(Thud.PLAYABLE_SQUARES) + 1)
+        board = Thud.Board.from_bytes(encoded)
+        self.assertEqual(board.to_bytes(), encoded)
+        self.assertEqual(board.zobrist, self.test_board.zobrist)
+        self.assertEqual((board.dwarves, board.trolls, board.blocked),
+                         (self.test_board.dwarves, self.test_board.trolls, self.test_board.blocked))
+        self.assertEqual(board.get_piece(3, 5).id, self.test_board.get_piece(3, 5).id)
+        self.assertEqual(len(board.units), 39)
+
+    def test_from_bytes_rejects_unknown_format(self):
+        encoded = bytearray(self.test_board.to_bytes())
+        encoded[0] = Thud.BOARD_FORMAT_VERSION + 1
+        self.assertRaises(ValueError, Thud.Board.from_bytes, bytes(encoded))
+        self.assertRaises(ValueError, Thud.Board.from_bytes, self.test_board.to_bytes()[:-1])
+
+    def test_initial_occupancy(self):
+        self.assertEqual(bin(self.test_board.dwarves).count('1'), 32)
+        self.assertEqual(bin(self.test_board.trolls).count('1'), 8)
+        self.assertTrue(self.test_board.is_blocked(7, 7))
+        self.assertTrue(self.test_board.is_blocked(0, 0))
+        self.assertTrue(self.test_board.is_dwarf(5, 0))
+        self.assertTrue(self.test_board.is_troll(6, 6))
+        self.assertTrue(self.test_board.is_open(4, 7))
+
+    def test_occupancy_matches_squares(self):
+        test_dwarf = self.test_board.get_piece(5, 0)
+        self.test_board.move_piece_on_board(test_dwarf, 5, 3)
+        test_dwarf.move((5, 3))
+        self.test_board.capture_piece(self.test_board.get_piece(6, 6))
+        dwarves, trolls, blocked = self.test_board.dwarves, self.test_board.trolls, self.test_board.blocked
+        self.test_board.rebuild_occupancy()
+        self.assertEqual((dwarves, trolls, blocked),
+                         (self.test_board.dwarves, self.test_board.trolls, self.test_board.blocked))
+        self.assertTrue(self.test_board.is_open(5, 0))
+        self.assertTrue(self.test_board.is_dwarf(5, 3))
+        self.assertTrue(self.test_board.is_open(6, 6))
+
+    def test_zobrist_updates_incrementally(self):
+        self.assertNotEqual(self.test_board.zobrist, 0)
+        test_dwarf = self.test_board.get_piece(5, 0)
+        self.test_board.move_piece_on_board(test_dwarf, 5, 3)
+        test_dwarf.move((5, 3))
+        self.test_board.capture_piece(self.test_board.get_piece(6, 6))
+        zobrist = self.test_board.zobrist
+        self.test_board.rebuild_occupancy()
+        self.assertEqual(zobrist, self.test_board.zobrist)
+        self.assertNotEqual(zobrist, Thud.Board().zobrist)
+
+    def test_zobrist_same_for_every_board(self):
+        self.assertEqual(self.test_board.zobrist, Thud.Board().zobrist)
+
     def test_generate_piece_id(self):
         self.assertEqual(self.test_board.generate_piece_id(), 41)
         self.assertEqual(self.test_board.generate_piece_id(), 42)
@@ -104,8 +174,12 @@ class GameManagerTest(unittest.TestCase):
             self.message = message
             return True
 
+        def send_update(self, message):
+            self.message = json.loads(message)
+            return True
+
     def setUp(self):
-        self.test_game_manager = Thud.GameManager()
+        self.test_game_manager = Thud.GameManager(':memory:')
         self.game_token, self.player_one_token, self.player_two_token = self.test_game_manager.start_game(
             'test_one', 'test_two'
         )
@@ -133,6 +207,300 @@ class GameManagerTest(unittest.TestCase):
     def get_unit_helper(self, x, y):
         return self.test_game_manager.active_games[self.game_token].board.get_piece(x, y)
 
+    def test_save_appends_moves(self):
+        game = self.test_game_manager.active_games[self.game_token]
+        self.assertEqual(game.saved_moves, 0)
+        self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 1]))
+        self.assertEqual(game.saved_moves, 1)
+        connection = self.test_game_manager.storage.connection()
+        self.assertEqual(connection.execute("SELECT COUNT(*) FROM moves").fetchone()[0], 1)
+        self.assertEqual(connection.execute("SELECT move_number FROM snapshots").fetchone()[0], 0)
+
+    def test_load_replays_moves(self):
+        game = self.test_game_manager.active_games[self.game_token]
+        generator = random.Random(5)
+        for turn in range(Thud.SNAPSHOT_INTERVAL + 9):
+            moves = game.legal_moves()
+            captures = [move for move in moves if move[2]]
+            start, destination, targets = generator.choice(captures or moves)
+            self.assertTrue(self.test_game_manager.process_move({"game": self.game_token,
+                                                                 "player": game.side_to_move().token,
+                                                                 "start": list(start),
+                                                                 "destination": list(destination)}))
+        snapshot_moves = self.test_game_manager.storage.connection().execute(
+            "SELECT move_number FROM snapshots").fetchone()[0]
+        self.assertEqual(snapshot_moves, Thud.SNAPSHOT_INTERVAL)
+        self.assertTrue(any(game.capture_history))
+        del self.test_game_manager.active_games[self.game_token]
+        self.assertTrue(self.test_game_manager.load_game(self.game_token))
+        loaded = self.test_game_manager.active_games[self.game_token]
+        self.assertEqual(loaded.export_position(), game.export_position())
+        self.assertEqual(len(loaded.move_history), len(game.move_history))
+        self.assertEqual(loaded.capture_history, game.capture_history)
+        self.assertEqual(loaded.player_one.token, game.player_one.token)
+        self.assertEqual(sorted((unit.id, unit.x, unit.y) for unit in loaded.board.units if unit.status == 'Alive'),
+                         sorted((unit.id, unit.x, unit.y) for unit in game.board.units if unit.status == 'Alive'))
+
+    def test_batched_saves(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=3)
+        game_token, player_one_token, player_two_token = game_manager.start_game('test_one', 'test_two')
+        game = game_manager.active_games[game_token]
+        self.assertTrue(game_manager.process_move({"game": game_token, "player": player_one_token,
+                                                   "start": [6, 0], "destination": [6, 1]}))
+        self.assertIsNone(game_manager.storage.load_game(game_token))
+        self.assertEqual(game_manager.dirty_games, {game_token})
+        self.assertTrue(game_manager.process_move({"game": game_token, "player": player_two_token,
+                                                   "start": [6, 6], "destination": [5, 5]}))
+        self.assertEqual(game_manager.dirty_games, set())
+        self.assertEqual(game.saved_moves, 2)
+        self.assertEqual(len(game_manager.storage.load_game(game_token)[2]), 2)
+
+    def test_flush_interval(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=100, flush_ms=0)
+        game_token, player_one_token, player_two_token = game_manager.start_game('test_one', 'test_two')
+        self.assertEqual(game_manager.dirty_games, set())
+        self.assertEqual(game_manager.active_games[game_token].saved_moves, 0)
+
+    def test_flush_on_shutdown_and_end(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=100)
+        game_token, player_one_token, player_two_token = game_manager.start_game('test_one', 'test_two')
+        second_token = game_manager.start_game('test_one', 'test_two')[0]
+        self.assertTrue(game_manager.end_game(game_token, player_one_token, player_two_token))
+        self.assertIsNotNone(game_manager.storage.load_game(game_token))
+        self.assertIsNone(game_manager.storage.load_game(second_token))
+        self.assertEqual(game_manager.flush(), 1)
+        self.assertIsNotNone(game_manager.storage.load_game(second_token))
+        self.assertEqual(game_manager.flush(), 0)
+
+    def test_ended_game_stays_ended(self):
+        self.assertTrue(self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 1])))
+        self.assertTrue(self.test_game_manager.end_game(self.game_token, self.player_one_token, self.player_two_token))
+        self.assertIsNone(self.test_game_manager.active_games.peek(self.game_token))
+        self.assertFalse(self.test_game_manager.process_move(self.troll_move_helper([6, 6], [5, 5])))
+        game = self.test_game_manager.active_games[self.game_token]
+        self.assertEqual((game.status, game.winner), ('Finished', None))
+        self.assertEqual(len(game.move_history), 1)
+
+    def test_save_game_counts_changes(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=3)
+        game_token, player_one_token, player_two_token = game_manager.start_game('test_one', 'test_two')
+        other_token = game_manager.start_game('test_one', 'test_two')[0]
+        self.assertEqual(game_manager.pending_changes, 2)
+        game_manager.save_game(game_token)
+        self.assertEqual(game_manager.pending_changes, 1)
+        self.assertTrue(game_manager.process_move({"game": game_token, "player": player_one_token,
+                                                   "start": [6, 0], "destination": [6, 1]}))
+        # two changes waiting, one short of a flush
+        self.assertEqual(game_manager.dirty_games, {game_token, other_token})
+        game_manager.save_game(game_token)
+        game_manager.save_game(other_token)
+        self.assertEqual((game_manager.pending_changes, game_manager.oldest_change), (0, None))
+
+    def test_failed_flush_keeps_games_queued(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=100)
+        game_token = game_manager.start_game('test_one', 'test_two')[0]
+        with unittest.mock.patch.object(game_manager.storage, 'save_games', side_effect=sqlite3.OperationalError):
+            self.assertRaises(sqlite3.OperationalError, game_manager.flush)
+        self.assertEqual(game_manager.dirty_games, {game_token})
+        self.assertEqual(game_manager.pending_changes, 1)
+        self.assertEqual(game_manager.flush(), 1)
+
+    def test_load_json_snapshot(self):
+        game = self.test_game_manager.active_games[self.game_token]
+        game.board.move_piece_on_board(game.board.get_piece(0, 5), 3, 5)
+        pieces = json.dumps(dict((unit.id, {"move_history": unit.moves, "status": unit.status})
+                                 for unit in game.board.units))
+        board = json.dumps(self.test_game_manager.report_game_state(self.game_token))
+        self.test_game_manager.storage.save_game(self.game_token, snapshot=(0, pieces, board))
+        self.assertTrue(self.test_game_manager.load_game(self.game_token))
+        loaded = self.test_game_manager.active_games[self.game_token]
+        self.assertEqual(loaded.board.to_bytes(), game.board.to_bytes())
+
+    def test_compact_snapshot(self):
+        pieces, board = self.test_game_manager.storage.connection().execute(
+            "SELECT pieces, board FROM snapshots").fetchone()
+        self.assertEqual(board, self.test_game_manager.report_compact_state(self.game_token))
+        self.assertEqual(len(json.loads(pieces)), 40)
+
+    def test_reload_keeps_piece_history(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=1000)
+        game_token = game_manager.start_game('one', 'two')[0]
+        game = game_manager.active_games[game_token]
+        generator = random.Random(1247)
+        for turn in range(40):
+            moves = game.legal_moves()
+            captures = [move for move in moves if move[2]]
+            start, destination, targets = generator.choice(captures or moves)
+            game.execute_move(game.side_to_move().token, start, destination)
+        game_manager.flush()
+        game_manager.active_games.expire(game_token)
+        loaded = game_manager.active_games[game_token]
+
+        def units(board):
+            return sorted((unit.id, unit.type, unit.status, [tuple(square) for square in unit.moves])
+                          for unit in board.units)
+        self.assertTrue(any(unit.status != 'Alive' for unit in game.board.units))
+        self.assertEqual(units(loaded.board), units(game.board))
+        self.assertEqual(len(loaded.board.units), 40)
+
+    def test_active_games_evicts_least_recently_used(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=100, max_active_games=2)
+        first = game_manager.start_game('one', 'two')[0]
+        second = game_manager.start_game('one', 'two')[0]
+        self.assertTrue(second in game_manager.active_games)
+        third = game_manager.start_game('one', 'two')[0]
+        self.assertEqual(len(game_manager.active_games), 2)
+        self.assertIsNone(game_manager.active_games.peek(first))
+        self.assertIsNotNone(game_manager.storage.load_game(first))
+        self.assertEqual(game_manager.dirty_games, {second, third})
+        self.assertEqual(game_manager.active_games.stats()["evictions"], 1)
+
+    def test_active_games_loads_on_miss(self):
+        player_one_token = self.test_game_manager.active_games[self.game_token].player_one.token
+        del self.test_game_manager.active_games[self.game_token]
+        self.assertTrue(self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 1])))
+        self.assertEqual(self.test_game_manager.active_games[self.game_token].player_one.token, player_one_token)
+        stats = self.test_game_manager.active_games.stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertTrue(stats["hits"] >= 1)
+        self.assertFalse('missing_game' in self.test_game_manager.active_games)
+        self.assertRaises(KeyError, lambda: self.test_game_manager.active_games['missing_game'])
+
+    def test_restarted_manager_serves_saved_games(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'games.db')
+            game_manager = Thud.GameManager(path, flush_changes=100)
+            game_token, player_one_token, player_two_token = game_manager.start_game('one', 'two')
+            self.assertTrue(game_manager.process_move({"game": game_token, "player": player_one_token,
+                                                       "start": [6, 0], "destination": [6, 1]}))
+            game_manager.shutdown()
+            restarted = Thud.GameManager(path)
+            try:
+                self.assertTrue(restarted.process_move({"game": game_token, "player": player_two_token,
+                                                        "start": [6, 6], "destination": [5, 5]}))
+                self.assertEqual(len(restarted.active_games[game_token].move_history), 2)
+                self.assertEqual(restarted.start_game('one', 'two')[0], 'onetwo2')
+            finally:
+                restarted.shutdown()
+
+    def test_clear_old_games(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=100)
+        game_token = game_manager.start_game('one', 'two')[0]
+        later_token = game_manager.start_game('one', 'two')[0]
+        now = time.time()
+        game_manager.timers.schedule(('idle', later_token), now + Thud.IDLE_TIMEOUT + 60)
+        self.assertEqual(game_manager.clear_old_games(now + 60), [])
+        self.assertEqual(game_manager.clear_old_games(now + Thud.IDLE_TIMEOUT + 2), [('idle', game_token)])
+        self.assertIsNone(game_manager.active_games.peek(game_token))
+        self.assertIsNotNone(game_manager.active_games.peek(later_token))
+        self.assertIsNotNone(game_manager.storage.load_game(game_token))
+        self.assertEqual(game_manager.active_games.stats()["expirations"], 1)
+
+    def test_reload_keeps_bots(self):
+        data = self.test_game_manager.process_start({"player_one": "Will",
+                                                     "player_two": {"bot": "alphabeta", "ms": 50}})
+        self.assertTrue(self.test_game_manager.active_games.expire(data["game"]))
+        game = self.test_game_manager.active_games[data["game"]]
+        self.assertIsNone(game.player_one.bot)
+        self.assertEqual(game.player_two.bot.settings, {"bot": "alphabeta", "ms": 50})
+        self.assertTrue(self.test_game_manager.process_move({"game": data["game"], "player": data["player_one"],
+                                                             "start": [5, 0], "destination": [5, 1]}))
+        self.assertEqual(len(game.move_history), 2)
+
+    def test_connected_games_stay_in_memory(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=100, max_active_games=1)
+        game_manager.add_match_player("Will", self.socket_one)
+        game_manager.add_match_player("Tom", self.socket_two)
+        game_token = game_manager.process_match_start("Tom", "Will")["game"]
+        other_token = game_manager.start_game('one', 'two')[0]
+        self.assertIsNotNone(game_manager.active_games.peek(game_token))
+        self.assertIsNotNone(game_manager.active_games.peek(other_token))
+        game_manager.clear_old_games(time.time() + Thud.IDLE_TIMEOUT + 2)
+        self.assertIsNotNone(game_manager.active_games.peek(game_token))
+        game_manager.remove_player_from_server("Will", self.socket_one)
+        game_manager.remove_player_from_server("Tom", self.socket_two)
+        game = game_manager.active_games.peek(game_token)
+        self.assertEqual((game.player_one.websocket, game.player_two.websocket), (None, None))
+        game_manager.clear_old_games(time.time() + 2 * Thud.IDLE_TIMEOUT + 4)
+        self.assertIsNone(game_manager.active_games.peek(game_token))
+
+    def test_flag_fall(self):
+        data = self.test_game_manager.process_start({"player_one": "one", "player_two": "two", "clock_ms": 60000})
+        game = self.test_game_manager.active_games[data["game"]]
+        self.assertTrue(self.test_game_manager.process_move({"game": data["game"], "player": data["player_one"],
+                                                             "start": [6, 0], "destination": [6, 1]}))
+        self.assertTrue(game.player_one.clock_ms <= 60000)
+        status = self.test_game_manager.process_status({"game": data["game"]})
+        self.assertEqual((status["status"], status["to_move"]), ('Active', 'Troll'))
+        self.assertEqual(set(status["clocks"]), {'Dwarf', 'Troll'})
+        self.assertEqual(self.test_game_manager.clear_old_games(time.time() + 30), [])
+        self.assertEqual(self.test_game_manager.clear_old_games(time.time() + 62), [('clock', data["game"])])
+        self.assertEqual((game.status, game.winner), ('Finished', 'Dwarf'))
+        self.assertEqual(game.legal_moves(), [])
+        self.assertFalse(self.test_game_manager.process_move({"game": data["game"], "player": data["player_two"],
+                                                              "start": [6, 6], "destination": [5, 5]}))
+        del self.test_game_manager.active_games[data["game"]]
+        self.assertEqual(self.test_game_manager.process_status({"game": data["game"]})["winner"], 'Dwarf')
+
+    def test_reload_keeps_clocks(self):
+        data = self.test_game_manager.process_start({"player_one": "one", "player_two": "two", "clock_ms": 60000})
+        self.assertTrue(self.test_game_manager.process_move({"game": data["game"], "player": data["player_one"],
+                                                             "start": [6, 0], "destination": [6, 1]}))
+        game = self.test_game_manager.active_games[data["game"]]
+        clocks, turn_started = (game.player_one.clock_ms, game.player_two.clock_ms), game.turn_started
+        self.assertTrue(self.test_game_manager.active_games.expire(data["game"]))
+        self.test_game_manager.timers.cancel(('clock', data["game"]))
+        game = self.test_game_manager.active_games[data["game"]]
+        self.assertEqual((game.player_one.clock_ms, game.player_two.clock_ms), clocks)
+        self.assertEqual(game.turn_started, turn_started)
+        self.assertEqual(self.test_game_manager.clear_old_games(time.time() + 62), [('clock', data["game"])])
+        self.assertEqual((game.status, game.winner), ('Finished', 'Dwarf'))
+
+    def test_late_move_loses_on_time(self):
+        data = self.test_game_manager.process_start({"player_one": "one", "player_two": "two", "clock_ms": 1000})
+        self.test_game_manager.active_games[data["game"]].turn_started -= 2
+        self.assertFalse(self.test_game_manager.process_move({"game": data["game"], "player": data["player_one"],
+                                                              "start": [6, 0], "destination": [6, 1]}))
+        self.assertEqual(self.test_game_manager.process_status({"game": data["game"]})["winner"], 'Troll')
+
+    def test_find_games(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=100)
+        finished = game_manager.start_game('one', 'two')[0]
+        active = game_manager.start_game('two', 'three')[0]
+        game_manager.active_games[finished].finish('Dwarf')
+        game_manager.mark_dirty(finished)
+        listing = game_manager.player_active_games('two')
+        self.assertEqual([game["game"] for game in listing["games"]], [active])
+        self.assertEqual(listing["games"][0]["player_one"], 'two')
+        self.assertFalse(any('token' in key for key in listing["games"][0]))
+        self.assertIsNone(listing["next"])
+        self.assertEqual([game["game"] for game in game_manager.recent_finished_games()["games"]], [finished])
+        first_page = game_manager.process_games({"player": "two", "limit": 1})
+        self.assertEqual(len(first_page["games"]), 1)
+        second_page = game_manager.process_games({"player": "two", "limit": 1, "before": first_page["next"]})
+        self.assertEqual(len(second_page["games"]), 1)
+        self.assertNotEqual(first_page["games"][0]["game"], second_page["games"][0]["game"])
+        self.assertEqual(game_manager.process_games({"player": "nobody"}), {"games": [], "next": None})
+
+    def test_game_tokens_for_many_rematches(self):
+        connection = self.test_game_manager.storage.connection()
+        with connection:
+            connection.executemany("INSERT INTO games (gametoken, player_one_name, player_two_name) VALUES (?, ?, ?)",
+                                   [('onetwo{}'.format(number), 'one', 'two') for number in range(1, 3001)])
+        self.assertEqual(self.test_game_manager.start_game('one', 'two')[0], 'onetwo3001')
+        self.assertEqual(self.test_game_manager.start_game('one', 'two')[0], 'onetwo3002')
+
+    def test_game_tokens_skip_taken_tokens(self):
+        self.assertEqual(self.test_game_manager.storage.next_game_number('ab'), 1)
+        connection = self.test_game_manager.storage.connection()
+        with connection:
+            connection.execute("UPDATE game_counters SET last_game = 10 WHERE prefix = 'ab'")
+        self.assertEqual(self.test_game_manager.start_game('a', 'b1')[0], 'ab11')
+        self.assertEqual(self.test_game_manager.start_game('a', 'b')[0], 'ab12')
+
+    def test_load_unsaved_game(self):
+        self.assertFalse(self.test_game_manager.load_game('never_saved'))
+
     def test_create_identical_game_names(self):
         game_token_2, player_one_token_2, player_two_token_2 = self.test_game_manager.start_game(
             'test_one', 'test_two'
@@ -267,9 +635,78 @@ class GameManagerTest(unittest.TestCase):
                          [(8, 9)])
         self.array_data_helper(self.test_game_manager.report_game_state(self.game_token), board_state)
 
+    def test_process_moves(self):
+        moves = self.test_game_manager.process_moves({"game": self.game_token})
+        self.assertTrue({"start": (6, 0), "destination": (6, 5), "captures": []} in moves)
+        self.assertTrue(all(move["start"] != (6, 6) for move in moves))
+
+    def test_process_moves_single_piece_with_captures(self):
+        self.assertTrue(self.test_game_manager.process_move(self.dwarf_move_helper((6, 0), (6, 4))))
+        moves = self.test_game_manager.process_moves({"game": self.game_token, "player": self.player_two_token,
+                                                      "start": [6, 6]})
+        self.assertTrue({"start": (6, 6), "destination": (6, 5), "captures": [(6, 4)]} in moves)
+        self.assertTrue(all(move["start"] == (6, 6) for move in moves))
+
+    def test_process_moves_wrong_player(self):
+        self.assertEqual(self.test_game_manager.process_moves({"game": self.game_token,
+                                                               "player": self.player_two_token}), [])
+
+    def test_process_moves_failure_bad_game_token(self):
+        self.assertFalse(self.test_game_manager.process_moves({"game": "badtoken"}))
+
+    def test_malformed_squares(self):
+        for square in ("ab", [1], [1, 2, 3]):
+            response = self.test_game_manager.process_moves({"game": self.game_token, "start": square})
+            self.assertTrue(response.startswith("Bad JSON data"))
+        for square in ("ab", [1], [1, 2, 3], None):
+            self.assertTrue(self.test_game_manager.process_move(self.dwarf_move_helper(square, [6, 5]))
+                            .startswith("Bad JSON data"))
+            self.assertTrue(self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], square))
+                            .startswith("Bad JSON data"))
+
+    def test_process_socket_message_moves(self):
+        action, moves = self.test_game_manager.process_socket_message(["moves", {"game": self.game_token,
+                                                                                 "start": [5, 0]}], "test_one")
+        self.assertEqual(action, "moves")
+        self.assertTrue({"start": (5, 0), "destination": (5, 13), "captures": []} in moves)
+
+    def test_process_start_bot_opponent(self):
+        data = self.test_game_manager.process_start({"player_one": "Will",
+                                                     "player_two": {"bot": "alphabeta", "ms": 50}})
+        game = self.test_game_manager.active_games[data["game"]]
+        self.assertEqual(game.player_two.name, "alphabeta")
+        self.assertEqual(game.move_history, [])
+        self.assertTrue(self.test_game_manager.process_move({"game": data["game"], "player": data["player_one"],
+                                                             "start": [5, 0], "destination": [5, 1]}))
+        # the bot answers straight away with a troll move
+        self.assertEqual(len(game.move_history), 2)
+        self.assertEqual(game.side_to_move(), game.player_one)
+
+    def test_process_start_bot_moves_first(self):
+        data = self.test_game_manager.process_start({"player_one": {"bot": "alphabeta", "ms": 50},
+                                                     "player_two": "Tom"})
+        game = self.test_game_manager.active_games[data["game"]]
+        self.assertEqual(len(game.move_history), 1)
+
+    def test_process_start_unknown_bot(self):
+        self.assertEqual(self.test_game_manager.process_start({"player_one": "Will",
+                                                               "player_two": {"bot": "nobody"}}), "Bad JSON data.")
+
+    def test_process_start_bad_options(self):
+        games = len(self.test_game_manager.active_games)
+        for start_data in ({"player_one": "Will", "player_two": {"bot": "alphabeta", "ms": "fast"}},
+                           {"player_one": "Will", "player_two": {"bot": "mcts", "workers": [2]}},
+                           {"player_one": "Will", "player_two": "Tom", "clock_ms": "soon"},
+                           {"player_one": "Will", "player_two": "Tom", "clock_ms": -5},
+                           {"player_one": ["Will"], "player_two": "Tom"},
+                           ["Will", "Tom"]):
+            self.assertEqual(self.test_game_manager.process_start(start_data), "Bad JSON data.")
+        self.assertEqual(len(self.test_game_manager.active_games), games)
+        self.assertFalse(self.test_game_manager.storage.game_exists("WillTom1"))
+
     def test_save_load(self):
         self.test_game = self.test_game_manager
-        
+
         initial = self.log_game()
 
         del self.test_game.active_games['test_onetest_two1']
@@ -280,42 +717,42 @@ class GameManagerTest(unittest.TestCase):
         self.player_one = self.test_game.active_games['test_onetest_two1'].player_one
         self.player_two = self.test_game.active_games['test_onetest_two1'].player_two
 
-        self.test_game.process_move({"game": 'test_onetest_two1', "player": self.player_one.token,
-                    "start": [3, 2], "destination": [3, 3]})
-        self.test_game.process_move({"game": 'test_onetest_two1', "player": self.player_two.token,
-                    "start": [6, 6], "destination": [5, 5]})
-        # Save this data, should be the same as move_load
-        load_check = self.log_game()
-        self.test_game.process_move({"game": 'test_onetest_two1', "player": self.player_one.token,
-                    "start": [0, 5], "destination": [2, 5]})
+        self.assertTrue(self.test_game.process_move({"game": 'test_onetest_two1', "player": self.player_one.token,
+                                                     "start": [3, 2], "destination": [3, 3]}))
+        self.assertTrue(self.test_game.process_move({"game": 'test_onetest_two1', "player": self.player_two.token,
+                                                     "start": [6, 6], "destination": [5, 5]}))
+        self.assertTrue(self.test_game.process_move({"game": 'test_onetest_two1', "player": self.player_one.token,
+                                                     "start": [0, 5], "destination": [2, 5]}))
+        three_moves = self.log_game()
+
+        # every move is saved as it's played, so reloading gives the game as it stands
+        del self.test_game.active_games['test_onetest_two1']
+        self.test_game.load_game('test_onetest_two1')
+
+        three_moves_load = self.log_game()
+
+        # taking a piece off the board directly isn't a move, so it isn't saved
         test_troll = self.test_game.active_games['test_onetest_two1'].board.get_piece(5, 5)
         self.test_game.active_games['test_onetest_two1'].board.capture_piece(test_troll)
 
-        first_move = self.log_game()
-
+        captured = self.log_game()
 
         del self.test_game.active_games['test_onetest_two1']
         self.test_game.load_game('test_onetest_two1')
 
-        first_move_load = self.log_game()
+        captured_load = self.log_game()
 
-        self.test_game.process_move({"game": 'test_onetest_two1', "player": self.player_one.token,
-                    "start": [3, 2], "destination": [3, 3]})
-        self.test_game.process_move({"game": 'test_onetest_two1', "player": self.player_two.token,
-                    "start": [6, 6], "destination": [5, 5]})
-        self.test_game.process_move({"game": 'test_onetest_two1', "player": self.player_one.token,
-                    "start": [0, 5], "destination": [2, 5]})
         test_troll = self.test_game.active_games['test_onetest_two1'].board.get_piece(5, 5)
         self.test_game.active_games['test_onetest_two1'].board.capture_piece(test_troll)
 
-        second_move = self.log_game()
-        for x in range(0, len(initial)):
-            self.assertTrue(initial[x] == ini_load[x])
-        for x in range(0, len(initial)):
-            self.assertTrue(load_check[x] == first_move_load[x])
-        for x in range(0, len(initial)):
-            self.assertTrue(first_move[x] == second_move[x])
-    
+        recaptured = self.log_game()
+
+        self.assertEqual(initial, ini_load)
+        self.assertEqual(three_moves, three_moves_load)
+        self.assertNotEqual(captured, three_moves)
+        self.assertEqual(captured_load, three_moves)
+        self.assertEqual(recaptured, captured)
+
     def log_game(self):
         # Saves game state
         game = self.test_game.active_games['test_onetest_two1']
@@ -341,8 +778,8 @@ class GameManagerTest(unittest.TestCase):
             self.assertTrue(player in ["Will", "Tom"])
 
     def test_add_player_to_server(self):
-        self.assertEqual(self.test_game_manager.add_player_to_server("Will", self.socket_one), [])
-        self.assertEqual(self.test_game_manager.add_player_to_server("Tom", self.socket_two), ["Will"])
+        self.assertEqual(self.test_game_manager.add_player_to_server("Will", self.socket_one), ([], 0))
+        self.assertEqual(self.test_game_manager.add_player_to_server("Tom", self.socket_two), (["Will"], 1))
 
     def test_assign_sockets_both_players(self):
         # mock including the sockets in the free players list
@@ -366,7 +803,9 @@ class GameManagerTest(unittest.TestCase):
         player_one_game = self.test_game_manager.active_games[player_one_game_token]
         self.assertEqual(player_one_response["game"], player_one_game_token)
         self.assertEqual(player_one_response["board"], self.test_game_manager.report_game_state(player_one_game_token))
-        self.assertEqual(player_one_response["player"], player_one_game.player_two.token)
+        will = player_one_game.player_one if player_one_game.player_one.name == "Will" else player_one_game.player_two
+        self.assertEqual(will.name, "Will")
+        self.assertEqual((player_one_response["player"], player_one_response["race"]), (will.token, will.race))
         self.assertTrue(player_one_response["race"] in ("Troll", "Dwarf"))
         player_two_response = self.socket_two.message["start"]
         player_two_game_token = player_two_response["game"]
@@ -377,6 +816,175 @@ class GameManagerTest(unittest.TestCase):
         self.assertTrue(player_two_response["race"] in ("Troll", "Dwarf"))
         self.assertFalse(player_one_response["race"] == player_two_response["race"])
 
+    def test_move_deltas(self):
+        game = self.test_game_manager.active_games[self.game_token]
+        sent = []
+        socket = unittest.mock.Mock(send_message=sent.append)
+        game.player_one.set_player_socket(socket)
+        game.player_two.set_player_socket(socket)
+        piece = game.board.get_piece(6, 0)
+        self.assertTrue(self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 5])))
+        self.assertEqual(sent, [["delta", {"game": self.game_token, "seq": 1, "piece": piece.id, "from": [6, 0],
+                                           "to": [6, 5], "captured": []}]] * 2)
+        self.assertEqual(json.dumps(sent[0]).count('{'), 1)
+        self.assertFalse(self.test_game_manager.process_move(self.dwarf_move_helper([6, 5], [6, 4])))
+        self.assertEqual(len(sent), 2)
+
+    def test_move_delta_captures(self):
+        game = self.test_game_manager.active_games[self.game_token]
+        self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 5]))
+        dwarf, troll = game.board.get_piece(6, 5), game.board.get_piece(6, 6)
+        self.assertEqual(self.test_game_manager.process_move(self.troll_move_helper([6, 6], [5, 5])), [(6, 5)])
+        self.assertEqual(self.test_game_manager.report_move(self.game_token),
+                         {"game": self.game_token, "seq": 2, "piece": troll.id, "from": [6, 6], "to": [5, 5],
+                          "captured": [dwarf.id]})
+
+    def test_report_game_json(self):
+        version, state = self.test_game_manager.report_game_json(self.game_token)
+        self.assertEqual(version, 0)
+        self.assertEqual(json.loads(state), self.test_game_manager.report_game_state(self.game_token))
+        self.assertIs(self.test_game_manager.report_game_json(self.game_token)[1], state)
+        self.assertFalse(self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 14])))
+        self.assertTrue(self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 5]), test=True))
+        self.assertIs(self.test_game_manager.report_game_json(self.game_token)[1], state)
+        self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 5]))
+        version, moved_state = self.test_game_manager.report_game_json(self.game_token)
+        self.assertEqual(version, 1)
+        self.assertEqual(json.loads(moved_state), self.test_game_manager.report_game_state(self.game_token))
+        self.assertNotEqual(moved_state, state)
+
+    def test_version_survives_reload(self):
+        self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 5]))
+        self.test_game_manager.save_game(self.game_token)
+        self.test_game_manager.active_games.expire(self.game_token)
+        self.assertEqual(self.test_game_manager.report_game_json(self.game_token)[0], 1)
+
+    def test_watchers(self):
+        watched = []
+        watcher = unittest.mock.Mock(send_update=watched.append)
+        other_watcher = unittest.mock.Mock(send_update=watched.append)
+        self.assertFalse(self.test_game_manager.add_watcher("missing", watcher))
+        snapshot = json.loads(self.test_game_manager.add_watcher(self.game_token, watcher))
+        self.assertEqual(snapshot, ["sync", self.test_game_manager.process_sync({"game": self.game_token})])
+        self.test_game_manager.add_watcher(self.game_token, other_watcher)
+        self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 5]))
+        self.assertEqual(len(watched), 2)
+        self.assertIs(watched[0], watched[1])
+        self.assertEqual(json.loads(watched[0]), ["delta", self.test_game_manager.report_move(self.game_token)])
+        self.test_game_manager.remove_watcher(self.game_token, watcher)
+        self.test_game_manager.remove_watcher(self.game_token, other_watcher)
+        self.assertEqual(self.test_game_manager.watchers, {})
+
+    def test_watched_games_stay_in_memory(self):
+        game_manager = Thud.GameManager(':memory:', flush_changes=100, max_active_games=1)
+        game_token, player_one_token, player_two_token = game_manager.start_game('one', 'two')
+        watched = []
+        watcher = unittest.mock.Mock(send_update=watched.append)
+        game_manager.add_watcher(game_token, watcher)
+        game_manager.start_game('three', 'four')
+        game_manager.clear_old_games(time.time() + Thud.IDLE_TIMEOUT + 2)
+        self.assertFalse(game_manager.active_games.expire(game_token))
+        self.assertIsNotNone(game_manager.active_games.peek(game_token))
+        self.assertTrue(game_manager.process_move({"game": game_token, "player": player_one_token,
+                                                   "start": [6, 0], "destination": [6, 5]}))
+        self.assertEqual(json.loads(watched[-1]), ["delta", game_manager.report_move(game_token)])
+        self.assertTrue(game_manager.end_game(game_token, player_one_token, player_two_token))
+        watcher.stop_watching.assert_called_once_with("Game ended.")
+        self.assertEqual(game_manager.watchers, {})
+
+    def test_queue_pairs_players(self):
+        self.test_game_manager.add_match_player("Will", self.socket_one)
+        self.test_game_manager.add_match_player("Tom", self.socket_two)
+        self.assertEqual(self.test_game_manager.process_socket_message(["queue", {}], "Will"),
+                         ["queue", {"queued": True, "rating": ThudMatchmaking.DEFAULT_RATING}])
+        action, start = self.test_game_manager.process_socket_message(["queue", {}], "Tom")
+        self.assertEqual(action, "start")
+        self.assertEqual(self.socket_one.message["start"]["game"], start["game"])
+        self.assertEqual(self.test_game_manager.free_players, {})
+        self.assertEqual(len(self.test_game_manager.match_queue), 0)
+
+    def test_queued_game_rates_players(self):
+        self.test_game_manager.add_match_player("Will", self.socket_one)
+        self.test_game_manager.add_match_player("Tom", self.socket_two)
+        self.test_game_manager.process_socket_message(["queue", {}], "Will")
+        action, start = self.test_game_manager.process_socket_message(["queue", {}], "Tom")
+        action, status = self.test_game_manager.process_socket_message(
+            ["resign", {"game": start["game"], "player": start["player"]}], "Tom")
+        self.assertEqual(action, "resign")
+        self.assertEqual(status["status"], 'Finished')
+        self.assertEqual(self.socket_one.message, ["resign", status])
+        ratings = self.test_game_manager.storage.load_ratings(['Will', 'Tom'])
+        self.assertEqual(ratings['Will'], (ThudMatchmaking.DEFAULT_RATING + ThudMatchmaking.K_FACTOR / 2, 1))
+        self.assertEqual(ratings['Tom'], (ThudMatchmaking.DEFAULT_RATING - ThudMatchmaking.K_FACTOR / 2, 1))
+        self.assertFalse(self.test_game_manager.process_resign({"game": start["game"],
+                                                                "player": self.socket_one.message[1]["winner"]}))
+
+    def test_queue_widens_window(self):
+        self.test_game_manager.storage.save_ratings([("Will", 1500, 10), ("Tom", 1750, 10)])
+        self.test_game_manager.add_match_player("Will", self.socket_one)
+        self.test_game_manager.add_match_player("Tom", self.socket_two)
+        self.test_game_manager.process_queue({}, "Will")
+        self.assertEqual(self.test_game_manager.process_queue({}, "Tom")[1]["rating"], 1750)
+        self.assertEqual(self.test_game_manager.match_queued_players(time.time() + 5), [])
+        games = self.test_game_manager.match_queued_players(time.time() + 30)
+        self.assertEqual(len(games), 1)
+        self.assertEqual(self.socket_one.message[1]["game"], games[0])
+        self.assertEqual(self.socket_two.message["start"]["game"], games[0])
+
+    def test_queue_leave(self):
+        self.assertEqual(self.test_game_manager.process_queue({}, "Will"), ["queue", False])
+        self.test_game_manager.add_match_player("Will", self.socket_one)
+        self.test_game_manager.process_queue({}, "Will")
+        self.assertEqual(self.test_game_manager.process_queue({"leave": True}, "Will")[1]["queued"], False)
+        self.test_game_manager.process_queue({}, "Will")
+        self.test_game_manager.remove_player_from_server("Will")
+        self.assertNotIn("Will", self.test_game_manager.match_queue)
+
+    def test_flag_fall_rates_players(self):
+        self.test_game_manager.start_clocks(self.game_token, 1000)
+        self.assertTrue(self.test_game_manager.flag_fall(self.game_token, time.time() + 2))
+        ratings = self.test_game_manager.storage.load_ratings(['test_one', 'test_two'])
+        self.assertEqual(ratings['test_two'], (ThudMatchmaking.DEFAULT_RATING + ThudMatchmaking.K_FACTOR / 2, 1))
+        self.assertEqual(ratings['test_one'], (ThudMatchmaking.DEFAULT_RATING - ThudMatchmaking.K_FACTOR / 2, 1))
+
+    def test_send_presence(self):
+        sent = []
+        watcher = unittest.mock.Mock(send_update=sent.append)
+        self.assertEqual(self.test_game_manager.add_player_to_server("Watcher", watcher), ([], 0))
+        self.test_game_manager.send_presence()
+        del sent[:]
+        self.test_game_manager.add_player_to_server("Will", self.socket_one)
+        self.test_game_manager.add_player_to_server("Tom", self.socket_two)
+        self.test_game_manager.remove_player_from_server("Tom")
+        self.assertEqual(sent, [])
+        changes = self.test_game_manager.send_presence()
+        self.assertEqual(changes, {"join": ["Will"], "leave": ["Tom"]})
+        self.assertEqual(sent, [json.dumps(["presence", changes])])
+        self.assertIsNone(self.test_game_manager.send_presence())
+
+    def test_lobby_pages(self):
+        for number in range(ThudPresence.LOBBY_PAGE + 5):
+            self.test_game_manager.add_match_player("player{}".format(number), self.socket_one)
+        first_page, cursor = self.test_game_manager.add_player_to_server("Will", self.socket_two)
+        self.assertEqual(len(first_page), ThudPresence.LOBBY_PAGE)
+        self.test_game_manager.remove_player_from_server(first_page[-1])
+        action, second_page, cursor = self.test_game_manager.process_socket_message(["lobby", {"after": cursor}],
+                                                                                    "Will")
+        self.assertEqual(action, "list")
+        self.assertEqual(second_page, ["player{}".format(number) for number in range(100, 105)] + ["Will"])
+        self.assertEqual(self.test_game_manager.process_socket_message(["lobby", {"after": cursor}], "Will"),
+                         ["list", [], cursor])
+        self.assertTrue(self.test_game_manager.process_socket_message(["lobby", {"after": "Will"}], "Will")
+                        .startswith("Bad JSON data"))
+
+    def test_process_sync(self):
+        self.test_game_manager.process_move(self.dwarf_move_helper([6, 0], [6, 5]))
+        action, sync = self.test_game_manager.process_socket_message(["sync", {"game": self.game_token}], "test_one")
+        self.assertEqual(action, "sync")
+        self.assertEqual(sync["seq"], 1)
+        self.assertEqual(sync["board"], self.test_game_manager.report_game_state(self.game_token))
+        self.assertFalse(self.test_game_manager.process_sync({"game": "missing"}))
+
 
 class GameTest(unittest.TestCase):
 
@@ -419,6 +1027,25 @@ class GameTest(unittest.TestCase):
         test_piece = self.test_game.board.get_piece(12, 3)
         self.assertFalse(self.test_game.validate_clear_path(test_piece, (2, 13)))
 
+    def test_rays_stop_at_board_edge(self):
+        east = Thud.DIRECTION_INDEX[(1, 0)]
+        self.assertEqual(len(Thud.RAYS[0][5][east]), 14)
+        self.assertEqual(Thud.RAYS[0][5][east][:2], ((1, 5), (2, 5)))
+        self.assertEqual(Thud.RAYS[4][1][Thud.DIRECTION_INDEX[(-1, -1)]], ())
+        self.assertEqual(Thud.RAYS[0][5][Thud.DIRECTION_INDEX[(-1, 0)]], ())
+        # the Thud stone stays in the ray, it's the occupancy check that stops pieces there
+        self.assertTrue((7, 7) in Thud.RAYS[7][0][Thud.DIRECTION_INDEX[(0, 1)]])
+
+    def test_find_line(self):
+        self.assertEqual(Thud.find_line(6, 6, 3, 3), (Thud.DIRECTION_INDEX[(-1, -1)], 3))
+        self.assertEqual(Thud.find_line(6, 6, 6, 10), (Thud.DIRECTION_INDEX[(0, 1)], 4))
+        self.assertIsNone(Thud.find_line(6, 6, 8, 7))
+        self.assertIsNone(Thud.find_line(6, 6, 6, 6))
+
+    def test_validate_clear_path_off_line_failure(self):
+        test_piece = self.test_game.board.get_piece(5, 0)
+        self.assertFalse(self.test_game.validate_clear_path(test_piece, (8, 1)))
+
     def test_validate_clear_path_to_troll_success(self):
         test_dwarf = self.test_game.board.get_piece(6, 0)
         test_troll = self.test_game.board.get_piece(6, 6)
@@ -685,6 +1312,112 @@ class GameTest(unittest.TestCase):
         self.test_game.execute_move(self.player_one, (0, 6), (4, 6))
         self.assertFalse(self.test_game.execute_move(self.player_two, (6, 6), (7, 7)))
 
+    def brute_force_moves_helper(self):
+        # probe every destination for every piece the same way the UI used to
+        player = self.test_game.side_to_move()
+        moves = set()
+        for unit in self.test_game.board.units:
+            if unit.status != 'Alive' or unit.type != player.race:
+                continue
+            start = (unit.x, unit.y)
+            for x in range(15):
+                for y in range(15):
+                    result = self.test_game.execute_move(player.token, start, (x, y), test=True)
+                    if result:
+                        captures = tuple(sorted(result)) if isinstance(result, list) else ()
+                        moves.add((start, (x, y), captures))
+        return moves
+
+    def legal_moves_helper(self, **kwargs):
+        return set((start, destination, tuple(sorted(captures)))
+                   for start, destination, captures in self.test_game.legal_moves(**kwargs))
+
+    def test_legal_moves_opening(self):
+        moves = self.test_game.legal_moves()
+        self.assertTrue(moves)
+        self.assertEqual(self.legal_moves_helper(), self.brute_force_moves_helper())
+
+    def test_legal_moves_match_validate_move(self):
+        random_moves = Thud.random.Random(602)
+        for turn in range(12):
+            moves = self.test_game.legal_moves()
+            self.assertEqual(self.legal_moves_helper(), self.brute_force_moves_helper())
+            # prefer captures so the position gets some tosses and shoves in it
+            captures = [move for move in moves if move[2]]
+            start, destination, expected = random_moves.choice(captures or moves)
+            result = self.test_game.execute_move(self.test_game.side_to_move().token, start, destination)
+            self.assertEqual(result, [tuple(square) for square in expected] if expected else True)
+
+    def test_legal_moves_dwarf_toss(self):
+        self.test_game.execute_move(self.player_one, (10, 13), (8, 13))
+        self.test_game.execute_move(self.player_two, (7, 8), (8, 9))
+        self.test_game.execute_move(self.player_one, (11, 12), (8, 12))
+        self.test_game.execute_move(self.player_two, (7, 6), (8, 5))
+        self.assertTrue(((8, 12), (8, 9), [(8, 9)]) in self.test_game.legal_moves(piece=(8, 12)))
+
+    def test_legal_moves_single_piece(self):
+        moves = self.test_game.legal_moves(piece=(5, 0))
+        self.assertTrue(moves)
+        self.assertTrue(all(start == (5, 0) for start, destination, captures in moves))
+        self.assertEqual(self.test_game.legal_moves(piece=(6, 6)), [])
+        self.assertEqual(self.test_game.legal_moves(piece=(7, 7)), [])
+
+    def test_legal_moves_wrong_player(self):
+        self.assertEqual(self.test_game.legal_moves(player_token=self.player_two), [])
+        self.assertTrue(self.test_game.legal_moves(player_token=self.player_one))
+
+    def test_position_hash_transposition(self):
+        other_game = Thud.Game('test_one', 'test_two')
+        self.test_game.execute_move(self.player_one, (5, 0), (5, 1))
+        self.test_game.execute_move(self.player_two, (6, 6), (5, 5))
+        self.test_game.execute_move(self.player_one, (9, 0), (9, 1))
+        other_game.execute_move(other_game.player_one.token, (9, 0), (9, 1))
+        other_game.execute_move(other_game.player_two.token, (6, 6), (5, 5))
+        self.assertNotEqual(self.test_game.position_hash, other_game.position_hash)
+        other_game.execute_move(other_game.player_one.token, (5, 0), (5, 1))
+        self.assertEqual(self.test_game.position_hash, other_game.position_hash)
+
+    def test_position_hash_side_to_move(self):
+        opening = self.test_game.position_hash
+        self.test_game.store_move((0, 0), (0, 0))
+        self.assertNotEqual(opening, self.test_game.position_hash)
+        self.assertEqual(opening ^ Thud.ZOBRIST_TROLL_TO_MOVE, self.test_game.position_hash)
+
+    def game_snapshot_helper(self):
+        board = self.test_game.board
+        pieces = [(unit.id, unit.type, unit.x, unit.y, unit.status, list(unit.moves)) for unit in board.units]
+        return (str(board.squares), board.dwarves, board.trolls, self.test_game.position_hash,
+                list(self.test_game.move_history), pieces)
+
+    def test_make_unmake_move_restores_position(self):
+        random_moves = Thud.random.Random(1247)
+        snapshots = []
+        undo_records = []
+        for turn in range(30):
+            moves = self.test_game.legal_moves()
+            captures = [move for move in moves if move[2]]
+            snapshots.append(self.game_snapshot_helper())
+            undo_records.append(self.test_game.make_move(random_moves.choice(captures or moves)))
+        self.assertTrue(any(undo[1] for undo in undo_records))
+        while undo_records:
+            self.test_game.unmake_move(undo_records.pop())
+            self.assertEqual(self.game_snapshot_helper(), snapshots.pop())
+
+    def test_make_move_dwarf_attack(self):
+        self.test_game.execute_move(self.player_one, (10, 13), (8, 13))
+        self.test_game.execute_move(self.player_two, (7, 8), (8, 9))
+        self.test_game.execute_move(self.player_one, (11, 12), (8, 12))
+        self.test_game.execute_move(self.player_two, (7, 6), (8, 5))
+        before = self.game_snapshot_helper()
+        target = self.test_game.board.get_piece(8, 9)
+        undo = self.test_game.make_move(((8, 12), (8, 9), [(8, 9)]))
+        self.assertEqual(target.status, 'Captured')
+        self.assertEqual(self.test_game.board.get_piece(8, 9).type, 'Dwarf')
+        self.test_game.unmake_move(undo)
+        self.assertIs(self.test_game.board.get_piece(8, 9), target)
+        self.assertEqual(target.status, 'Alive')
+        self.assertEqual(self.game_snapshot_helper(), before)
+
     def test_execute_move_test_move(self):
         self.test_game.execute_move(self.player_one, (6, 0), (6, 1), test=True)
         self.assertEqual(self.test_game.move_history, [])
@@ -696,6 +1429,494 @@ class GameTest(unittest.TestCase):
         self.assertEqual(self.test_game.move_history, moves)
 
 
+class AlphaBetaPlayerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_game = Thud.Game('test_one', 'test_two')
+        self.player_one = self.test_game.player_one.token
+        self.player_two = self.test_game.player_two.token
+
+    def test_evaluate_opening(self):
+        self.assertEqual(ThudAI.evaluate(self.test_game), 0)
+        self.test_game.board.capture_piece(self.test_game.board.get_piece(6, 6))
+        self.assertEqual(ThudAI.evaluate(self.test_game), 4)
+
+    def test_choose_move_takes_troll(self):
+        self.test_game.execute_move(self.player_one, (10, 13), (8, 13))
+        self.test_game.execute_move(self.player_two, (7, 8), (8, 9))
+        self.test_game.execute_move(self.player_one, (11, 12), (8, 12))
+        self.test_game.execute_move(self.player_two, (7, 6), (8, 5))
+        bot = ThudAI.AlphaBetaPlayer(ms=200, max_depth=2)
+        self.assertEqual(bot.choose_move(self.test_game), ((8, 12), (8, 9), [(8, 9)]))
+
+    def test_choose_move_leaves_game_unchanged(self):
+        position_hash = self.test_game.position_hash
+        move = ThudAI.AlphaBetaPlayer(ms=100).choose_move(self.test_game)
+        self.assertTrue(move in self.test_game.legal_moves())
+        self.assertEqual(position_hash, self.test_game.position_hash)
+        self.assertEqual(self.test_game.move_history, [])
+
+    def test_choose_move_time_budget(self):
+        bot = ThudAI.AlphaBetaPlayer(ms=100)
+        start = Thud.datetime.datetime.now()
+        bot.choose_move(self.test_game)
+        self.assertTrue(Thud.datetime.datetime.now() - start < Thud.datetime.timedelta(seconds=1))
+
+    def test_create_bot(self):
+        bot = ThudAI.create_bot({"bot": "alphabeta", "ms": 250})
+        self.assertEqual(bot.budget, 0.25)
+        self.assertEqual(ThudAI.create_bot({"bot": "alphabeta", "ms": 10 ** 9}).budget, ThudAI.MAX_MS / 1000.0)
+
+
+class MCTSPlayerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_game = Thud.Game('test_one', 'test_two')
+        self.player_one = self.test_game.player_one.token
+        self.player_two = self.test_game.player_two.token
+
+    def test_choose_move_takes_last_troll(self):
+        dwarves = Thud.SQUARE_BITS[8][12] | Thud.SQUARE_BITS[8][13] | Thud.SQUARE_BITS[8][14]
+        test_game = Thud.Game.from_position((dwarves, Thud.SQUARE_BITS[8][9], 'Dwarf'))
+        bot = ThudAI.MCTSPlayer(ms=300, seed=3)
+        self.assertEqual(bot.choose_move(test_game), ((8, 12), (8, 9), [(8, 9)]))
+        self.assertTrue(bot.rollouts > 0)
+
+    def test_choose_move_leaves_game_unchanged(self):
+        position_hash = self.test_game.position_hash
+        move = ThudAI.MCTSPlayer(ms=100, policy='random', seed=1).choose_move(self.test_game)
+        self.assertTrue(move in self.test_game.legal_moves())
+        self.assertEqual(position_hash, self.test_game.position_hash)
+        self.assertEqual(self.test_game.move_history, [])
+
+    @unittest.mock.patch.object(ThudAI, 'MAX_WORKERS', 2)
+    def test_root_parallel_search(self):
+        bot = ThudAI.MCTSPlayer(ms=100, workers=2, seed=5)
+        try:
+            self.assertTrue(bot.choose_move(self.test_game) in self.test_game.legal_moves())
+        finally:
+            bot.close()
+
+    @unittest.mock.patch.object(ThudAI, 'MAX_WORKERS', 2)
+    def test_create_bot(self):
+        bot = ThudAI.create_bot({"bot": "mcts", "ms": 250, "workers": 2, "policy": "random", "name": "Robot"})
+        self.assertEqual(bot.settings, {"bot": "mcts", "ms": 250, "workers": 2, "policy": "random"})
+        self.assertRaises(KeyError, ThudAI.create_bot, {"bot": "mcts", "policy": "cheating"})
+
+    def test_workers_capped(self):
+        self.assertEqual(ThudAI.create_bot({"bot": "mcts", "workers": 1000000}).workers, ThudAI.MAX_WORKERS)
+
+    @unittest.mock.patch.object(ThudAI, 'MAX_WORKERS', 2)
+    def test_bots_closed_with_game(self):
+        game_manager = Thud.GameManager(':memory:')
+        data = game_manager.process_start({"player_one": "Will", "player_two": {"bot": "mcts", "ms": 50, "workers": 2}})
+        bot = game_manager.active_games[data["game"]].player_two.bot
+        game_manager.process_move({"game": data["game"], "player": data["player_one"], "start": [5, 0],
+                                   "destination": [5, 1]})
+        self.assertIsNotNone(bot.executor)
+        game_manager.active_games.expire(data["game"])
+        self.assertIsNone(bot.executor)
+
+
+class EnginePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_game = Thud.Game('test_one', 'test_two')
+        self.test_game.execute_move(self.test_game.player_one.token, (5, 0), (5, 1))
+
+    def test_export_position_round_trip(self):
+        position = self.test_game.export_position()
+        copy = Thud.Game.from_position(position)
+        self.assertEqual(copy.position_hash, self.test_game.position_hash)
+        self.assertEqual(copy.export_position(), position)
+        self.assertEqual(sorted(copy.legal_moves()), sorted(self.test_game.legal_moves()))
+
+    def test_bot_move(self):
+        move = ThudWorkers.bot_move(self.test_game.export_position(), {"bot": "alphabeta", "ms": 50}, "game")
+        self.assertTrue(move in self.test_game.legal_moves())
+        self.assertEqual(len(ThudWorkers.worker_bots), 1)
+
+    @unittest.mock.patch.object(ThudAI, 'MAX_WORKERS', 4)
+    def test_worker_bots_search_alone(self):
+        bot = ThudWorkers.find_worker_bot({"bot": "mcts", "ms": 50, "workers": 4}, None)
+        self.assertEqual(bot.workers, 1)
+
+    def test_engine_pool(self):
+        engine_pool = ThudWorkers.EnginePool(workers=1)
+        try:
+            analysis = engine_pool.hint(self.test_game, 50).result(timeout=10)
+            self.assertTrue(tuple(analysis["move"]) in self.test_game.legal_moves())
+            self.assertTrue(analysis["depth"] >= 1)
+            results = [future.result(timeout=10) for future in engine_pool.analyse([self.test_game] * 2, 50)]
+            self.assertEqual(len(results), 2)
+        finally:
+            engine_pool.shutdown()
+
+    def test_apply_bot_move(self):
+        game_manager = Thud.GameManager(':memory:')
+        game_manager.inline_bots = False
+        data = game_manager.process_start({"player_one": "Will", "player_two": {"bot": "alphabeta", "ms": 50}})
+        self.assertTrue(game_manager.process_move({"game": data["game"], "player": data["player_one"],
+                                                   "start": [5, 0], "destination": [5, 1]}))
+        game = game_manager.active_games[data["game"]]
+        self.assertEqual(len(game.move_history), 1)
+        player = game_manager.bot_to_move(data["game"])
+        self.assertEqual(player, game.player_two)
+        move = ThudWorkers.bot_move(game.export_position(), player.bot.settings)
+        self.assertTrue(game_manager.apply_bot_move(data["game"], player, move))
+        self.assertIsNone(game_manager.bot_to_move(data["game"]))
+
+
+class SimulateTest(unittest.TestCase):
+
+    def test_play_game(self):
+        result = simulate.play_game('capture', seed=1, max_moves=400)
+        self.assertTrue(result["finished"])
+        self.assertTrue(result["moves"] > 0)
+        self.assertTrue(result["capture_moves"] <= result["dwarves_captured"] + result["trolls_captured"])
+
+    def test_play_game_move_limit(self):
+        result = simulate.play_game('random', seed=1, max_moves=10)
+        self.assertEqual(result["moves"], 10)
+        self.assertFalse(result["finished"])
+
+    def test_run_simulation(self):
+        report = simulate.run_simulation(4, workers=2, policy='random', max_moves=20)
+        self.assertEqual(report["games"], 4)
+        self.assertEqual(report["average_moves"], 20)
+        self.assertEqual(report["dwarves_ahead"] + report["trolls_ahead"] + report["level"], 4)
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_perft_depth_one(self):
+        game = Thud.Game('player_one', 'player_two')
+        self.assertEqual(benchmark.perft(game, 1), len(game.legal_moves()))
+
+    def test_perft_depth_two(self):
+        game = benchmark.saved_position('first move')
+        expected = 0
+        for move in game.legal_moves():
+            undo = game.make_move(move)
+            expected += len(game.legal_moves())
+            game.unmake_move(undo)
+        position = game.export_position()
+        self.assertEqual(benchmark.perft(game, 2), expected)
+        self.assertEqual(game.export_position(), position)
+
+    def test_saved_positions(self):
+        self.assertEqual(benchmark.saved_position('base state').side_to_move().race, 'Dwarf')
+        game = benchmark.saved_position('first move')
+        self.assertEqual(game.side_to_move().race, 'Troll')
+        self.assertEqual(bin(game.board.dwarves).count('1'), 32)
+        self.assertEqual(bin(game.board.trolls).count('1'), 8)
+
+    def test_compare(self):
+        baseline = {"perft": {"base state": {"1": {"nodes": 656}}},
+                    "timings": {"base state": {"legal_moves": {"per_call_us": 100.0}}}}
+        results = {"perft": {"base state": {"1": {"nodes": 656}}},
+                   "timings": {"base state": {"legal_moves": {"per_call_us": 110.0}}}}
+        self.assertEqual(benchmark.compare(results, baseline, 0.2), [])
+        results["timings"]["base state"]["legal_moves"]["per_call_us"] = 130.0
+        results["perft"]["base state"]["1"]["nodes"] = 655
+        self.assertEqual(len(benchmark.compare(results, baseline, 0.2)), 2)
+
+
+class TimingWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = ThudTimers.TimingWheel(tick_ms=1000, slots=4, levels=3, now=100)
+
+    def test_deadlines_fire_in_order(self):
+        self.wheel.schedule('late', 112.5)
+        self.wheel.schedule('soon', 102)
+        self.wheel.schedule('past', 50)
+        self.assertEqual(self.wheel.advance(101), ['past'])
+        self.assertEqual(self.wheel.advance(112), ['soon'])
+        self.assertEqual(self.wheel.advance(113), ['late'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel_and_reschedule(self):
+        self.wheel.schedule('game', 103)
+        self.wheel.schedule('game', 130)
+        self.assertEqual(self.wheel.deadline('game'), 130)
+        self.assertEqual(self.wheel.advance(129), [])
+        self.assertTrue(self.wheel.cancel('game'))
+        self.assertFalse(self.wheel.cancel('game'))
+        self.assertEqual(self.wheel.advance(200), [])
+
+    def test_matches_sorted_deadlines(self):
+        generator = random.Random(3)
+        deadlines = dict((key, 100 + generator.uniform(0, 300)) for key in range(200))
+        for key, deadline in deadlines.items():
+            self.wheel.schedule(key, deadline)
+        fired = []
+        for now in range(101, 402):
+            for key in self.wheel.advance(now):
+                self.assertTrue(deadlines[key] <= now < deadlines[key] + 1)
+                fired.append(key)
+        self.assertEqual(sorted(fired), sorted(deadlines))
+
+
+class MatchQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = ThudMatchmaking.MatchQueue(bucket_width=50, window=100, growth=10, max_window=400)
+
+    def test_rate_game(self):
+        self.assertEqual(ThudMatchmaking.rate_game(1500, 1500, 32), (1516, 1484))
+        winner, loser = ThudMatchmaking.rate_game(1200, 1600, 32)
+        self.assertTrue(winner - 1200 > 16)
+        self.assertAlmostEqual(winner + loser, 2800)
+
+    def test_join_pairs_within_window(self):
+        self.assertIsNone(self.queue.join('one', 1500, now=0))
+        self.assertIsNone(self.queue.join('far', 1700, now=0))
+        self.assertEqual(self.queue.join('two', 1560, now=0), 'one')
+        self.assertEqual(list(self.queue.waiting), ['far'])
+
+    def test_nearest_bucket_first(self):
+        self.queue.join('low', 1405, now=0)
+        self.queue.join('close', 1530, now=1)
+        self.assertEqual(self.queue.join('new', 1500, now=2), 'close')
+
+    def test_window_widens(self):
+        self.queue.join('one', 1500, now=0)
+        self.queue.join('two', 1750, now=0)
+        self.assertEqual(self.queue.match_waiting(now=10), [])
+        self.assertEqual(self.queue.match_waiting(now=15), [('one', 'two')])
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.buckets, {})
+
+    def test_window_capped(self):
+        self.queue.join('one', 1000, now=0)
+        self.queue.join('two', 2000, now=0)
+        self.assertEqual(self.queue.match_waiting(now=10000), [])
+
+    def test_leave(self):
+        self.queue.join('one', 1500, now=0)
+        self.assertTrue(self.queue.leave('one'))
+        self.assertFalse(self.queue.leave('one'))
+        self.assertIsNone(self.queue.join('two', 1500, now=0))
+
+
+class PresenceTest(unittest.TestCase):
+
+    def test_page_after_changes(self):
+        presence = ThudPresence.Presence()
+        for name in 'abcde':
+            presence.join(name)
+        names, cursor = presence.page(limit=2)
+        self.assertEqual(names, ['a', 'b'])
+        presence.leave('b')
+        presence.leave('c')
+        presence.join('b')
+        # b rejoined after the first page, so carries on after d and e rather than being skipped
+        names, cursor = presence.page(cursor, limit=2)
+        self.assertEqual(names, ['d', 'e'])
+        self.assertEqual(presence.page(cursor, limit=2), (['b'], 6))
+        self.assertEqual(presence.page(6), ([], 6))
+        self.assertEqual(presence.page(1), (['d', 'e', 'b'], 6))
+
+    def test_latest_change_only(self):
+        presence = ThudPresence.Presence()
+        presence.join('a')
+        presence.take_changes()
+        presence.leave('a')
+        presence.join('a')
+        presence.join('b')
+        presence.leave('b')
+        self.assertEqual(presence.take_changes(), {"join": ['a'], "leave": ['b']})
+        self.assertIsNone(presence.take_changes())
+        self.assertFalse(presence.leave('b'))
+
+    def test_compaction(self):
+        presence = ThudPresence.Presence()
+        for number in range(500):
+            presence.join(number)
+        for number in range(400):
+            presence.leave(number)
+        self.assertTrue(len(presence.order) <= 2 * len(presence) + ThudPresence.LOBBY_PAGE)
+        self.assertEqual(presence.page(limit=1000), (list(range(400, 500)), 500))
+
+
+class GameStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = ThudStorage.GameStorage(os.path.join(self.directory.name, 'games.db'))
+        self.header = ('game1', 'one', 'token1', 'Dwarf', 'two', 'token2', 'Troll', 'now', 'Active', None, None)
+        self.snapshot = (0, '{}', '{}')
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    def test_connection_setup(self):
+        connection = self.storage.connection()
+        self.assertIs(self.storage.connection(), connection)
+        self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        self.assertEqual(connection.execute("PRAGMA synchronous").fetchone()[0], 1)
+        self.assertEqual(connection.execute("PRAGMA user_version").fetchone()[0], len(ThudStorage.MIGRATIONS))
+
+    def test_failed_migration_rolls_back(self):
+        path = os.path.join(self.directory.name, 'failed.db')
+
+        def failing_migration(connection):
+            connection.execute("CREATE TABLE half_done (name text)")
+            raise sqlite3.OperationalError("migration failed")
+
+        with unittest.mock.patch.object(ThudStorage, 'MIGRATIONS', ThudStorage.MIGRATIONS + [failing_migration]):
+            self.assertRaises(sqlite3.OperationalError, ThudStorage.GameStorage, path)
+        storage = ThudStorage.GameStorage(path)
+        try:
+            connection = storage.connection()
+            self.assertEqual(connection.execute("PRAGMA user_version").fetchone()[0], len(ThudStorage.MIGRATIONS))
+            self.assertIsNone(connection.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone())
+        finally:
+            storage.close()
+
+    def test_connection_per_thread(self):
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(self.storage.connection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], self.storage.connection())
+        self.assertEqual(len(self.storage.connections), 2)
+
+    def test_save_load(self):
+        self.assertIsNone(self.storage.load_game('game1'))
+        self.storage.save_game('game1', self.header, snapshot=self.snapshot, replace=True)
+        self.assertEqual(self.storage.load_game('game1'), (self.header, self.snapshot, []))
+        self.storage.save_game('game1', moves=[(0, (3, 2), [3, 3], [], 'later')])
+        self.storage.save_game('game1', moves=[(1, (6, 6), [5, 5], [[4, 4]], 'latest')])
+        header, snapshot, moves = self.storage.load_game('game1')
+        self.assertEqual(header, self.header[:7] + ('latest', ) + self.header[8:])
+        self.assertEqual(moves, [((3, 2), [3, 3], [], 'later'), ((6, 6), [5, 5], [[4, 4]], 'latest')])
+
+    def test_replace(self):
+        self.storage.save_game('game1', self.header, [(0, (3, 2), [3, 3], [], 'now')], self.snapshot)
+        self.storage.save_game('game1', self.header, [], self.snapshot, replace=True)
+        self.assertEqual(self.storage.load_game('game1')[2], [])
+
+    def test_migrate_once(self):
+        self.storage.save_game('game1', self.header, snapshot=self.snapshot)
+        reopened = ThudStorage.GameStorage(self.storage.path)
+        try:
+            self.assertEqual(reopened.load_game('game1'), (self.header, self.snapshot, []))
+        finally:
+            reopened.close()
+
+    def test_find_games(self):
+        for number in range(5):
+            status = 'Finished' if number % 2 else 'Active'
+            self.storage.save_game('game{}'.format(number), ('game{}'.format(number), 'one', 'token1', 'Dwarf',
+                                                            'two' if number < 3 else 'three', 'token2', 'Troll',
+                                                            '2016-01-0{}'.format(number + 1), status, None, None))
+        self.assertEqual([game[0] for game in self.storage.find_games(player='two')], ['game2', 'game1', 'game0'])
+        self.assertEqual([game[0] for game in self.storage.find_games(player='one', status='Active')],
+                         ['game4', 'game2', 'game0'])
+        self.assertEqual([game[0] for game in self.storage.find_games(status='Finished')], ['game3', 'game1'])
+        first_page = self.storage.find_games(limit=2)
+        self.assertEqual([game[0] for game in first_page], ['game4', 'game3'])
+        self.assertEqual([game[0] for game in self.storage.find_games(before=(first_page[-1][5], first_page[-1][0]))],
+                         ['game2', 'game1', 'game0'])
+        self.assertEqual(len(self.storage.find_games(limit=1000)), 5)
+
+    def test_game_indexes(self):
+        plan = self.storage.connection().execute(
+            "EXPLAIN QUERY PLAN SELECT gametoken FROM games WHERE status = ? ORDER BY last_accessed DESC",
+            ('Active', )).fetchall()
+        self.assertTrue(any('games_status' in step[-1] for step in plan))
+
+    def test_history_indexes(self):
+        for listing in ({"player": 'one'}, {}, {"player": 'one', "before": ('now', 'game1')}):
+            query, parameters = self.storage.listing_query(**listing)
+            plan = self.storage.connection().execute("EXPLAIN QUERY PLAN " + query, parameters).fetchall()
+            self.assertFalse(any('TEMP B-TREE' in step[-1] for step in plan), listing)
+            self.assertTrue(any('history' in step[-1] for step in plan), listing)
+
+    def test_next_game_number(self):
+        self.assertEqual(self.storage.next_game_number('onetwo'), 1)
+        self.assertEqual(self.storage.next_game_number('onetwo'), 2)
+        self.assertEqual(self.storage.next_game_number('twoone'), 1)
+        self.storage.save_game('threefour7', ('threefour7', 'three', 't1', 'Dwarf', 'four', 't2', 'Troll', 'now',
+                                              'Active', None, None))
+        self.assertEqual(self.storage.next_game_number('threefour'), 8)
+
+    def test_migrate_legacy_games(self):
+        path = os.path.join(self.directory.name, 'legacy.db')
+        connection = sqlite3.connect(path)
+        ThudStorage.create_games_table(connection)
+        connection.execute("INSERT INTO Games VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                           self.header[:8] + ('[[[3, 2], [3, 3]]]', '{"1": {}}', '{"0": []}'))
+        connection.execute("PRAGMA user_version = 1")
+        connection.commit()
+        connection.close()
+        storage = ThudStorage.GameStorage(path)
+        try:
+            self.assertEqual(storage.load_game('game1'),
+                             (self.header, (1, '{"1": {}}', '{"0": []}'), [((3, 2), [3, 3], [], 'now')]))
+        finally:
+            storage.close()
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = ThudStorage.GameStorage(os.path.join(self.directory.name, 'source.db'))
+        self.target = ThudStorage.GameStorage(os.path.join(self.directory.name, 'target.db'))
+
+    def tearDown(self):
+        self.source.close()
+        self.target.close()
+        self.directory.cleanup()
+
+    def save_games(self, count):
+        game_manager = Thud.GameManager(self.source.path)
+        try:
+            for number in range(count):
+                game_manager.start_game('one', 'two')
+            for game_id in sorted(game_manager.active_games):
+                game = game_manager.active_games[game_id]
+                start, destination, captures = game.legal_moves()[0]
+                game_manager.process_move({"game": game_id, "player": game.side_to_move().token,
+                                           "start": start, "destination": destination})
+            game_manager.flush()
+            return sorted(game_manager.active_games)
+        finally:
+            game_manager.storage.close()
+
+    def test_export_import(self):
+        game_ids = self.save_games(5)
+        path = os.path.join(self.directory.name, 'games.ndjson')
+        with archive.open_archive(path, 'w') as file:
+            self.assertEqual(archive.export_games(self.source, file, chunk_size=2), 5)
+        with archive.open_archive(path, 'r') as file:
+            self.assertEqual([json.loads(line)["gametoken"] for line in file], game_ids)
+        with archive.open_archive(path, 'r') as file:
+            self.assertEqual(archive.import_games(self.target, file, batch_size=2), 5)
+        for game_id in game_ids:
+            self.assertEqual(self.target.load_game(game_id), self.source.load_game(game_id))
+        self.assertEqual(self.target.next_game_number('onetwo'), 6)
+
+    def test_gzip_and_reimport(self):
+        game_ids = self.save_games(2)
+        path = os.path.join(self.directory.name, 'games.ndjson.gz')
+        self.assertEqual(archive.main(['export', path, '--db', self.source.path]), 2)
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(2), b'\x1f\x8b')
+        self.assertEqual(archive.main(['import', path, '--db', self.target.path]), 2)
+        self.assertEqual(archive.main(['import', path, '--db', self.target.path]), 2)
+        game_manager = Thud.GameManager(self.target.path)
+        try:
+            game = game_manager.active_games[game_ids[0]]
+            self.assertEqual(len(game.move_history), 1)
+        finally:
+            game_manager.storage.close()
+
+
 class PieceTest(unittest.TestCase):
 
     def test_piece_init_location(self):
@@ -9,6 +9,7 @@ urlpatterns = [
         url(r"^getgamebyid/([a-zA-Z0-9]+)", ThudServerDjango.get_game_by_id_handler),
         url(r"^version", ThudServerDjango.get_version),
         url(r"^start", ThudServerDjango.StartGameWithPlayers),
+        url(r"^moves", ThudServerDjango.LegalMoves),
         url(r"^move", ThudServerDjango.ExecuteMove),
         url(r"^move/validate", ThudServerDjango.ValidateMove),
         url(r"^game", ThudServerDjango.GetBoardState),